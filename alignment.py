@@ -0,0 +1,55 @@
+# Copyright 2022
+# Author: scott.allan.stone@gmail.com (Scott Stone)
+import numpy as np
+
+SNAP_MODES = ('nearest', 'left', 'right')
+
+def align_timestamps(time_stamps: np.ndarray,
+                     reference: np.ndarray,
+                     mode: str = 'nearest',
+                     max_gap: float = None) -> np.ndarray:
+    """Map a batch of timestamps (e.g. markers) onto sample indices of a sorted reference clock (e.g. gaze).
+       mode='nearest' snaps to the closest sample, 'left' to the last sample at or before the timestamp and
+       'right' to the first sample at or after it.
+       Timestamps further than max_gap seconds from their snapped sample (or that fall outside the reference
+       for left/right snapping) map to -1.
+       Only temporaries the size of `time_stamps` are allocated, never the size of `reference`.
+    """
+    if mode not in SNAP_MODES:
+        raise ValueError(f"mode must be one of {SNAP_MODES}, not {mode!r}")
+
+    time_stamps = np.asarray(time_stamps, dtype=np.float64)
+    n = len(reference)
+    if n == 0:
+        return np.full(time_stamps.shape, -1, dtype=np.int64)
+
+    right = np.searchsorted(reference, time_stamps, side='left') # first sample >= ts
+    if mode == 'right':
+        idx = right
+    else:
+        left = np.searchsorted(reference, time_stamps, side='right') - 1 # last sample <= ts
+        if mode == 'left':
+            idx = left
+        else:
+            left_c, right_c = np.clip(left, 0, n - 1), np.clip(right, 0, n - 1)
+            closer_right = np.abs(reference[right_c] - time_stamps) < np.abs(time_stamps - reference[left_c])
+            idx = np.where(closer_right, right_c, left_c)
+
+    outside = (idx < 0) | (idx >= n)
+    idx = np.clip(idx, 0, n - 1)
+    if max_gap is not None:
+        outside |= np.abs(reference[idx] - time_stamps) > max_gap
+
+    return np.where(outside, -1, idx).astype(np.int64)
+
+def align_intervals(starts: np.ndarray,
+                    ends: np.ndarray,
+                    reference: np.ndarray,
+                    mode: str = 'nearest',
+                    max_gap: float = None) -> tuple:
+    """Map paired start/end timestamps onto reference sample indices in one searchsorted call
+    """
+    starts = np.asarray(starts, dtype=np.float64)
+    idx = align_timestamps(np.concatenate((starts, np.asarray(ends, dtype=np.float64))),
+                           reference, mode=mode, max_gap=max_gap)
+    return idx[:len(starts)], idx[len(starts):]
@@ -1,10 +1,21 @@
 # Copyright 2022
 # Author: scott.allan.stone@gmail.com (Scott Stone)
-from msilib.schema import Error
-import liesl
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.patches import Ellipse
+from metrics import metrics_by_phase, phase_metrics
+from markers import MarkerIndex
+from alignment import align_intervals
+from session import load_session, GAZE_COLUMNS, Stream
+from spectral import nystagmus_spectrum, NYSTAGMUS_BAND
+from spectral import spectrogram as short_time_spectrum
+from events import detect_events, eye_velocity
+from profiling import Profiler, profiled
+from pursuit import analyze_pursuit, pursuit_paths
+from timeline import load_timeline
+from jump import analyze_jumps
+from markers import JUMP_MARKERS, BRIGHTNESS_MARKER
+from pupil import analyze_pupil
+from preprocess import gaze_pipeline
+import os
 
 class Analyzer:
     def __init__(self, 
@@ -12,38 +23,64 @@ class Analyzer:
                  stimulus_marker_name: str,
                  gaze_name: str,
                  phases: str = None,
-                 dpi: int = 300):
+                 dpi: int = 300,
+                 redo: str = 'latest',
+                 snap: str = 'nearest',
+                 max_gap: float = None,
+                 cache: str = 'use',
+                 channels: tuple = GAZE_COLUMNS,
+                 extra_channels: tuple = (),
+                 dtype=None,
+                 release: bool = False,
+                 preprocess: dict = None,
+                 profile: Profiler = None):
 
         self.file = file
         self.stimulus_marker_name = stimulus_marker_name
         self.gaze_name = gaze_name
-        self.data = liesl.XDFFile(file, verbose=True) # verbose is broken
-        self.sample_rate = self.data[self.gaze_name]._stream['info']['effective_srate']
+        # Times every pipeline stage when given an enabled Profiler, see profiling.py
+        self.profiler = profile if profile is not None else Profiler(enabled=False)
+        with self.profiler.stage('load_session'):
+            self.session = load_session(file, stimulus_marker_name, gaze_name,
+                                        columns=tuple(channels) + tuple(extra_channels), dtype=dtype, cache=cache)
+        # Channels loaded after the gaze columns for the stages that need them (by name, e.g. 'confidence')
+        self.n_gaze = len(channels)
+        self.extra_columns = {name: self.n_gaze + i for i, name in enumerate(extra_channels)}
+        self.sample_rate = self.session.sample_rate
         self.phases = phases # default to None
         self.dpi = dpi # default to 300, for image output
+        self.redo = redo # which run of a redone phase to keep: 'latest' or 'first'
+        self.snap = snap # how markers snap to gaze samples: 'nearest', 'left' or 'right'
+        self.max_gap = max_gap # seconds between a marker and its gaze sample before it's rejected
+        self.release = release # drop the full gaze stream once the phases are extracted
+        self.preprocess = preprocess # options for preprocess.gaze_pipeline ({} for the defaults), None for raw gaze
+        self.dispersions = {} # phase -> (mean gaze, dispersion x, dispersion y)
 
         self._pull_marker_data()
         self._find_start_end_phase_indices()
         self._convert_idx_to_timestamps()
         self._get_gaze_data()
+        self._preprocess_gaze()
+        self._get_sub_phases()
         self._get_gaze_by_phase()
-        valid = self._verify_integrity
+        valid = self._verify_integrity()
         if valid is False:
-            raise Error("\tData integrity check failed")
+            raise RuntimeError("\tData integrity check failed")
         else:
             print(f"\tData validity passed. Found {len(self.phases)} phases and {len(self.gaze_data)} gaze chunks.")
 
+    @profiled()
     def _verify_integrity(self) -> bool:
-        """Verify that we have all of the data (5 streams)
+        """Verify that we have all of the data
         Checks if: 
-            - There are 5 streams
+            - There is a gaze chunk for every phase
             - There are the correct number of markers
             - There are the correct number of gaze chunks
         """
-        if len(self.data) != len(self.phases):
+        if len(self.gaze_data) != len(self.phases):
             return False
 
-        for stream in zip(self.data, self.phases):
+        for stream in zip(self.gaze_data, self.phases):
             gaze, phase = stream
             # Check if gaze has any data in it
             if len(gaze) == 0:
@@ -54,88 +91,251 @@ class Analyzer:
 
         return True
 
+    @profiled()
     def _pull_marker_data(self) -> None:
         """Pull the data from the file and store it
         """
-        self.markers = self.data[self.stimulus_marker_name]
+        self.markers = self.session.markers
         if self.phases is None:
             self.phases = ['stare','pursuit','vor', 'jump', 'brightness']
         self.phase_starts = self.phases.copy()
         self.phase_ends = [phase + '_end' for phase in self.phase_starts]
 
+    @profiled()
     def _find_start_end_phase_indices(self) -> None:
         """Find the indices of the start and end of each phase
         """
-        self.marker_start_idx, self.marker_end_idx = [], []
-        for marker in self.markers.time_series:
-            for marker_start in self.phase_starts:
-                if marker[0] == marker_start:
-                    self.marker_start_idx.append(self.markers.time_series.index(marker))
-            for marker_end in self.phase_ends:
-                if marker[0] == marker_end:
-                    self.marker_end_idx.append(self.markers.time_series.index(marker))
+        self.marker_index = MarkerIndex(self.markers.time_series, self.markers.time_stamps)
+        self.phases, self.marker_start_idx, self.marker_end_idx = \
+            self.marker_index.phase_bounds(self.phase_starts, redo=self.redo)
+        self.phase_starts = self.phases.copy()
+        self.phase_ends = [phase + '_end' for phase in self.phase_starts]
 
+    @profiled()
     def _convert_idx_to_timestamps(self) -> None:
         """Convert the marker_stimulus timestamps to gaze timestamps so we can extract the data
         """
-        self.timestamps_start, self.timestamps_end = [], []
-        for idx in zip(self.marker_start_idx, self.marker_end_idx):
-            self.timestamps_start.append(self.markers.time_stamps[idx[0]])
-            self.timestamps_end.append(self.markers.time_stamps[idx[1]])
-            
+        self.timestamps_start = self.marker_index.time_stamps[self.marker_start_idx]
+        self.timestamps_end = self.marker_index.time_stamps[self.marker_end_idx]
+
+    @profiled()
     def _get_gaze_data(self) -> None:
         """Get gaze data for each phase
         """
-        self.gaze = self.data[self.gaze_name]
-        self.gaze_timestamps_start, self.gaze_timestamps_end = [], []
-        for ts in zip(self.timestamps_start, self.timestamps_end):
-            self.gaze_timestamps_start.append(np.min(np.abs(ts[0] - self.gaze.time_stamps).argmin()))
-            self.gaze_timestamps_end.append(np.min(np.abs(ts[1] - self.gaze.time_stamps).argmin()))
+        self.gaze = self.session.gaze
+        self.gaze_timestamps_start, self.gaze_timestamps_end = \
+            align_intervals(self.timestamps_start, self.timestamps_end, self.gaze.time_stamps,
+                            mode=self.snap, max_gap=self.max_gap)
+        missing = (self.gaze_timestamps_start < 0) | (self.gaze_timestamps_end < 0)
+        if np.any(missing):
+            raise ValueError(f"No gaze data within {self.max_gap}s of phase markers: "
+                             f"{[phase for phase, m in zip(self.phases, missing) if m]}")
+
+    @profiled()
+    def _preprocess_gaze(self) -> None:
+        """With preprocess, run the gaze columns through preprocess.gaze_pipeline over the whole stream, a chunk
+           at a time: masked by the confidence channel (which must be in extra_channels), gaps bridged and
+           Savitzky-Golay smoothed. The smoothed columns replace the raw ones and their velocity (per second)
+           goes in gaze_velocity, sliced per phase into phase_velocity.
+        """
+        self.gaze_velocity = None
+        if self.preprocess is None:
+            return
+        if 'confidence' not in self.extra_columns:
+            raise ValueError("Preprocessing masks by confidence, pass 'confidence' in extra_channels")
+        columns = list(range(self.n_gaze)) + [self.extra_columns['confidence']]
+        cleaned = gaze_pipeline(self.sample_rate, **self.preprocess).run(self.gaze.time_stamps, self.gaze.time_series,
+                                                                         columns=columns)
+        time_series = np.array(self.gaze.time_series) # the session's may be a read-only memory map
+        time_series[:, :self.n_gaze] = cleaned[:, :self.n_gaze]
+        self.gaze = Stream(time_series, self.gaze.time_stamps)
+        self.gaze_velocity = cleaned[:, self.n_gaze:2 * self.n_gaze]
 
+    @profiled()
+    def _get_sub_phases(self) -> None:
+        """Find the pursuit sub-phases (pursuit_<dir>_start / _end) and their gaze indices, only those of the
+           pursuit run the redo policy kept (a redone pursuit leaves the abandoned run's markers behind)
+        """
+        names, starts, ends = self.marker_index.sub_phase_bounds('pursuit', redo=self.redo)
+        timestamps_start = self.marker_index.time_stamps[starts]
+        timestamps_end = self.marker_index.time_stamps[ends]
+        if 'pursuit' in self.phases:
+            i = self.phases.index('pursuit')
+            inside = (timestamps_start >= self.timestamps_start[i]) & (timestamps_end <= self.timestamps_end[i])
+        else:
+            inside = np.zeros(len(names), dtype=bool)
+        names, timestamps_start, timestamps_end = names[inside], timestamps_start[inside], timestamps_end[inside]
+        gaze_start, gaze_end = align_intervals(timestamps_start, timestamps_end, self.gaze.time_stamps,
+                                               mode=self.snap, max_gap=self.max_gap)
+        found = (gaze_start >= 0) & (gaze_end >= 0)
+        self.sub_phases = list(names[found])
+        self.sub_phase_timestamps_start, self.sub_phase_timestamps_end = timestamps_start[found], timestamps_end[found]
+        self.sub_phase_gaze_start, self.sub_phase_gaze_end = gaze_start[found], gaze_end[found]
+
+    @profiled()
     def _get_gaze_by_phase(self) -> None:
-        """Get gaze data for each phase
+        """Get gaze data for each phase (and pursuit sub-phase).
+           phase_samples / sub_phase_samples hold every loaded column and their timestamps are in
+           phase_time_stamps / sub_phase_time_stamps; gaze_data / sub_phase_data are the gaze columns of them.
         """
-        self.gaze_data = []
+        self.phase_samples, self.phase_time_stamps = [], []
         for idx in zip(self.gaze_timestamps_start, self.gaze_timestamps_end):
             start, end = idx
-            self.gaze_data.append(self.gaze.time_series[start:end, -4:])
+            self.phase_samples.append(self.gaze.time_series[start:end]) # only the loaded columns are there
+            self.phase_time_stamps.append(self.gaze.time_stamps[start:end])
+        self.sub_phase_samples = [self.gaze.time_series[start:end]
+                                  for start, end in zip(self.sub_phase_gaze_start, self.sub_phase_gaze_end)]
+        self.sub_phase_time_stamps = [self.gaze.time_stamps[start:end]
+                                      for start, end in zip(self.sub_phase_gaze_start, self.sub_phase_gaze_end)]
+        self.phase_velocity = None if self.gaze_velocity is None else \
+            [self.gaze_velocity[start:end] for start, end in zip(self.gaze_timestamps_start, self.gaze_timestamps_end)]
 
-    def calculate_velocity(self, save=True, show=False) -> None:
-        """Calculate the velocity of gaze data for each phase
+        if self.release:
+            # Copy the phases out so nothing references the full stream any more. Sub-phases lie inside a
+            # phase (pursuit) and become views of its copy instead of second copies of the same samples
+            self.phase_samples = [np.array(samples) for samples in self.phase_samples]
+            self.phase_time_stamps = [np.array(time_stamps) for time_stamps in self.phase_time_stamps]
+            bounds = list(zip(self.sub_phase_gaze_start, self.sub_phase_gaze_end))
+            self.sub_phase_samples = [self._within_phase(self.phase_samples, samples, start, end)
+                                      for samples, (start, end) in zip(self.sub_phase_samples, bounds)]
+            self.sub_phase_time_stamps = [self._within_phase(self.phase_time_stamps, time_stamps, start, end)
+                                          for time_stamps, (start, end) in zip(self.sub_phase_time_stamps, bounds)]
+            if self.phase_velocity is not None:
+                self.phase_velocity = [np.array(velocity) for velocity in self.phase_velocity]
+            self.gaze = None
+            self.gaze_velocity = None
+            self.session.release_gaze()
+
+        self.gaze_data = [samples[:, :self.n_gaze] for samples in self.phase_samples]
+        self.sub_phase_data = [samples[:, :self.n_gaze] for samples in self.sub_phase_samples]
+
+    def _within_phase(self, phases: list, samples: np.ndarray, start: int, end: int) -> np.ndarray:
+        """Samples start:end of the gaze stream as a view of the copied phase that holds them, or a copy of
+           their own if no phase does
         """
-        self.velocity = []
+        for phase, phase_start, phase_end in zip(phases, self.gaze_timestamps_start, self.gaze_timestamps_end):
+            if phase_start <= start and end <= phase_end:
+                return phase[start - phase_start:end - phase_start]
+        return np.array(samples)
+
+    def channel(self, name: str, samples: np.ndarray) -> np.ndarray:
+        """One of the extra channels out of a phase's samples, e.g. channel('confidence', analyzer.phase_samples[i])
+        """
+        if name not in self.extra_columns:
+            raise ValueError(f"Channel {name!r} wasn't loaded, pass it in extra_channels")
+        return samples[:, self.extra_columns[name]]
+
+    @profiled()
+    def calculate_velocity(self) -> None:
+        """Calculate the velocity of gaze data for each phase.
+           self.eye_velocity holds the speed of each eye in units per second, (N, 2) per phase. With
+           preprocess it comes from the Savitzky-Golay derivative instead of np.gradient of the raw gaze.
+        """
+        self.velocity, self.eye_velocity = [], []
+        if self.phase_velocity is not None:
+            for velocity in self.phase_velocity:
+                self.velocity.append(np.linalg.norm(velocity, axis=1) / self.sample_rate) # per sample, like np.gradient
+                pairs = velocity[:, :4].reshape(-1, 2, 2)
+                self.eye_velocity.append(np.hypot(pairs[..., 0], pairs[..., 1]))
+            return
         for gaze_data in self.gaze_data:
             self.velocity.append(np.linalg.norm(np.gradient(gaze_data, axis=0), axis=1))
+            self.eye_velocity.append(eye_velocity(gaze_data, self.sample_rate))
+
+    @profiled()
+    def detect_events(self, **thresholds) -> None:
+        """Label saccades, fixations and nystagmus slow / fast phases in each phase, for both eyes.
+           self.events maps each phase to a list of EVENT_DTYPE arrays (eye 0, eye 1), see events.py.
+           Keyword arguments are passed on to events.detect_events (high, low, min_duration, drift).
+        """
+        if not hasattr(self, 'eye_velocity'):
+            self.calculate_velocity()
 
-        # Plot the velocity
-        for velocity, phase in zip(self.velocity, self.phases):
-            plt.figure()
-            plt.title(f"Velocity of {phase} data")
-            plt.plot(velocity)
-            if save is True:
-                plt.savefig(f'{self.file[:-4]}_{phase}_velocity.png', dpi=self.dpi)   
-            if show is True:
-                plt.show()
-            
-            plt.clf()
+        self.events = {}
+        for gaze_data, velocity, phase in zip(self.gaze_data, self.eye_velocity, self.phases):
+            self.events[phase] = [detect_events(gaze_data[:, 2 * eye:2 * eye + 2], self.sample_rate,
+                                                velocity=velocity[:, eye], **thresholds)
+                                  for eye in range(velocity.shape[1])]
 
-    def calculate_distance(self) -> None:
-        """Calculate the distance between gaze data for each phase
+    @profiled()
+    def calculate_pursuit(self, timeline: str = None, **options) -> None:
+        """Gain, lag and catch-up saccades of every pursuit sub-phase against the regenerated target,
+           see pursuit.py. Needs pursuit.PURSUIT_CHANNELS in extra_channels. The target comes from the
+           recording's saved timeline (<session>_timeline.npz, or the file given) when there is one,
+           otherwise from the protocol constants. self.pursuit is a PURSUIT_DTYPE array in sub_phases order.
         """
-        def dist(x1, y1, x2, y2):
-            return np.sqrt((x2 - x1)**2 + (y2 - y1)**2)
+        if len(self.sub_phases) == 0:
+            self.pursuit = analyze_pursuit([], np.empty(0), [], [], self.sample_rate)
+            return
+        timeline = timeline or os.path.splitext(self.file.rstrip('/'))[0] + '_timeline.npz'
+        paths = pursuit_paths(load_timeline(timeline)) if os.path.exists(timeline) else pursuit_paths()
+        positions = [np.column_stack((self.channel('norm_pos_x', samples), self.channel('norm_pos_y', samples)))
+                     for samples in self.sub_phase_samples]
+        confidence = [self.channel('confidence', samples) for samples in self.sub_phase_samples]
+        self.pursuit = analyze_pursuit(self.sub_phases, self.sub_phase_timestamps_start, self.sub_phase_time_stamps,
+                                       positions, self.sample_rate, confidence=confidence, paths=paths, **options)
 
-        self.distances = []
-        for gaze_data in self.gaze_data:
-            distance = 0
-            for gaze_idx in range(len(gaze_data) - 1):
-                distance += dist(gaze_data[gaze_idx, 0], gaze_data[gaze_idx, 1],
-                                      gaze_data[gaze_idx + 1, 0], gaze_data[gaze_idx + 1, 1])
-            self.distances.append(distance)
+    @profiled()
+    def calculate_jumps(self, **options) -> None:
+        """Latency, amplitude, accuracy and corrective saccades of both eyes after every jump marker of the
+           jump phase, see jump.py. Needs jump.JUMP_CHANNELS in extra_channels.
+           self.jumps is a JUMP_DTYPE array in marker order (empty without a jump phase).
+        """
+        if 'jump' not in self.phases:
+            self.jumps = analyze_jumps([], np.empty(0), np.empty(0), np.empty((0, 4)), self.sample_rate)
+            return
+        i = self.phases.index('jump')
+        positions, labels = self.marker_index.events(JUMP_MARKERS)
+        times = self.marker_index.time_stamps[positions]
+        inside = (times >= self.timestamps_start[i]) & (times <= self.timestamps_end[i])
+        samples = self.phase_samples[i]
+        eyes = np.column_stack([self.channel(name, samples) for name in
+                                ('gaze_normal_3d_eye_0_x', 'gaze_normal_3d_eye_0_y',
+                                 'gaze_normal_3d_eye_1_x', 'gaze_normal_3d_eye_1_y')])
+        self.jumps = analyze_jumps(list(labels[inside]), times[inside], self.phase_time_stamps[i], eyes,
+                                   self.sample_rate, confidence=self.channel('confidence', samples), **options)
+
+    @profiled()
+    def calculate_pupil(self, diameter: str = '3d', **options) -> None:
+        """Pupillary light response of both eyes to brightness_high in the brightness phase, see pupil.py.
+           Needs the diameter_<diameter>_eye_0/1 channels and confidence in extra_channels (pupil.PUPIL_CHANNELS
+           for '3d'). self.pupil is a PUPIL_DTYPE array, one row per brightness_high in the phase.
+        """
+        if 'brightness' not in self.phases:
+            self.pupil = analyze_pupil(np.empty(0), np.empty(0), np.empty((0, 2)), self.sample_rate)
+            return
+        i = self.phases.index('brightness')
+        times = self.marker_index.timestamps(BRIGHTNESS_MARKER)
+        times = times[(times >= self.timestamps_start[i]) & (times <= self.timestamps_end[i])]
+        samples = self.phase_samples[i]
+        diameters = np.column_stack([self.channel(f'diameter_{diameter}_eye_{eye}', samples) for eye in range(2)])
+        self.pupil = analyze_pupil(times, self.phase_time_stamps[i], diameters, self.sample_rate,
+                                   confidence=self.channel('confidence', samples), **options)
+
+    @profiled()
+    def calculate_metrics(self) -> None:
+        """Calculate path length, velocity and dispersion for both eyes in each phase and pursuit sub-phase
+        """
+        self.metrics = metrics_by_phase(self.gaze_data, self.phases, self.sample_rate)
+        self.sub_phase_metrics = [phase_metrics(gaze, self.sample_rate) for gaze in self.sub_phase_data]
+
+    @profiled()
+    def calculate_distance(self) -> None:
+        """Calculate the distance between gaze data for each phase (eye 0, see self.metrics for both eyes)
+        """
+        self.calculate_metrics()
+        self.distances = [self.metrics[phase]['path_length'][0] for phase in self.phases]
 
-    def calculate_dispersion(self, phase: str='stare', save=True, show=False) -> None:
-        """Calculate the dispersion of gaze data for each phase
+    @profiled()
+    def calculate_dispersion(self, phase: str='stare') -> None:
+        """Calculate the dispersion of gaze data for a phase. Every phase asked for is kept in
+           self.dispersions, the last one is also in mean_gaze / dispersion_x / dispersion_y.
+           A phase the session doesn't have is skipped, leaving them NaN.
         """
+        if phase not in self.phases:
+            self.mean_gaze = np.full(self.n_gaze, np.nan)
+            self.dispersion_x = self.dispersion_y = np.nan
+            return
         phase_idx = self.phases.index(phase)
         gaze = self.gaze_data[phase_idx]
 
@@ -143,73 +343,46 @@ class Analyzer:
         self.mean_gaze = np.mean(gaze, axis=0)
         self.dispersion_x = np.std(gaze[:, 0])
         self.dispersion_y = np.std(gaze[:, 1])
+        self.dispersions[phase] = (self.mean_gaze, self.dispersion_x, self.dispersion_y)
 
-        # Draw ellipsoid of the dispersion
-        plt.figure()
-        plt.title(f"Dispersion of {phase} data")
-        plt.plot(gaze[:, 0], gaze[:, 1], 'r')
-        plt.plot(gaze[:, 2], gaze[:, 3], 'b')
-        plt.plot(self.mean_gaze[0], self.mean_gaze[1], '.k')
-        plt.plot(self.mean_gaze[2], self.mean_gaze[3], '.k') # other eye
-        ellipse = Ellipse((self.mean_gaze), self.dispersion_x, self.dispersion_y, fill=False, color='r')
-        plt.gca().add_patch(ellipse)
-
-        if save is True:
-            plt.savefig(f'{self.file[:-4]}_{phase}_dispersion.png', dpi=self.dpi)
-        if show is True:
-            plt.show()
-
-        plt.clf()
-
-    def calculate_frequency(self, cutoff=5) -> None:
-        """Calculate the nystagmus frequency of gaze data for each phase
+    @profiled()
+    def calculate_frequency(self, cutoff=5, band: tuple = NYSTAGMUS_BAND, spectrogram: bool = False) -> None:
+        """Calculate the nystagmus frequency of gaze data for each phase with Welch's method, all four
+           gaze columns at once.
+           self.frequency maps each phase to the dominant frequency and band power of every column,
+           self.spectra to (frequencies, PSD x, PSD y) of eye 0 between 0 and cutoff Hz for plotting,
+           and self.spectrograms (if asked for) to (times, frequencies, power).
         """
-
+        self.frequency, self.spectra, self.spectrograms = {}, {}, {}
         for i in zip(self.gaze_data, self.phases):
-            # Get the stare data from the gaze
             gaze, phase = i
             print(f'\tCalculating frequency for {phase} data')
 
-            gaze_x, gaze_y = gaze[:, 0], gaze[:, 1]
-
-            # Calculate the nystagmus frequency using the FFT of the gaze data
-            N = len(gaze)
-            T = 1 / self.sample_rate
-
-            yf_x = np.abs(np.fft.fft(gaze[:, 0]))
-            yf_x = yf_x[:int(N/2)]
-            yf_y = np.abs(np.fft.fft(gaze[:, 1]))
-            yf_y = yf_y[:int(N/2)]
-            xf = np.fft.fftfreq(N, T)[:N//2]
-
-            freq_idx = np.where((xf <= cutoff) & (xf > 0)) # cut of 0hz and above 5hz
-            plt.plot(xf[freq_idx], yf_x[freq_idx])
-            plt.plot(xf[freq_idx], yf_y[freq_idx])
-            plt.legend(['x', 'y'])
-            plt.title(f'Frequency decomposition of {phase} data')
-            plt.ylabel('Power')
-            plt.xlabel('Frequency (Hz)')
-            plt.savefig(f'{self.file[:-4]}_{phase}_frequency.png', dpi=self.dpi)
-            plt.clf()
-
-    def plot(self, save=True, show=False) -> None:
-        """Plot gaze data for each phase (and save it if wanted)
-        """
-        for gaze_data, phase in zip(self.gaze_data, self.phases):
-            plt.plot(gaze_data[:, 0], gaze_data[:, 1], label=phase, marker='.', color='r')
-            plt.plot(gaze_data[:, 2], gaze_data[:, 3], label=phase, marker='.', color='b')
-            plt.title(phase)
-            if save is True:
-                plt.savefig(f'{self.file[:-4]}_{phase}.png', dpi=self.dpi)
-            if show is True:
-                plt.show()
-            plt.clf()
-    
+            spectrum = nystagmus_spectrum(gaze, self.sample_rate, band=band)
+            self.frequency[phase] = {'dominant_frequency': spectrum['dominant_frequency'],
+                                     'band_power': spectrum['band_power']}
+
+            xf, psd = spectrum['frequencies'], spectrum['psd']
+            keep = (xf <= cutoff) & (xf > 0) # cut of 0hz and above 5hz
+            self.spectra[phase] = (xf[keep], psd[keep, 0], psd[keep, 1])
+
+            if spectrogram is True:
+                self.spectrograms[phase] = short_time_spectrum(gaze, self.sample_rate)
+
+    @profiled()
+    def plot(self) -> None:
+        """Render every figure for the calculations done so far. matplotlib is only imported here,
+           so analysis on its own never loads it.
+        """
+        from plots import Renderer
+        with Renderer(dpi=self.dpi) as renderer:
+            renderer.render(self)
+
     def analyze(self) -> None:
-        """Simple alias to run all of the calculations and plotting commands, since this 
-           is the most common use case.
+        """Simple alias to run all of the calculations, since this is the most common use case.
+           Rendering is a separate step, see plot() and plots.py.
         """
         self.calculate_dispersion(phase='stare')
-        self.calculate_distance()
+        self.calculate_distance() # also fills self.metrics
         self.calculate_velocity()
-        self.plot()
\ No newline at end of file
+        self.detect_events()
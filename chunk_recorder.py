@@ -0,0 +1,225 @@
+# Copyright 2022
+# Author: scott.allan.stone@gmail.com (Scott Stone)
+import argparse
+import json
+import os
+import threading
+import time
+import numpy as np
+import pylsl
+from monitor import LSL_DTYPES, channel_labels
+from session import Session, Stream, project_columns, GAZE_COLUMNS
+from xdf_writer import XDFWriter, NUMERIC_FORMATS
+
+LABEL_SIZE = 64 # bytes kept of every string sample (marker labels are much shorter)
+LSL_FORMATS = {pylsl.cf_float32: 'float32', pylsl.cf_double64: 'double64', pylsl.cf_string: 'string',
+               pylsl.cf_int8: 'int8', pylsl.cf_int16: 'int16', pylsl.cf_int32: 'int32', pylsl.cf_int64: 'int64'}
+
+def chunk_dir(file: str) -> str:
+    """The chunked recording of data/pt_x/pt_x.xdf lives in data/pt_x/pt_x.chunks/
+    """
+    return os.path.splitext(file)[0] + '.chunks'
+
+def record_dtype(channel_format: str, channel_count: int) -> np.dtype:
+    """One fixed-size record per sample: its timestamp, then its values (or its first string, utf-8)
+    """
+    if channel_format == 'string':
+        return np.dtype([('time', '<f8'), ('value', f'S{LABEL_SIZE}')])
+    return np.dtype([('time', '<f8'), ('value', NUMERIC_FORMATS[channel_format], (channel_count,))])
+
+class _StreamFile:
+    """One bound stream: its inlet, a preallocated block of records, and the file the blocks go to
+    """
+    def __init__(self, inlet: pylsl.StreamInlet, directory: str, block_samples: int):
+        info = inlet.info()
+        self.inlet = inlet
+        self.name = info.name()
+        self.format = LSL_FORMATS[info.channel_format()]
+        self.channel_count = info.channel_count()
+        self.records = np.zeros(block_samples, dtype=record_dtype(self.format, self.channel_count))
+        self.chunk = None if self.format == 'string' else \
+            np.empty((block_samples, self.channel_count), dtype=LSL_DTYPES[info.channel_format()])
+        self.count = 0 # records waiting in the block
+        self.written = 0
+
+        meta = {'name': self.name, 'type': info.type(), 'channel_count': self.channel_count,
+                'nominal_srate': info.nominal_srate(), 'channel_format': self.format,
+                'source_id': info.source_id(), 'channel_labels': channel_labels(info) or None}
+        base = os.path.join(directory, self.name)
+        with open(base + '.json', 'w') as f:
+            json.dump(meta, f, indent=2)
+        self.f = open(base + '.bin', 'ab')
+
+    def pull(self) -> int:
+        """Pull what has arrived into the free part of the block, returns the number of samples
+        """
+        free = len(self.records) - self.count
+        if self.chunk is None:
+            samples, time_stamps = self.inlet.pull_chunk(timeout=0.0, max_samples=free)
+            values = [str(sample[0]).encode()[:LABEL_SIZE] for sample in samples]
+        else:
+            _, time_stamps = self.inlet.pull_chunk(timeout=0.0, max_samples=free, dest_obj=self.chunk)
+            values = self.chunk[:len(time_stamps)]
+        n = len(time_stamps)
+        if n:
+            block = self.records[self.count:self.count + n]
+            block['time'] = time_stamps
+            block['value'] = values
+            self.count += n
+        return n
+
+    def full(self) -> bool:
+        return self.count == len(self.records)
+
+    def write(self) -> None:
+        """Append the block to the file. Records are fixed size, so a crash mid-write only loses the last one.
+        """
+        if self.count:
+            self.f.write(self.records[:self.count].tobytes())
+            self.f.flush()
+            self.written += self.count
+            self.count = 0
+
+    def sync(self) -> None:
+        os.fsync(self.f.fileno())
+
+    def close(self) -> None:
+        self.write()
+        self.sync()
+        self.f.close()
+
+class ChunkRecorder:
+    """In-process recorder next to liesl.Recorder, with the same bind / start_recording / stop_recording.
+       A background thread pulls every bound stream in chunks into preallocated blocks and appends them to
+       one file of fixed-size records per stream, with an fsync every `fsync_interval` seconds. A session
+       that crashes halfway is still readable up to the last block: read_chunks() loads it as a Session,
+       load_session() / Analyzer accept the .chunks directory, and to_xdf() converts it.
+    """
+    def __init__(self, block_seconds: float = 1.0, fsync_interval: float = 2.0, poll: float = 0.1,
+                 resolve_timeout: float = 2.0):
+        self.block_seconds = block_seconds
+        self.fsync_interval = fsync_interval
+        self.poll = poll
+        self.resolve_timeout = resolve_timeout
+        self.streams = []
+        self.directory = None
+        self._files = []
+        self._thread = None
+        self._stop = threading.Event()
+
+    def bind(self, streams: list) -> None:
+        """Streams to record, as liesl takes them: a list of dicts of stream properties, e.g. {"type": "Gaze"}
+        """
+        self.streams = streams
+
+    def _resolve(self) -> list:
+        inlets = []
+        for props in self.streams:
+            predicate = " and ".join(f"{key}='{value}'" for key, value in props.items())
+            found = pylsl.resolve_bypred(predicate, 1, self.resolve_timeout)
+            if len(found) == 0:
+                print(f"ChunkRecorder: no stream matching {props}, not recording it")
+                continue
+            inlets.append(pylsl.StreamInlet(found[0], max_buflen=360, processing_flags=pylsl.proc_clocksync))
+        return inlets
+
+    def start_recording(self, filename: str) -> None:
+        """Record next to `filename` (the XDF liesl writes), in chunk_dir(filename)
+        """
+        self.directory = chunk_dir(filename)
+        os.makedirs(self.directory, exist_ok=True)
+        self._files = []
+        for inlet in self._resolve():
+            srate = inlet.info().nominal_srate()
+            block_samples = max(64, int(srate * self.block_seconds)) if srate > 0 else 64
+            self._files.append(_StreamFile(inlet, self.directory, block_samples))
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='chunk-recorder', daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        last_write = last_sync = time.monotonic()
+        while not self._stop.wait(self.poll):
+            for stream in self._files:
+                # Keep pulling while the block fills up, so a burst never waits for the next poll
+                while stream.pull() and stream.full():
+                    stream.write()
+            now = time.monotonic()
+            if now - last_write >= self.block_seconds:
+                for stream in self._files:
+                    stream.write()
+                last_write = now
+            if now - last_sync >= self.fsync_interval:
+                for stream in self._files:
+                    stream.sync()
+                last_sync = now
+
+    def stop_recording(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        for stream in self._files:
+            while stream.pull() and stream.full():
+                stream.write()
+            stream.close()
+
+def read_stream(directory: str, name: str) -> tuple:
+    """(stream meta, records) of one recorded stream. The records are memory-mapped; a partial last record
+       (the recorder crashed while writing it) is left out.
+    """
+    base = os.path.join(directory, name)
+    with open(base + '.json') as f:
+        meta = json.load(f)
+    dtype = record_dtype(meta['channel_format'], meta['channel_count'])
+    n = os.path.getsize(base + '.bin') // dtype.itemsize
+    if n == 0:
+        return meta, np.zeros(0, dtype=dtype)
+    return meta, np.memmap(base + '.bin', dtype=dtype, mode='r', shape=(n,))
+
+def stream_names(directory: str) -> list:
+    return sorted(os.path.splitext(f)[0] for f in os.listdir(directory) if f.endswith('.json'))
+
+def read_chunks(directory: str,
+                stimulus_marker_name: str,
+                gaze_name: str,
+                columns: tuple = GAZE_COLUMNS,
+                dtype=None) -> Session:
+    """Load a chunked recording like session.read_xdf loads an XDF file
+    """
+    _, markers = read_stream(directory, stimulus_marker_name)
+    _, gaze = read_stream(directory, gaze_name)
+    labels = np.char.decode(markers['value'], 'utf-8').astype(str)
+    span = gaze['time'][-1] - gaze['time'][0] if len(gaze) > 1 else 0
+    return Session(markers=Stream(labels, np.array(markers['time'])),
+                   gaze=Stream(project_columns(gaze['value'], columns, dtype), np.array(gaze['time'])),
+                   sample_rate=(len(gaze) - 1) / span if span > 0 else 0.0,
+                   columns=columns)
+
+def to_xdf(directory: str, file: str, block_samples: int = 1 << 16) -> None:
+    """Convert a chunked recording to an XDF file, block_samples at a time
+    """
+    with XDFWriter(file) as xdf:
+        for stream_id, name in enumerate(stream_names(directory), start=1):
+            meta, records = read_stream(directory, name)
+            xdf.add_stream(stream_id, meta['name'], meta['type'], meta['channel_count'], meta['nominal_srate'],
+                           meta['channel_format'], channel_labels=meta['channel_labels'],
+                           source_id=meta['source_id'])
+            for first in range(0, len(records), block_samples):
+                block = records[first:first + block_samples]
+                if meta['channel_format'] == 'string':
+                    samples = [[label] for label in np.char.decode(block['value'], 'utf-8')]
+                else:
+                    samples = block['value']
+                xdf.write_samples(stream_id, block['time'], samples)
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a chunked recording (a .chunks directory) to XDF")
+    parser.add_argument('directory')
+    parser.add_argument('--out', default=None, help="XDF file to write (default: next to the directory)")
+    args = parser.parse_args()
+    out = args.out or os.path.splitext(args.directory.rstrip('/'))[0] + '_chunks.xdf'
+    to_xdf(args.directory, out)
+    print(f"Wrote {out}")
+
+if __name__ == '__main__':
+    main()
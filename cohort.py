@@ -0,0 +1,230 @@
+# Copyright 2022
+# Author: scott.allan.stone@gmail.com (Scott Stone)
+import argparse
+import json
+import os
+from glob import glob
+import numpy as np
+from metrics import METRIC_NAMES, N_EYES
+from spectral import segment_spectra, NYSTAGMUS_BAND
+
+MAGIC = b'COHORT1\n'
+ALIGN = 64 # the gaze block starts on a 64 byte boundary
+
+class Cohort:
+    """Every phase of every session in one ragged array: a flat, contiguous (N, 4) gaze buffer plus
+       offsets, so segment i is gaze[offsets[i]:offsets[i + 1]] and belongs to
+       (sessions[segment_session[i]], phases[segment_phase[i]]).
+       The metrics run over the whole cohort at once with segmented reductions (np.add.reduceat and
+       friends) instead of one small NumPy call per phase per session.
+    """
+    def __init__(self, gaze: np.ndarray, offsets: np.ndarray, segment_session: np.ndarray,
+                 segment_phase: np.ndarray, sessions: list, phases: list, sample_rates: np.ndarray):
+        self.gaze = gaze
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.segment_session = np.asarray(segment_session, dtype=np.int32)
+        self.segment_phase = np.asarray(segment_phase, dtype=np.int32)
+        self.sessions = list(sessions)
+        self.phases = list(phases)
+        self.sample_rates = np.asarray(sample_rates, dtype=np.float64)
+        # Sub-phases repeat within a session (pursuit_right_centre runs twice), so the key also counts
+        # how many segments of that session and phase came before
+        self._index = {}
+        for i, (s, p) in enumerate(zip(self.segment_session.tolist(), self.segment_phase.tolist())):
+            occurrence = 0
+            while (self.sessions[s], self.phases[p], occurrence) in self._index:
+                occurrence += 1
+            self._index[(self.sessions[s], self.phases[p], occurrence)] = i
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def segment(self, session: str, phase: str, occurrence: int = 0) -> int:
+        return self._index[(session, phase, occurrence)]
+
+    def __getitem__(self, key: tuple) -> np.ndarray:
+        """cohort['pt_x', 'stare'] is that phase's gaze, a view into the flat buffer;
+           cohort['pt_x', 'pursuit_right_centre', 1] is the second run of a repeated sub-phase
+        """
+        i = self.segment(*key)
+        return self.gaze[self.offsets[i]:self.offsets[i + 1]]
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    @property
+    def segment_rates(self) -> np.ndarray:
+        return self.sample_rates[self.segment_session]
+
+    def _reduce(self, ufunc, values: np.ndarray, empty=np.nan) -> np.ndarray:
+        """ufunc.reduceat over every segment of a per-sample array; empty segments get `empty`
+        """
+        lengths = self.lengths
+        out = np.full((len(self),) + values.shape[1:], empty, dtype=np.float64)
+        nonempty = lengths > 0
+        if np.any(nonempty):
+            out[nonempty] = ufunc.reduceat(values, self.offsets[:-1][nonempty], axis=0)
+        return out
+
+    def steps(self, gaze: np.ndarray = None) -> np.ndarray:
+        """Distance from each sample to the next one of the same segment, per eye: (N, 2), 0 at every
+           segment's last sample
+        """
+        gaze = self.gaze[:, :2 * N_EYES].astype(np.float64) if gaze is None else gaze
+        diff = np.diff(gaze, axis=0)
+        diff *= diff
+        steps = np.zeros((len(gaze), N_EYES))
+        np.sqrt(diff[:, 0::2] + diff[:, 1::2], out=steps[:-1])
+        steps[self.offsets[1:][self.lengths > 0] - 1] = 0
+        return steps
+
+    def velocity(self) -> np.ndarray:
+        """Speed of each eye at every sample in units per second, (N, 2), like steps()
+        """
+        return self.steps() * np.repeat(self.segment_rates, self.lengths)[:, None]
+
+    def metrics(self) -> dict:
+        """metrics.phase_metrics for every segment at once: every entry is an (n_segments, 2) array
+        """
+        n = self.lengths.astype(np.float64)
+        rates = self.segment_rates
+        metrics = {'n_samples': np.repeat(n[:, None], N_EYES, axis=1),
+                   'duration': np.repeat((n / rates)[:, None], N_EYES, axis=1)}
+
+        gaze = self.gaze[:, :2 * N_EYES].astype(np.float64)
+        steps = self.steps(gaze)
+        path_length = self._reduce(np.add, steps)
+        metrics['path_length'] = path_length
+        metrics['mean_velocity'] = path_length * (rates / np.maximum(n - 1, 1))[:, None]
+        metrics['peak_velocity'] = self._reduce(np.maximum, steps) * rates[:, None]
+
+        mean = self._reduce(np.add, gaze) / np.maximum(n, 1)[:, None]
+        # Two passes (like np.std) so the dispersion doesn't lose precision far from the origin
+        gaze -= np.repeat(mean, self.lengths, axis=0)
+        gaze *= gaze
+        std = np.sqrt(self._reduce(np.add, gaze) / np.maximum(n, 1)[:, None])
+        metrics['mean_x'], metrics['mean_y'] = mean[:, 0::2], mean[:, 1::2]
+        metrics['dispersion_x'], metrics['dispersion_y'] = std[:, 0::2], std[:, 1::2]
+
+        short = n < 2
+        for name in METRIC_NAMES[2:]:
+            metrics[name][short] = np.nan
+        return metrics
+
+    def spectra(self, sample_rate: float = None, segment_seconds: float = 8.0, overlap: float = 0.5,
+                batch: int = 256) -> tuple:
+        """Welch spectrum of every gaze column of every segment, one FFT size for the whole cohort so the
+           windows of all segments go through rfft together, `batch` windows at a time.
+           sample_rate defaults to the median session rate. Segments shorter than one window are NaN.
+           Returns (frequencies (F,), psd (n_segments, F, 4)).
+        """
+        sample_rate = float(np.median(self.sample_rates)) if sample_rate is None else sample_rate
+        nperseg = int(2 ** round(np.log2(max(2, segment_seconds * sample_rate))))
+        step = max(1, int(nperseg * (1 - overlap)))
+        n_windows = np.maximum(0, (self.lengths - nperseg) // step + 1)
+        owner = np.repeat(np.arange(len(self)), n_windows)
+        window_starts = self.offsets[:-1][owner] + step * (np.arange(len(owner)) -
+                                                           np.repeat(np.cumsum(n_windows) - n_windows, n_windows))
+
+        frequencies = np.fft.rfftfreq(nperseg, 1 / sample_rate)
+        columns = self.gaze.shape[1]
+        psd = np.zeros((len(self), len(frequencies), columns))
+        within = np.arange(nperseg)
+        for first in range(0, len(window_starts), batch):
+            starts = window_starts[first:first + batch]
+            windows = self.gaze[starts[:, None] + within].astype(np.float64) # (W, nperseg, C)
+            _, power = segment_spectra(np.moveaxis(windows, 2, 0), sample_rate, 'constant') # (C, W, F)
+            # Windows are grouped by segment, so each segment's share of the batch is one reduceat run
+            segments, runs = np.unique(owner[first:first + batch], return_index=True)
+            psd[segments] += np.add.reduceat(np.moveaxis(power, 0, -1), runs, axis=0)
+        psd /= np.maximum(n_windows, 1)[:, None, None]
+        psd[n_windows == 0] = np.nan
+        return frequencies, psd
+
+    def band_summary(self, band: tuple = NYSTAGMUS_BAND, **spectra_options) -> dict:
+        """Dominant frequency and band power of every column of every segment, (n_segments, 4) each
+        """
+        frequencies, psd = self.spectra(**spectra_options)
+        in_band = (frequencies >= band[0]) & (frequencies <= band[1])
+        band_psd = psd[:, in_band]
+        dominant = frequencies[in_band][np.argmax(np.nan_to_num(band_psd, nan=-1), axis=1)]
+        dominant[np.isnan(band_psd[:, 0])] = np.nan
+        return {'dominant_frequency': dominant,
+                'band_power': band_psd.sum(axis=1) * (frequencies[1] - frequencies[0])}
+
+    def save(self, file: str) -> None:
+        """One file: magic, header length, JSON header, then the gaze buffer (memory-mappable)
+        """
+        header = {'dtype': self.gaze.dtype.str, 'shape': list(self.gaze.shape),
+                  'offsets': self.offsets.tolist(), 'segment_session': self.segment_session.tolist(),
+                  'segment_phase': self.segment_phase.tolist(), 'sessions': self.sessions,
+                  'phases': self.phases, 'sample_rates': self.sample_rates.tolist()}
+        raw = json.dumps(header).encode()
+        raw += b' ' * (-(len(MAGIC) + 8 + len(raw)) % ALIGN)
+        with open(file, 'wb') as f:
+            f.write(MAGIC)
+            f.write(np.uint64(len(raw)).tobytes())
+            f.write(raw)
+            f.write(np.ascontiguousarray(self.gaze).tobytes())
+
+def load_cohort(file: str, mmap: bool = True) -> Cohort:
+    """Read a saved Cohort, its gaze buffer memory-mapped unless mmap is False
+    """
+    with open(file, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{file} is not a cohort file")
+        length = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = json.loads(f.read(length))
+    data_offset = len(MAGIC) + 8 + length
+    shape = tuple(header['shape'])
+    if mmap:
+        gaze = np.memmap(file, dtype=header['dtype'], mode='r', offset=data_offset, shape=shape)
+    else:
+        gaze = np.fromfile(file, dtype=header['dtype'], offset=data_offset).reshape(shape)
+    return Cohort(gaze, header['offsets'], header['segment_session'], header['segment_phase'],
+                  header['sessions'], header['phases'], header['sample_rates'])
+
+def build_cohort(files: list, stimulus_marker_name: str = 'Stimulus_Markers', gaze_name: str = 'pupil_capture',
+                 cache: str = 'use', dtype=np.float32, sub_phases: bool = True) -> Cohort:
+    """Segment every session with Analyzer and pack the phases (and pursuit sub-phases, as
+       pursuit_<name>) into one Cohort. Sessions that fail to segment are skipped.
+    """
+    from analyzer import Analyzer
+
+    chunks, lengths, segment_session, segment_phase, sessions, rates = [], [], [], [], [], []
+    phases = {}
+    for file in files:
+        try:
+            analyzer = Analyzer(file, stimulus_marker_name, gaze_name, cache=cache, dtype=dtype)
+        except (RuntimeError, ValueError, KeyError) as e:
+            print(f"\t{file}: skipped ({e})")
+            continue
+        segments = list(zip(analyzer.phases, analyzer.gaze_data))
+        if sub_phases:
+            segments += [('pursuit_' + name, gaze) for name, gaze in zip(analyzer.sub_phases, analyzer.sub_phase_data)]
+        for phase, gaze in segments:
+            chunks.append(np.asarray(gaze, dtype=dtype))
+            lengths.append(len(gaze))
+            segment_session.append(len(sessions))
+            segment_phase.append(phases.setdefault(phase, len(phases)))
+        sessions.append(os.path.splitext(os.path.basename(file))[0])
+        rates.append(analyzer.sample_rate)
+
+    gaze = np.concatenate(chunks) if chunks else np.zeros((0, 2 * N_EYES), dtype=dtype)
+    return Cohort(gaze, np.concatenate(([0], np.cumsum(lengths))), segment_session, segment_phase,
+                  sessions, list(phases), rates)
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack every session's phases into one cohort file")
+    parser.add_argument('--glob', default='data/pt*/*.xdf', help="which recordings to pack")
+    parser.add_argument('--out', default='data/cohort.bin')
+    args = parser.parse_args()
+
+    cohort = build_cohort(sorted(glob(args.glob)))
+    cohort.save(args.out)
+    print(f"Packed {len(cohort)} phases of {len(cohort.sessions)} sessions ({cohort.gaze.nbytes / 2**20:.1f}MB) "
+          f"into {args.out}")
+
+if __name__ == '__main__':
+    main()
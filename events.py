@@ -0,0 +1,109 @@
+# Copyright 2022
+# Author: scott.allan.stone@gmail.com (Scott Stone)
+import numpy as np
+
+EVENT_LABELS = ('fixation', 'saccade', 'slow_phase', 'fast_phase')
+FIXATION, SACCADE, SLOW_PHASE, FAST_PHASE = range(len(EVENT_LABELS))
+EVENT_DTYPE = np.dtype([('label', np.uint8),          # index into EVENT_LABELS
+                        ('start', np.int64),          # first sample
+                        ('end', np.int64),            # one past the last sample
+                        ('peak_velocity', np.float64),
+                        ('amplitude', np.float64)])   # distance between the first and last sample
+
+def eye_velocity(gaze: np.ndarray, sample_rate: float) -> np.ndarray:
+    """Speed of each eye in units per second, (N, 4) gaze -> (N, 2)
+    """
+    gradient = np.gradient(np.asarray(gaze, dtype=np.float64)[:, :4], axis=0).reshape(-1, 2, 2) * sample_rate
+    return np.hypot(gradient[..., 0], gradient[..., 1])
+
+def runs(mask: np.ndarray) -> tuple:
+    """Start and (exclusive) end of every run of True in a boolean array
+    """
+    edges = np.diff(np.concatenate(([0], mask.view(np.int8), [0])))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+def run_max(values: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """Maximum of values[start:end] for every (non-empty) run, in one reduceat call
+    """
+    if len(starts) == 0:
+        return np.empty(0, dtype=values.dtype)
+    padded = np.append(values, values[-1]) # so an end of len(values) is still a valid index
+    return np.maximum.reduceat(padded, np.stack((starts, ends), axis=1).ravel())[::2]
+
+def adaptive_thresholds(velocity: np.ndarray, high: float = 6, low: float = 3) -> tuple:
+    """Velocity thresholds from the median and median absolute deviation of the speed, so they don't
+       depend on what units the gaze is in
+    """
+    median = np.median(velocity)
+    mad = np.median(np.abs(velocity - median)) * 1.4826
+    return median + high * mad, median + low * mad
+
+def detect_events(position: np.ndarray,
+                  sample_rate: float,
+                  velocity: np.ndarray = None,
+                  high: float = None,
+                  low: float = None,
+                  min_duration: float = 0.01,
+                  drift: float = None) -> np.ndarray:
+    """I-VT event detection with hysteresis for one eye.
+       A saccade is a run of samples faster than `low` that reaches `high` at least once and lasts at least
+       min_duration seconds. Everything between saccades is a fixation, or a nystagmus slow phase if it
+       drifts faster than `drift`. A saccade that goes against the slow phase before it is a fast phase.
+       Thresholds default to the adaptive ones (units per second), drift to a quarter of `low`.
+       Returns a structured EVENT_DTYPE array sorted by start.
+    """
+    position = np.asarray(position, dtype=np.float64)[:, :2]
+    n = len(position)
+    if n < 2:
+        return np.empty(0, dtype=EVENT_DTYPE)
+    if velocity is None:
+        gradient = np.gradient(position, axis=0) * sample_rate
+        velocity = np.hypot(gradient[:, 0], gradient[:, 1])
+    if high is None or low is None:
+        adaptive_high, adaptive_low = adaptive_thresholds(velocity)
+        high = adaptive_high if high is None else high
+        low = adaptive_low if low is None else low
+    if drift is None:
+        drift = low / 4
+
+    # Hysteresis: runs above the low threshold that reach the high one
+    starts, ends = runs(velocity > low)
+    peaks = run_max(velocity, starts, ends)
+    fast = (peaks > high) & ((ends - starts) >= max(1, int(min_duration * sample_rate)))
+    sacc_start, sacc_end, sacc_peak = starts[fast], ends[fast], peaks[fast]
+
+    # The gaps between saccades
+    gap_start = np.concatenate(([0], sacc_end))
+    gap_end = np.concatenate((sacc_start, [n]))
+    gap_keep = gap_end > gap_start
+    gap_start, gap_end = gap_start[gap_keep], gap_end[gap_keep]
+    gap_peak = run_max(velocity, gap_start, gap_end)
+
+    def displacement(start, end):
+        return position[end - 1] - position[start]
+
+    gap_move = displacement(gap_start, gap_end)
+    gap_speed = np.hypot(gap_move[:, 0], gap_move[:, 1]) / np.maximum(gap_end - gap_start, 1) * sample_rate
+    gap_label = np.where(gap_speed > drift, SLOW_PHASE, FIXATION)
+
+    # A fast phase resets the slow drift just before it
+    sacc_move = displacement(sacc_start, sacc_end)
+    before = np.searchsorted(gap_end, sacc_start, side='right') - 1
+    has_before = (before >= 0) & (gap_end[np.maximum(before, 0)] == sacc_start)
+    before = np.maximum(before, 0)
+    against = np.einsum('ij,ij->i', sacc_move, gap_move[before]) < 0
+    sacc_label = np.where(has_before & (gap_label[before] == SLOW_PHASE) & against, FAST_PHASE, SACCADE)
+
+    events = np.empty(len(sacc_start) + len(gap_start), dtype=EVENT_DTYPE)
+    events['label'] = np.concatenate((sacc_label, gap_label))
+    events['start'] = np.concatenate((sacc_start, gap_start))
+    events['end'] = np.concatenate((sacc_end, gap_end))
+    events['peak_velocity'] = np.concatenate((sacc_peak, gap_peak))
+    events['amplitude'] = np.hypot(*np.concatenate((sacc_move, gap_move)).T)
+    return events[np.argsort(events['start'], kind='stable')]
+
+def count_events(events: np.ndarray) -> dict:
+    """Number of events of each label
+    """
+    counts = np.bincount(events['label'], minlength=len(EVENT_LABELS))
+    return dict(zip(EVENT_LABELS, counts.tolist()))
@@ -0,0 +1,95 @@
+# Copyright 2022
+# Author: scott.allan.stone@gmail.com (Scott Stone)
+import numpy as np
+from pylsl import local_clock
+from markers import PURSUIT_DIRECTIONS, JUMP_MARKERS, BRIGHTNESS_MARKER
+
+CONDITIONS = ('', 'stare', 'pursuit', 'vor', 'jump', 'brightness')
+SUB_PHASES = ('',) + tuple(dict.fromkeys('pursuit_' + dir for dir in PURSUIT_DIRECTIONS)) \
+             + JUMP_MARKERS + (BRIGHTNESS_MARKER,)
+FRAME_DTYPE = np.dtype([('frame', np.int64),       # frame number on the scheduler's ideal grid
+                        ('time', np.float64),      # pylsl.local_clock() right after the flip
+                        ('condition', np.uint8),   # index into CONDITIONS
+                        ('sub_phase', np.uint8),   # index into SUB_PHASES
+                        ('paced', np.bool_)])      # False for the first frame after a pause (see resume)
+
+class FrameLog:
+    """When every frame was actually presented, in a preallocated ring buffer.
+       Call phase() when the condition / sub-phase changes, record() right after every flip and resume()
+       after waiting on the experimenter. Each is a couple of scalar stores, so logging can't cause the
+       drops it is looking for. flush() appends the trial's frames to a binary file (read back with
+       read_frame_log) and summarises them.
+       If more than `capacity` frames are recorded between flushes the oldest are overwritten.
+    """
+    def __init__(self, fps: float = 60, capacity: int = 2 ** 16, clock=local_clock):
+        self.fps = fps
+        self.clock = clock
+        self.buffer = np.zeros(capacity, dtype=FRAME_DTYPE)
+        self.capacity = capacity
+        self.count = 0 # frames since the last flush
+        self.condition = 0
+        self.sub_phase = 0
+        self.paced = False
+        self._condition_codes = {name: i for i, name in enumerate(CONDITIONS)}
+        self._sub_phase_codes = {name: i for i, name in enumerate(SUB_PHASES)}
+
+    def phase(self, condition: str = None, sub_phase: str = '') -> None:
+        """Set what the following frames belong to. A new condition resets the sub-phase.
+        """
+        if condition is not None:
+            self.condition = self._condition_codes[condition]
+        self.sub_phase = self._sub_phase_codes[sub_phase]
+
+    def record(self, frame: int, time_stamp: float = None) -> None:
+        """Log one presented frame, call right after pygame.display.flip() (time_stamp defaults to now)
+        """
+        if time_stamp is None:
+            time_stamp = self.clock()
+        self.buffer[self.count % self.capacity] = (frame, time_stamp, self.condition, self.sub_phase, self.paced)
+        self.count += 1
+        self.paced = True
+
+    def resume(self) -> None:
+        """The next frame comes after a pause, so it isn't compared against the one before it
+        """
+        self.paced = False
+
+    def frames(self) -> np.ndarray:
+        """The frames since the last flush, oldest first
+        """
+        if self.count <= self.capacity:
+            return self.buffer[:self.count]
+        return np.roll(self.buffer, -(self.count % self.capacity))
+
+    def flush(self, file: str) -> dict:
+        """Append the frames since the last flush to a binary file and return their summary
+        """
+        frames = self.frames()
+        with open(file, 'ab') as f:
+            f.write(frames.tobytes())
+        summary = frame_summary(frames, self.fps)
+        summary['overwritten'] = max(0, self.count - self.capacity)
+        self.count = 0
+        return summary
+
+def read_frame_log(file: str) -> np.ndarray:
+    return np.fromfile(file, dtype=FRAME_DTYPE)
+
+def frame_summary(frames: np.ndarray, fps: float, tolerance: float = 0.002) -> dict:
+    """Dropped and late frames in a FRAME_DTYPE log.
+       Between two logged frames the time should be (frame difference) / fps. Each whole frame more than that
+       is a dropped frame, a slip under half a frame but over `tolerance` seconds is a late one.
+       Frames after a pause and extra flips within the same frame aren't compared.
+    """
+    period = 1 / fps
+    elapsed, steps = np.diff(frames['time']), np.diff(frames['frame'])
+    keep = frames['paced'][1:] & (steps > 0)
+    elapsed, steps = elapsed[keep], steps[keep]
+    slip = elapsed - steps * period
+    dropped = np.maximum(np.round(slip / period), 0).astype(np.int64)
+    intervals = elapsed[steps == 1]
+    return {'frames': len(frames),
+            'dropped': int(dropped.sum()),
+            'late': int(np.count_nonzero((dropped == 0) & (slip > tolerance))),
+            'mean_interval_ms': float(intervals.mean() * 1000) if len(intervals) else None,
+            'max_interval_ms': float(intervals.max() * 1000) if len(intervals) else None}
@@ -0,0 +1,67 @@
+# Copyright 2022
+# Author: scott.allan.stone@gmail.com (Scott Stone)
+import pygame
+from timeline import CROSS, DOT, TARGET_SIZE
+
+RENDER_MODES = ('dirty', 'full')
+
+class FrameRenderer:
+    """Draws compiled timeline frames (see timeline.py) onto the display surface.
+       In 'dirty' mode only the rectangles where the target was and now is are repainted and sent to the
+       display with pygame.display.update(rects). Anything that invalidates that (a new background colour,
+       text drawn on top, the first frame) falls back to a full fill and flip, as 'full' mode always does.
+    """
+    def __init__(self, screen: pygame.Surface, mode: str = 'dirty', target_size: int = TARGET_SIZE,
+                 cross_size: int = 10, cross_width: int = 4):
+        if mode not in RENDER_MODES:
+            raise ValueError(f"mode must be one of {RENDER_MODES}, not {mode!r}")
+        self.screen = screen
+        self.mode = mode
+        self.target_size = target_size
+        self.cross_size = cross_size
+        self.cross_width = cross_width
+        self.background = None
+        self.previous = [] # where the target was drawn last
+        self.rects = None  # what present() has to update, None for the whole screen
+        self.stale = True  # the screen holds something other than the last frame drawn
+
+    def cross(self, centre: tuple, colour: tuple) -> pygame.Rect:
+        x, y = centre
+        size, width = self.cross_size, self.cross_width
+        vertical = pygame.draw.line(self.screen, colour, (x, y - size), (x, y + size), width)
+        return vertical.union(pygame.draw.line(self.screen, colour, (x - size, y), (x + size, y), width))
+
+    def dot(self, centre: tuple, colour: tuple) -> pygame.Rect:
+        return pygame.draw.circle(self.screen, colour, centre, self.target_size, 0)
+
+    def draw(self, shape: int, x: int, y: int, colour: tuple, background: tuple) -> None:
+        full = self.mode == 'full' or self.stale or background != self.background
+        if full:
+            self.screen.fill(background)
+        else:
+            for rect in self.previous:
+                self.screen.fill(background, rect)
+
+        drawn = []
+        if shape == CROSS:
+            drawn.append(self.cross((x, y), colour))
+        elif shape == DOT:
+            drawn.append(self.dot((x, y), colour))
+
+        self.rects = None if full or self.rects is None else self.rects + self.previous + drawn
+        self.previous = drawn
+        self.background = background
+        self.stale = False
+
+    def invalidate(self) -> None:
+        """Something else was drawn on the screen: the next present() and draw() cover all of it
+        """
+        self.rects = None
+        self.stale = True
+
+    def present(self) -> None:
+        if self.rects is None:
+            pygame.display.flip()
+        else:
+            pygame.display.update(self.rects)
+        self.rects = []
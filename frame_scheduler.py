@@ -0,0 +1,92 @@
+# Copyright 2022
+# Author: scott.allan.stone@gmail.com (Scott Stone)
+import time
+import pygame
+
+class FrameScheduler:
+    """Frame pacing for the stimulus on time.perf_counter.
+       Waits sleep until `spin` seconds before the deadline, then spin on the clock for the rest, so they are
+       precise without pinning a core. The pygame event queue is pumped while sleeping so the window stays
+       responsive. Holds are rounded to whole frames and measured from the last frame boundary, so
+       consecutive holds don't drift. Every wait's overshoot past its deadline is kept for report().
+       frame_count counts frames on that ideal grid (idle time included), see frame_log.py.
+    """
+    def __init__(self, fps: float = 60, spin: float = 0.002, sleep_slice: float = 0.005, late: float = 0.001):
+        self.fps = fps
+        self.frame = 1 / fps
+        self.spin = spin # seconds before a deadline to stop sleeping; more on OSes with coarse sleep
+        self.sleep_slice = sleep_slice # longest single sleep, so events get pumped regularly
+        self.late = late # overshoot (seconds) that counts as late
+        self.deadline = time.perf_counter()
+        self.frame_count = 0
+        self.waits = 0
+        self.late_waits = 0
+        self.resyncs = 0
+        self.total_overshoot = 0.0
+        self.max_overshoot = 0.0
+
+    def frames(self, seconds: float) -> int:
+        """Whole display frames closest to a duration (at least one)
+        """
+        return max(1, round(seconds * self.fps))
+
+    def _start(self) -> float:
+        """Where the next wait counts from: the last frame boundary if we are still within a frame of it,
+           otherwise (after waiting on the experimenter, say) now
+        """
+        now = time.perf_counter()
+        if now - self.deadline > self.frame:
+            self.resyncs += 1
+            self.frame_count += int((now - self.deadline) / self.frame)
+            return now
+        return self.deadline
+
+    def sync(self) -> None:
+        """Restart the frame grid from now, e.g. right after waiting on the experimenter
+        """
+        now = time.perf_counter()
+        self.frame_count += max(0, int((now - self.deadline) / self.frame))
+        self.deadline = now
+
+    def wait_until(self, deadline: float) -> float:
+        """Sleep-then-spin until the deadline, returns the overshoot in seconds
+        """
+        remaining = deadline - time.perf_counter()
+        while remaining > self.spin:
+            if pygame.display.get_init():
+                pygame.event.pump()
+            time.sleep(min(remaining - self.spin, self.sleep_slice))
+            remaining = deadline - time.perf_counter()
+        while time.perf_counter() < deadline:
+            pass
+        overshoot = time.perf_counter() - deadline
+        self.deadline = deadline
+        self.waits += 1
+        self.total_overshoot += overshoot
+        self.max_overshoot = max(self.max_overshoot, overshoot)
+        if overshoot > self.late:
+            self.late_waits += 1
+        return overshoot
+
+    def tick(self) -> float:
+        """Wait for the next frame boundary (replaces pygame.time.Clock.tick(FPS))
+        """
+        start = self._start()
+        self.frame_count += 1
+        return self.wait_until(start + self.frame)
+
+    def hold(self, seconds: float) -> int:
+        """Hold for the whole number of frames closest to `seconds`, returns how many
+        """
+        n = self.frames(seconds)
+        start = self._start()
+        self.frame_count += n
+        self.wait_until(start + n * self.frame)
+        return n
+
+    def report(self) -> dict:
+        return {'waits': self.waits,
+                'late': self.late_waits,
+                'resyncs': self.resyncs,
+                'mean_overshoot_ms': 1000 * self.total_overshoot / max(1, self.waits),
+                'max_overshoot_ms': 1000 * self.max_overshoot}
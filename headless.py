@@ -0,0 +1,55 @@
+# Copyright 2022
+# Author: scott.allan.stone@gmail.com (Scott Stone)
+import csv
+import pygame
+from pylsl import local_clock
+
+# What the experimenter does at each wait_for_space(): 'space' carries on, 'redo' asks to redo the trial first
+KEY_RESPONSES = {'space': (pygame.K_SPACE,), 'redo': (pygame.K_r, pygame.K_SPACE)}
+
+class KeyScript:
+    """Scripted experimenter for a headless run: every wait_for_space() gets the next response, then 'space'
+    """
+    def __init__(self, responses: list = ()):
+        unknown = set(responses) - set(KEY_RESPONSES)
+        if unknown:
+            raise ValueError(f"key responses must be in {tuple(KEY_RESPONSES)}, not {sorted(unknown)}")
+        self.responses = list(responses)
+
+    def post(self) -> None:
+        response = self.responses.pop(0) if self.responses else 'space'
+        for key in KEY_RESPONSES[response]:
+            pygame.event.post(pygame.event.Event(pygame.KEYDOWN, key=key))
+
+class FakeOutlet:
+    """Stands in for the Stimulus_Markers StreamOutlet: keeps every marker with its timestamp
+    """
+    def __init__(self):
+        self.samples = []
+
+    def push_sample(self, sample: list, timestamp: float = 0.0, pushthrough: bool = True) -> None:
+        self.samples.append((sample[0], timestamp if timestamp else local_clock()))
+
+    def wait_for_consumers(self, timeout: float) -> bool:
+        return True
+
+    def have_consumers(self) -> bool:
+        return True
+
+    def save(self, file: str) -> None:
+        with open(file, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(('label', 'time_stamp'))
+            writer.writerows(self.samples)
+
+class FakeRecorder:
+    """Stands in for liesl.Recorder when there is no eye tracker or LabRecorder to talk to
+    """
+    def bind(self, streams: list) -> None:
+        self.streams = streams
+
+    def start_recording(self, filename: str) -> None:
+        self.filename = filename
+
+    def stop_recording(self) -> None:
+        pass
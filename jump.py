@@ -0,0 +1,126 @@
+# Copyright 2022
+# Author: scott.allan.stone@gmail.com (Scott Stone)
+import numpy as np
+from events import adaptive_thresholds, runs, run_max
+from pursuit import affine_calibration
+from timeline import JUMP_TARGETS
+from metrics import N_EYES
+
+# Where each eye looks (its gaze direction, mapped onto the screen by calibration) and the confidence
+JUMP_CHANNELS = ('gaze_normal_3d_eye_0_x', 'gaze_normal_3d_eye_0_y',
+                 'gaze_normal_3d_eye_1_x', 'gaze_normal_3d_eye_1_y', 'confidence')
+JUMP_DTYPE = np.dtype([('label', 'U16'),                        # jump marker, e.g. 'jump_left'
+                       ('time', np.float64),                    # of the marker
+                       ('size', np.float64),                    # horizontal target jump, screen fractions
+                       ('latency', np.float64, (N_EYES,)),      # seconds to the primary saccade onset
+                       ('amplitude', np.float64, (N_EYES,)),    # of the primary saccade, screen fractions
+                       ('gain', np.float64, (N_EYES,)),         # primary amplitude / target jump
+                       ('error', np.float64, (N_EYES,)),        # landing position - target
+                       ('corrective_saccades', np.int64, (N_EYES,))])
+
+def analyze_jumps(labels: list,
+                  marker_times: np.ndarray,
+                  time_stamps: np.ndarray,
+                  positions: np.ndarray,
+                  sample_rate: float,
+                  confidence: np.ndarray = None,
+                  calibrate: bool = True,
+                  min_confidence: float = 0.6,
+                  min_latency: float = 0.08,
+                  max_latency: float = 0.6,
+                  min_gain: float = 0.25,
+                  settle: float = 0.4,
+                  corrective_window: float = 0.4) -> np.ndarray:
+    """Saccadic response to every jump marker, both eyes at once.
+       labels / marker_times are the jump markers (jump_left, jump_right, jump_cross) in order,
+       time_stamps / positions (N, 4: x_0, y_0, x_1, y_1) / confidence the gaze of the jump phase.
+       With calibrate, each eye's horizontal position is mapped onto the screen by an affine fit on the
+       samples from `settle` seconds after every marker to the next one, where it should sit on the target.
+       Saccades are hysteresis runs above events.adaptive_thresholds of the horizontal speed. The primary
+       saccade is the first one starting min_latency..max_latency seconds after the marker (and before the
+       next) that goes at least min_gain of the way towards the target, found for every marker and eye with
+       searchsorted windows over the saccade onsets. Corrective saccades are the ones starting within
+       corrective_window seconds after it ends. Returns a JUMP_DTYPE array, one row per marker; a marker with
+       no target change (the first jump_cross) or no primary saccade gets NaN.
+    """
+    result = np.zeros(len(labels), dtype=JUMP_DTYPE)
+    result['label'] = labels
+    result['time'] = marker_times
+    n = len(time_stamps)
+    if len(labels) == 0 or n < 2:
+        for field in ('size', 'latency', 'amplitude', 'gain', 'error'):
+            result[field] = np.nan
+        return result
+
+    time_stamps = np.asarray(time_stamps, dtype=np.float64)
+    positions = np.asarray(positions, dtype=np.float64)
+    valid = np.ones(n, dtype=bool) if confidence is None else np.asarray(confidence) >= min_confidence
+    target = np.array([JUMP_TARGETS[label[len('jump_'):]][0] for label in labels])
+    previous = np.concatenate(([target[0]], target[:-1]))
+    size = target - previous
+    result['size'] = size
+
+    # Marker -> the sample it lands on, and the sample where the next marker does
+    onset = np.searchsorted(time_stamps, marker_times)
+    following = np.append(onset[1:], n)
+    owner = np.searchsorted(onset, np.arange(n), side='right') - 1 # the marker each sample belongs to
+
+    # Horizontal position per eye, on the screen: x (N, 2)
+    x = positions[:, 0::2][:, :N_EYES].copy()
+    if calibrate:
+        since = time_stamps - np.asarray(marker_times)[np.maximum(owner, 0)]
+        still = valid & (owner >= 0) & (since >= settle)
+        if np.count_nonzero(still) >= 10:
+            for eye in range(N_EYES):
+                xy = positions[:, 2 * eye:2 * eye + 2]
+                x[:, eye] = np.column_stack((xy, np.ones(n))) @ affine_calibration(xy[still], target[owner[still]][:, None])[:, 0]
+
+    # Saccades of both eyes in one pass: eye-major, with a gap between the eyes so no run joins them
+    speed = np.abs(np.gradient(x, axis=0)) * sample_rate
+    speed[~valid] = 0
+    high, low = adaptive_thresholds(speed[valid].ravel())
+    stride = n + 1
+    flat_speed = np.concatenate((speed.T, np.zeros((N_EYES, 1))), axis=1).ravel()
+    run_start, run_end = runs(flat_speed > low)
+    saccade = (run_max(flat_speed, run_start, run_end) > high) & ((run_end - run_start) >= 2)
+    run_start, run_end = run_start[saccade], run_end[saccade]
+    eye_of, start_sample, end_sample = run_start // stride, run_start % stride, run_end % stride
+    move = x[np.minimum(end_sample, n) - 1, eye_of] - x[start_sample, eye_of]
+
+    # Every (marker, eye): the saccades starting inside its latency window
+    lo_sample = np.minimum(onset + int(round(min_latency * sample_rate)), following)
+    hi_sample = np.minimum(onset + int(round(max_latency * sample_rate)), following)
+    eyes = np.arange(N_EYES)
+    lo = np.searchsorted(run_start, (eyes[None, :] * stride + lo_sample[:, None]).ravel())
+    hi = np.searchsorted(run_start, (eyes[None, :] * stride + hi_sample[:, None]).ravel())
+
+    # Expand to (window, candidate) pairs and keep the first candidate heading for the target
+    counts = hi - lo
+    pair_window = np.repeat(np.arange(len(lo)), counts)
+    pair_saccade = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    towards = move[pair_saccade] * size[pair_window // N_EYES] >= min_gain * size[pair_window // N_EYES] ** 2
+    towards &= size[pair_window // N_EYES] != 0
+    primary = np.full(len(lo), -1)
+    hits = pair_window[towards]
+    # Pairs are in window then saccade order, so the first hit of a window is its primary saccade
+    first_hit = np.unique(hits, return_index=True)
+    primary[first_hit[0]] = pair_saccade[towards][first_hit[1]]
+    primary = primary.reshape(len(labels), N_EYES)
+    found = primary >= 0
+    p = np.maximum(primary, 0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        latency = time_stamps[start_sample[p]] - np.asarray(marker_times)[:, None]
+        landing = x[np.minimum(end_sample[p], n) - 1, eyes[None, :]]
+        result['latency'] = np.where(found, latency, np.nan)
+        result['amplitude'] = np.where(found, np.abs(move[p]), np.nan)
+        result['gain'] = np.where(found, move[p] / size[:, None], np.nan)
+        result['error'] = np.where(found, landing - target[:, None], np.nan)
+
+    # Corrective saccades: onsets between the primary's end and corrective_window after it (before the next marker)
+    window_start = eyes[None, :] * stride + end_sample[p]
+    window_end = eyes[None, :] * stride + np.minimum(end_sample[p] + int(round(corrective_window * sample_rate)),
+                                                     following[:, None])
+    corrective = np.searchsorted(run_start, window_end) - np.searchsorted(run_start, window_start)
+    result['corrective_saccades'] = np.where(found, np.maximum(corrective, 0), 0)
+    return result
@@ -0,0 +1,60 @@
+# Copyright 2022
+# Author: scott.allan.stone@gmail.com (Scott Stone)
+import queue
+import threading
+from pylsl import local_clock
+
+class MarkerDispatcher:
+    """Sends markers on an LSL outlet from a background thread with explicit timestamps, so the render
+       loop never blocks on LSL.
+       on_flip(label) holds a marker until flipped() is called right after the flip that makes its stimulus
+       visible, and stamps it with that time; push(label) stamps it now. Markers go out in the order they
+       were stamped.
+    """
+    def __init__(self, outlet, clock=local_clock):
+        self.outlet = outlet
+        self.clock = clock
+        self.pending = [] # waiting for the next flip
+        self.sent = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._send, name='marker-dispatch', daemon=True)
+        self._thread.start()
+
+    def _send(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            label, time_stamp = item
+            self.outlet.push_sample([label], time_stamp)
+            self.sent += 1
+
+    def on_flip(self, label: str) -> None:
+        """Send the marker with the time of the next flip
+        """
+        self.pending.append(label)
+
+    def push(self, label: str) -> None:
+        """Send the marker with the current time (anything still waiting for a flip goes first)
+        """
+        self.flipped()
+        self._queue.put((label, self.clock()))
+
+    def flipped(self, time_stamp: float = None) -> float:
+        """Call right after pygame.display.flip(): stamps the pending markers with the flip time
+        """
+        if not self.pending:
+            return time_stamp
+        if time_stamp is None:
+            time_stamp = self.clock()
+        for label in self.pending:
+            self._queue.put((label, time_stamp))
+        self.pending = []
+        return time_stamp
+
+    def close(self, timeout: float = 5.0) -> None:
+        """Send everything still queued and stop the thread
+        """
+        self.flipped()
+        self._queue.put(None)
+        self._thread.join(timeout)
@@ -0,0 +1,114 @@
+# Copyright 2022
+# Author: scott.allan.stone@gmail.com (Scott Stone)
+import numpy as np
+
+# Sub-phase markers pushed by run_stimulus.py
+PURSUIT_DIRECTIONS = ('left', 'right_centre', 'right', 'left_centre',
+                      'left_hold', 'right_centre', 'right_hold', 'left_centre',
+                      'top', 'bottom_centre', 'bottom', 'top_centre',
+                      'top_hold', 'bottom_centre', 'bottom_hold', 'top_centre')
+JUMP_MARKERS = ('jump_left', 'jump_right', 'jump_cross')
+BRIGHTNESS_MARKER = 'brightness_high'
+REDO_POLICIES = ('latest', 'first')
+
+class MarkerIndex:
+    """Lookup table from marker label to every position (and timestamp) it occurs at.
+       Built in a single pass over the marker stream, so repeated markers (e.g. a redone trial)
+       are all kept rather than collapsing onto the first occurrence.
+    """
+    def __init__(self, labels: list, time_stamps: np.ndarray):
+        self.time_stamps = np.asarray(time_stamps, dtype=np.float64)
+        self.labels = [label[0] if isinstance(label, (list, tuple)) else label for label in labels]
+
+        positions = {}
+        for pos, label in enumerate(self.labels):
+            positions.setdefault(label, []).append(pos)
+
+        self.positions = {label: np.array(pos, dtype=np.int64) for label, pos in positions.items()}
+
+    def __contains__(self, label: str) -> bool:
+        return label in self.positions
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def find(self, label: str) -> np.ndarray:
+        """Sorted positions of every occurrence of the label (empty if it never occurs)
+        """
+        return self.positions.get(label, np.empty(0, dtype=np.int64))
+
+    def timestamps(self, label: str) -> np.ndarray:
+        """Timestamps of every occurrence of the label
+        """
+        return self.time_stamps[self.find(label)]
+
+    def events(self, labels: tuple = JUMP_MARKERS) -> tuple:
+        """Merge several point markers into one time ordered sequence.
+           Returns (positions, labels) where labels is an array of the marker names.
+        """
+        pos = np.concatenate([self.find(label) for label in labels])
+        pos.sort()
+        return pos, np.array([self.labels[p] for p in pos], dtype=str)
+
+    def pairs(self, start: str, end: str, redo: str = 'latest') -> tuple:
+        """Pair every end marker with a start marker that precedes it.
+           redo='latest' pairs each end with the closest start before it (a redone trial wins),
+           redo='first' pairs it with the first start after the previous end.
+           Returns (start_positions, end_positions); ends without any start are dropped.
+        """
+        if redo not in REDO_POLICIES:
+            raise ValueError(f"redo must be one of {REDO_POLICIES}, not {redo!r}")
+
+        starts, ends = self.find(start), self.find(end)
+        if len(starts) == 0 or len(ends) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        if redo == 'latest':
+            idx = np.searchsorted(starts, ends) - 1
+        else:
+            previous_end = np.concatenate(([-1], ends[:-1]))
+            idx = np.searchsorted(starts, previous_end, side='right')
+
+        valid = (idx >= 0) & (idx < len(starts))
+        idx, ends = idx[valid], ends[valid]
+        valid = starts[idx] < ends
+        return starts[idx[valid]], ends[valid]
+
+    def phase_bounds(self, phases: list, redo: str = 'latest') -> tuple:
+        """Find the start/end positions of each phase (marker `phase` to `phase_end`).
+           If a phase was run more than once, the redo policy decides which run is used.
+           Returns (phases_found, start_positions, end_positions) in the order of `phases`.
+        """
+        found, starts, ends = [], [], []
+        for phase in phases:
+            s, e = self.pairs(phase, phase + '_end', redo=redo)
+            if len(e) == 0:
+                continue
+            # Several complete runs of one phase: the latest / first complete one wins
+            pick = -1 if redo == 'latest' else 0
+            found.append(phase)
+            starts.append(s[pick])
+            ends.append(e[pick])
+
+        return found, np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64)
+
+    def sub_phase_bounds(self, prefix: str = 'pursuit', names: tuple = None, redo: str = 'latest') -> tuple:
+        """Find every `<prefix>_<name>_start` / `<prefix>_<name>_end` pair, e.g. the pursuit directions.
+           Returns (names, start_positions, end_positions) sorted by start position.
+        """
+        if names is None:
+            names = tuple(dict.fromkeys(PURSUIT_DIRECTIONS))
+
+        found, starts, ends = [], [], []
+        for name in names:
+            s, e = self.pairs(f"{prefix}_{name}_start", f"{prefix}_{name}_end", redo=redo)
+            found.extend([name] * len(s))
+            starts.append(s)
+            ends.append(e)
+
+        if len(found) == 0:
+            return np.empty(0, dtype=str), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        starts, ends = np.concatenate(starts), np.concatenate(ends)
+        order = np.argsort(starts, kind='stable')
+        return np.array(found, dtype=str)[order], starts[order], ends[order]
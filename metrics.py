@@ -0,0 +1,46 @@
+# Copyright 2022
+# Author: scott.allan.stone@gmail.com (Scott Stone)
+import numpy as np
+
+# Gaze columns are laid out as (x_0, y_0, x_1, y_1), one (x, y) pair per eye
+N_EYES = 2
+METRIC_NAMES = ('n_samples', 'duration', 'path_length', 'mean_velocity', 'peak_velocity',
+                'mean_x', 'mean_y', 'dispersion_x', 'dispersion_y')
+
+def eye_steps(gaze: np.ndarray) -> np.ndarray:
+    """Euclidean distance travelled between consecutive samples, per eye.
+       Takes an (N, 4) gaze array and returns an (N - 1, 2) array.
+    """
+    diff = np.diff(gaze[:, :2 * N_EYES], axis=0).reshape(-1, N_EYES, 2)
+    return np.hypot(diff[..., 0], diff[..., 1])
+
+def phase_metrics(gaze: np.ndarray, sample_rate: float) -> dict:
+    """Compute the summary statistics of one phase of gaze data for both eyes at once.
+       Every entry of the returned dict is a length 2 array (eye 0, eye 1).
+    """
+    gaze = np.asarray(gaze, dtype=np.float64)[:, :2 * N_EYES]
+    n = len(gaze)
+    metrics = {'n_samples': np.full(N_EYES, n),
+               'duration': np.full(N_EYES, n / sample_rate)}
+
+    if n < 2:
+        for name in METRIC_NAMES[2:]:
+            metrics[name] = np.full(N_EYES, np.nan)
+        return metrics
+
+    steps = eye_steps(gaze)
+    speed = steps * sample_rate
+    mean = gaze.mean(axis=0).reshape(N_EYES, 2)
+    std = gaze.std(axis=0).reshape(N_EYES, 2)
+
+    metrics['path_length'] = steps.sum(axis=0)
+    metrics['mean_velocity'] = speed.mean(axis=0)
+    metrics['peak_velocity'] = speed.max(axis=0)
+    metrics['mean_x'], metrics['mean_y'] = mean[:, 0], mean[:, 1]
+    metrics['dispersion_x'], metrics['dispersion_y'] = std[:, 0], std[:, 1]
+    return metrics
+
+def metrics_by_phase(gaze_data: list, phases: list, sample_rate: float) -> dict:
+    """Compute phase_metrics for every phase, keyed by phase name
+    """
+    return {phase: phase_metrics(gaze, sample_rate) for gaze, phase in zip(gaze_data, phases)}
@@ -0,0 +1,181 @@
+# Copyright 2022
+# Author: scott.allan.stone@gmail.com (Scott Stone)
+import threading
+import numpy as np
+import pylsl
+from session import PUPIL_CAPTURE_CHANNELS, resolve_columns
+from preprocess import gaze_pipeline
+
+MONITOR_CHANNELS = ('confidence', 'norm_pos_x', 'norm_pos_y')
+LSL_DTYPES = {pylsl.cf_float32: np.float32, pylsl.cf_double64: np.float64, pylsl.cf_int8: np.int8,
+              pylsl.cf_int16: np.int16, pylsl.cf_int32: np.int32, pylsl.cf_int64: np.int64}
+# Quality limits: the window is bad if any is crossed
+MIN_CONFIDENCE = 0.6 # per sample, below it the sample counts as a dropout
+MAX_DROPOUT = 0.2    # fraction of the window
+MIN_RATE = 0.8       # samples received / samples expected at the nominal rate
+MAX_LATENCY = 0.5    # seconds since the newest sample
+POOR_TRIAL = 0.25    # fraction of bad updates that makes a whole trial poor
+
+def channel_labels(info: pylsl.StreamInfo) -> tuple:
+    """Channel labels from an LSL stream's description (empty if it doesn't have them)
+    """
+    labels = []
+    channel = info.desc().child('channels').child('channel')
+    while not channel.empty():
+        labels.append(channel.child_value('label'))
+        channel = channel.next_sibling()
+    return tuple(labels)
+
+class GazeMonitor:
+    """Live gaze quality from the LSL Gaze stream while recording.
+       Chunks are pulled into a preallocated ring buffer and the rolling sums behind the window statistics
+       (confidence, speed, dispersion, dropouts) are updated with only the samples entering and leaving the
+       window, so an update costs the same however long the session is. start() does this on a background
+       thread every `interval` seconds; `quality` always holds the latest result.
+       With preprocess (options for preprocess.gaze_pipeline, {} for the defaults) every chunk also goes
+       through the same pipeline the Analyzer uses, and `latest` holds its newest sample (time, x, y,
+       x velocity, y velocity), a window // 2 behind the raw stream.
+    """
+    def __init__(self, inlet: pylsl.StreamInlet, window: float = 2.0, channels: tuple = MONITOR_CHANNELS,
+                 interval: float = 0.05, resync: int = 1000, preprocess: dict = None):
+        info = inlet.info()
+        self.inlet = inlet
+        self.sample_rate = info.nominal_srate() or 200.0
+        self.columns = resolve_columns(channels, channel_labels(info) or PUPIL_CAPTURE_CHANNELS)
+        self.window = max(2, int(window * self.sample_rate))
+        self.interval = interval
+        self.resync = resync # recompute the sums from scratch every this many updates, so rounding can't build up
+
+        capacity = 2 * self.window
+        self._chunk = np.empty((self.window, info.channel_count()), dtype=LSL_DTYPES.get(info.channel_format(), np.float32))
+        self.time_stamps = np.zeros(capacity)
+        self.values = np.zeros((capacity, 5)) # confidence, x, y, speed, valid
+        self.count = 0 # samples seen
+        self.updates = 0
+        self._sums = np.zeros(8) # confidence, valid, x, y, x^2, y^2, speed, valid speeds
+        self.pipeline = None if preprocess is None else gaze_pipeline(self.sample_rate, **preprocess)
+        self.latest = None
+        self.quality = None
+        self.trial_updates = 0
+        self.trial_bad = 0
+        self._thread = None
+        self._stop = threading.Event()
+
+    @classmethod
+    def connect(cls, stream_type: str = 'Gaze', timeout: float = 5.0, **kwargs):
+        """Monitor the first stream of this type on the network, or None if there isn't one
+        """
+        streams = pylsl.resolve_byprop('type', stream_type, timeout=timeout)
+        if len(streams) == 0:
+            return None
+        return cls(pylsl.StreamInlet(streams[0], max_buflen=10), **kwargs)
+
+    def _rows(self, first: int, last: int) -> np.ndarray:
+        """Ring buffer rows of samples first..last-1 (last - first <= capacity)
+        """
+        return np.arange(first, last) % len(self.time_stamps)
+
+    def _window_sums(self, rows: np.ndarray) -> np.ndarray:
+        confidence, x, y, speed, valid = self.values[rows].T
+        moving = speed >= 0
+        return np.array([confidence.sum(), valid.sum(), (x * valid).sum(), (y * valid).sum(),
+                         (x * x * valid).sum(), (y * y * valid).sum(), speed[moving].sum(), moving.sum()])
+
+    def _add(self, time_stamps: np.ndarray, chunk: np.ndarray) -> None:
+        n = len(time_stamps)
+        confidence = chunk[:, self.columns[0]].astype(np.float64)
+        x = chunk[:, self.columns[1]].astype(np.float64)
+        y = chunk[:, self.columns[2]].astype(np.float64)
+        valid = confidence >= MIN_CONFIDENCE
+        if self.pipeline is not None:
+            done_time_stamps, done = self.pipeline.push(time_stamps, np.stack((x, y, confidence), axis=1))
+            if len(done_time_stamps):
+                self.latest = np.concatenate(([done_time_stamps[-1]], done[-1]))
+
+        # Speed from the sample before, -1 where either sample is a dropout
+        if self.count > 0:
+            previous = self.values[(self.count - 1) % len(self.time_stamps)]
+            px, py, pvalid = np.append(previous[1], x[:-1]), np.append(previous[2], y[:-1]), \
+                np.append(previous[4] > 0, valid[:-1])
+            pt = np.append(self.time_stamps[(self.count - 1) % len(self.time_stamps)], time_stamps[:-1])
+        else:
+            px, py, pvalid, pt = np.append(x[0], x[:-1]), np.append(y[0], y[:-1]), np.append(False, valid[:-1]), \
+                np.append(time_stamps[0], time_stamps[:-1])
+        dt = np.maximum(time_stamps - pt, 1 / self.sample_rate / 10)
+        speed = np.where(valid & pvalid, np.hypot(x - px, y - py) / dt, -1.0)
+
+        leaving = self._rows(max(0, self.count - self.window), max(0, self.count + n - self.window))
+        if len(leaving):
+            self._sums -= self._window_sums(leaving)
+        rows = self._rows(self.count, self.count + n)
+        self.time_stamps[rows] = time_stamps
+        self.values[rows] = np.stack((confidence, x, y, speed, valid), axis=1)
+        self._sums += self._window_sums(rows)
+        self.count += n
+
+    def update(self) -> dict:
+        """Pull whatever has arrived and recompute the window's quality
+        """
+        while True:
+            _, time_stamps = self.inlet.pull_chunk(timeout=0.0, max_samples=self.window, dest_obj=self._chunk)
+            if len(time_stamps) == 0:
+                break
+            self._add(np.asarray(time_stamps), self._chunk[:len(time_stamps)])
+            if len(time_stamps) < self.window:
+                break
+
+        self.updates += 1
+        in_window = min(self.count, self.window)
+        if self.updates % self.resync == 0 and in_window:
+            self._sums = self._window_sums(self._rows(self.count - in_window, self.count))
+        self.quality = self._quality(in_window)
+        self.trial_updates += 1
+        self.trial_bad += not self.quality['ok']
+        return self.quality
+
+    def _quality(self, n: int) -> dict:
+        if n == 0:
+            return {'samples': 0, 'ok': False, 'latency': None}
+        confidence, n_valid, sx, sy, sxx, syy, speed, n_speed = self._sums
+        rows = self._rows(self.count - n, self.count)
+        span = self.time_stamps[rows[-1]] - self.time_stamps[rows[0]]
+        quality = {'samples': n,
+                   'confidence': confidence / n,
+                   'dropout': 1 - n_valid / n,
+                   'velocity': speed / n_speed if n_speed else None,
+                   'dispersion_x': np.sqrt(max(0.0, sxx / n_valid - (sx / n_valid) ** 2)) if n_valid else None,
+                   'dispersion_y': np.sqrt(max(0.0, syy / n_valid - (sy / n_valid) ** 2)) if n_valid else None,
+                   'rate': (n - 1) / (span * self.sample_rate) if span > 0 else None,
+                   'latency': pylsl.local_clock() - self.time_stamps[rows[-1]],
+                   'smoothed_speed': None if self.latest is None else np.hypot(self.latest[3], self.latest[4])}
+        quality = {key: None if value is None else float(value) for key, value in quality.items()}
+        quality['samples'] = n
+        quality['ok'] = bool(quality['dropout'] <= MAX_DROPOUT and quality['latency'] <= MAX_LATENCY
+                             and (quality['rate'] is None or quality['rate'] >= MIN_RATE))
+        return quality
+
+    def reset_trial(self) -> None:
+        """Start counting bad updates for a new trial
+        """
+        self.trial_updates = 0
+        self.trial_bad = 0
+
+    def poor_trial(self) -> bool:
+        """True if enough of the trial's updates were bad that it is worth redoing
+        """
+        return self.trial_updates > 0 and self.trial_bad / self.trial_updates > POOR_TRIAL
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self.update()
+            self._stop.wait(self.interval)
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='gaze-monitor', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
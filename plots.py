@@ -0,0 +1,93 @@
+# Copyright 2022
+# Author: scott.allan.stone@gmail.com (Scott Stone)
+import os
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.patches import Ellipse
+import numpy as np
+
+class Renderer:
+    """Draws the analysis figures with the object-oriented Agg API.
+       One figure is reused for every image and cleared in between, and close() (or leaving the
+       `with` block) releases it, so nothing accumulates in pyplot's global figure list.
+    """
+    def __init__(self, dpi: int = 300, figsize: tuple = (6.4, 4.8)):
+        self.dpi = dpi
+        self.figure = Figure(figsize=figsize)
+        FigureCanvasAgg(self.figure)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self.figure is not None:
+            self.figure.clear()
+            self.figure = None
+
+    def _axes(self, title: str):
+        self.figure.clear()
+        ax = self.figure.add_subplot()
+        ax.set_title(title)
+        return ax
+
+    def _save(self, path: str) -> None:
+        self.figure.savefig(path, dpi=self.dpi)
+        self.figure.clear()
+
+    def gaze(self, gaze: np.ndarray, phase: str, path: str) -> None:
+        ax = self._axes(phase)
+        ax.plot(gaze[:, 0], gaze[:, 1], label=phase, marker='.', color='r')
+        ax.plot(gaze[:, 2], gaze[:, 3], label=phase, marker='.', color='b')
+        self._save(path)
+
+    def velocity(self, velocity: np.ndarray, phase: str, path: str) -> None:
+        ax = self._axes(f"Velocity of {phase} data")
+        ax.plot(velocity)
+        self._save(path)
+
+    def dispersion(self, gaze: np.ndarray, mean_gaze: np.ndarray, dispersion_x: float, dispersion_y: float,
+                   phase: str, path: str) -> None:
+        ax = self._axes(f"Dispersion of {phase} data")
+        ax.plot(gaze[:, 0], gaze[:, 1], 'r')
+        ax.plot(gaze[:, 2], gaze[:, 3], 'b')
+        ax.plot(mean_gaze[0], mean_gaze[1], '.k')
+        ax.plot(mean_gaze[2], mean_gaze[3], '.k') # other eye
+        ax.add_patch(Ellipse(mean_gaze[:2], dispersion_x, dispersion_y, fill=False, color='r'))
+        self._save(path)
+
+    def frequency(self, frequencies: np.ndarray, power_x: np.ndarray, power_y: np.ndarray,
+                  phase: str, path: str) -> None:
+        ax = self._axes(f'Frequency decomposition of {phase} data')
+        ax.plot(frequencies, power_x)
+        ax.plot(frequencies, power_y)
+        ax.legend(['x', 'y'])
+        ax.set_ylabel('Power')
+        ax.set_xlabel('Frequency (Hz)')
+        self._save(path)
+
+    def render(self, analyzer) -> list:
+        """Draw every figure for whatever the analyzer has calculated. Returns the files written.
+        """
+        stem = os.path.splitext(analyzer.file.rstrip('/'))[0] # .xdf files and .chunks/ recordings alike
+        written = []
+        for gaze, phase in zip(analyzer.gaze_data, analyzer.phases):
+            written.append(f'{stem}_{phase}.png')
+            self.gaze(gaze, phase, written[-1])
+
+        for velocity, phase in zip(getattr(analyzer, 'velocity', []), analyzer.phases):
+            written.append(f'{stem}_{phase}_velocity.png')
+            self.velocity(velocity, phase, written[-1])
+
+        for phase, (mean_gaze, dispersion_x, dispersion_y) in analyzer.dispersions.items():
+            written.append(f'{stem}_{phase}_dispersion.png')
+            gaze = analyzer.gaze_data[analyzer.phases.index(phase)]
+            self.dispersion(gaze, mean_gaze, dispersion_x, dispersion_y, phase, written[-1])
+
+        for phase, spectrum in getattr(analyzer, 'spectra', {}).items():
+            written.append(f'{stem}_{phase}_frequency.png')
+            self.frequency(*spectrum, phase, written[-1])
+
+        return written
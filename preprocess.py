@@ -0,0 +1,296 @@
+# Copyright 2022
+# Author: scott.allan.stone@gmail.com (Scott Stone)
+import argparse
+from math import factorial
+import numpy as np
+
+class ConfidenceMask:
+    """Blank (NaN) every sample whose confidence is below min_confidence, and drop the confidence column
+       (`column`, the last one by default) from the values
+    """
+    def __init__(self, min_confidence: float = 0.6, column: int = -1):
+        self.min_confidence = min_confidence
+        self.column = column
+        self._columns = 0
+
+    def push(self, time_stamps: np.ndarray, values: np.ndarray) -> tuple:
+        values = np.asarray(values, dtype=np.float64)
+        column = self.column % values.shape[1]
+        out = np.delete(values, column, axis=1)
+        out[values[:, column] < self.min_confidence] = np.nan
+        self._columns = out.shape[1]
+        return time_stamps, out
+
+    def flush(self) -> tuple:
+        return np.empty(0), np.empty((0, self._columns))
+
+class GapFill:
+    """Bridge NaN runs (blinks, dropouts) linearly between the valid samples either side, per column, when
+       they span at most max_gap seconds. Longer gaps hold the last valid value (hold=True) or stay NaN,
+       and so do gaps at the end of the data; gaps at the start always stay NaN.
+       Samples are held back while a gap is open and could still be bridged, so at most max_gap seconds
+       (plus the chunk) are ever buffered.
+    """
+    def __init__(self, max_gap: float = 0.3, hold: bool = True):
+        self.max_gap = max_gap
+        self.hold = hold
+        self.reset()
+
+    def reset(self) -> None:
+        self._time_stamps = np.empty(0)
+        self._values = None
+        self._last_time = None  # per column, the last valid sample already passed on (NaN: none yet)
+        self._last_value = None
+
+    def _fill(self, final: bool) -> tuple:
+        """Fill what can be decided, returns (filled rows, how many of them are done)
+        """
+        t, values = self._time_stamps, self._values
+        out = values.copy()
+        ready = len(t)
+        for column in range(values.shape[1]):
+            bad = np.flatnonzero(np.isnan(values[:, column]))
+            if len(bad) == 0:
+                continue
+            good = np.flatnonzero(~np.isnan(values[:, column]))
+            # Anchors: the last valid sample before this buffer, then the valid ones in it
+            anchor_time = np.concatenate(([self._last_time[column]], t[good]))
+            anchor_value = np.concatenate(([self._last_value[column]], values[good, column]))
+            right = np.searchsorted(good, bad) + 1
+            left = right - 1
+            has_left = ~np.isnan(anchor_time[left])
+            has_right = right < len(anchor_time)
+            right = np.minimum(right, len(anchor_time) - 1)
+
+            gap = anchor_time[right] - anchor_time[left]
+            bridge = has_left & has_right & (gap <= self.max_gap)
+            # An open gap is decided once it is already longer than max_gap (or the data ends)
+            open_gap = has_left & ~has_right & ~final & (t[-1] - anchor_time[left] <= self.max_gap)
+            if np.any(open_gap):
+                ready = min(ready, bad[np.argmax(open_gap)])
+
+            with np.errstate(invalid='ignore', divide='ignore'):
+                fraction = (t[bad] - anchor_time[left]) / gap
+                line = anchor_value[left] + (anchor_value[right] - anchor_value[left]) * fraction
+            held = anchor_value[left] if self.hold else np.full(len(bad), np.nan)
+            out[bad, column] = np.where(bridge, line, np.where(has_left, held, np.nan))
+        return out, ready
+
+    def push(self, time_stamps: np.ndarray, values: np.ndarray, final: bool = False) -> tuple:
+        values = np.asarray(values, dtype=np.float64)
+        if self._values is None:
+            self._values = np.empty((0, values.shape[1]))
+            self._last_time = np.full(values.shape[1], np.nan)
+            self._last_value = np.full(values.shape[1], np.nan)
+        self._time_stamps = np.concatenate((self._time_stamps, time_stamps))
+        self._values = np.concatenate((self._values, values))
+        if len(self._time_stamps) == 0:
+            return self._time_stamps, self._values
+
+        out, ready = self._fill(final)
+        for column in range(self._values.shape[1]):
+            good = np.flatnonzero(~np.isnan(self._values[:ready, column]))
+            if len(good):
+                self._last_time[column] = self._time_stamps[good[-1]]
+                self._last_value[column] = self._values[good[-1], column]
+        done = self._time_stamps[:ready], out[:ready]
+        self._time_stamps, self._values = self._time_stamps[ready:], self._values[ready:]
+        return done
+
+    def flush(self) -> tuple:
+        if self._values is None:
+            return np.empty(0), np.empty((0, 0))
+        done = self.push(np.empty(0), np.empty((0, self._values.shape[1])), final=True)
+        self.reset()
+        return done
+
+def savgol_weights(length: int, order: int, deriv: int = 0, delta: float = 1.0) -> np.ndarray:
+    """(length, length) weights of a least squares polynomial fit over `length` samples: row i applied
+       to the samples gives the deriv-th derivative of the fit at sample i
+    """
+    z = np.arange(length) - (length - 1) / 2
+    fit = np.linalg.pinv(z[:, None] ** np.arange(order + 1)) # samples -> polynomial coefficients
+    powers = np.arange(order + 1) - deriv
+    scale = np.array([factorial(p + deriv) / factorial(p) if p >= 0 else 0.0 for p in powers])
+    evaluate = np.where(powers >= 0, z[:, None] ** np.maximum(powers, 0), 0) * scale
+    return evaluate @ fit / delta ** deriv
+
+def _apply(weights: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """weights (R, W) @ rows (W, C), summed in a fixed order so the result doesn't depend on the shapes
+    """
+    out = np.zeros((len(weights), rows.shape[1]))
+    for k in range(weights.shape[1]):
+        out += weights[:, k, None] * rows[k]
+    return out
+
+class SavitzkyGolay:
+    """Savitzky-Golay smoothing and differentiation over `window` samples (odd), for every column and every
+       derivative in `derivs`; the output is the columns of derivs[0], then of derivs[1], ...
+       (per second, at sample_rate). The first and last window // 2 samples come from the polynomial
+       fitted to the first / last whole window, and data shorter than a window gets one fit over all of it.
+       Every sample waits for the window // 2 after it, and only the last window is kept.
+    """
+    def __init__(self, window: int = 11, order: int = 2, derivs: tuple = (0, 1), sample_rate: float = 1.0):
+        if window < 3 or window % 2 == 0 or order >= window:
+            raise ValueError(f"window must be odd, at least 3 and above the order, not {window} (order {order})")
+        self.window = window
+        self.order = order
+        self.derivs = tuple(derivs)
+        self.delta = 1 / sample_rate
+        self.half = window // 2
+        self.weights = [savgol_weights(window, order, deriv, self.delta) for deriv in self.derivs]
+        self.reset()
+
+    def reset(self) -> None:
+        self._time_stamps = np.empty(0)
+        self._values = None # the last `window` samples
+        self.received = 0
+        self.emitted = 0
+
+    def push(self, time_stamps: np.ndarray, values: np.ndarray) -> tuple:
+        values = np.asarray(values, dtype=np.float64)
+        if self._values is None:
+            self._values = np.empty((0, values.shape[1]))
+        t = np.concatenate((self._time_stamps, time_stamps))
+        buffer = np.concatenate((self._values, values))
+        first = self.received - len(self._values) # sample number of buffer[0]
+        self.received += len(values)
+
+        out_t, out = [], []
+        if self.emitted == 0 and self.received >= self.window:
+            # The start: the first window's fit
+            out_t.append(t[:self.half])
+            out.append(np.concatenate([_apply(w[:self.half], buffer[:self.window]) for w in self.weights], axis=1))
+            self.emitted = self.half
+        if self.emitted > 0:
+            end = self.received - self.half # samples before this have their whole window
+            n = max(0, end - self.emitted)
+            start = self.emitted - self.half - first
+            parts = []
+            for weights in self.weights:
+                centre = weights[self.half]
+                part = np.zeros((n, buffer.shape[1]))
+                for k in range(self.window):
+                    part += centre[k] * buffer[start + k:start + k + n]
+                parts.append(part)
+            out_t.append(t[self.emitted - first:self.emitted - first + n])
+            out.append(np.concatenate(parts, axis=1))
+            self.emitted += n
+
+        self._time_stamps, self._values = t[-self.window:], buffer[-self.window:]
+        if not out:
+            return np.empty(0), np.empty((0, buffer.shape[1] * len(self.derivs)))
+        return np.concatenate(out_t), np.concatenate(out)
+
+    def flush(self) -> tuple:
+        if self._values is None or self.received == 0:
+            columns = 0 if self._values is None else self._values.shape[1] * len(self.derivs)
+            self.reset()
+            return np.empty(0), np.empty((0, columns))
+        if self.emitted == 0:
+            # Never filled a window: one fit over everything
+            n = self.received
+            weights = [savgol_weights(n, min(self.order, n - 1), deriv, self.delta) for deriv in self.derivs]
+            done = self._time_stamps, np.concatenate([_apply(w, self._values) for w in weights], axis=1)
+        else:
+            rest = self.received - self.emitted
+            done = self._time_stamps[-rest:], \
+                np.concatenate([_apply(w[self.window - rest:], self._values) for w in self.weights], axis=1)
+        self.reset()
+        return done
+
+class Pipeline:
+    """Preprocessing stages run one after the other on chunks of (time_stamps, values (N, C)).
+       Every stage keeps just enough state to carry on where the last chunk ended, holding samples back
+       until they can be finished, so pushing the data in any chunks and then flushing gives exactly
+       what one push of all of it does. Every sample comes out once, in order, with its timestamp.
+    """
+    def __init__(self, *stages):
+        self.stages = stages
+
+    def push(self, time_stamps: np.ndarray, values: np.ndarray) -> tuple:
+        """Feed a chunk in, returns the samples that are finished (possibly none)
+        """
+        for stage in self.stages:
+            time_stamps, values = stage.push(np.asarray(time_stamps, dtype=np.float64), values)
+        return time_stamps, values
+
+    def flush(self) -> tuple:
+        """End of the data: finish every held-back sample and reset for the next stream
+        """
+        time_stamps = values = None
+        for stage in self.stages:
+            parts = []
+            if time_stamps is not None and len(time_stamps):
+                parts.append(stage.push(time_stamps, values))
+            parts.append(stage.flush())
+            time_stamps = np.concatenate([t for t, _ in parts])
+            values = np.concatenate([v for _, v in parts])
+        return time_stamps, values
+
+    def run(self, time_stamps: np.ndarray, values: np.ndarray, chunk_samples: int = 1 << 16,
+            out: np.ndarray = None, columns: list = None) -> np.ndarray:
+        """Whole recording, chunk_samples at a time (only `columns` of values, picked chunk by chunk):
+           the output (N, C out) is written into `out` if given (e.g. a np.lib.format.open_memmap), so with
+           memory-mapped input only one chunk and the stage state are in memory. Every stage keeps the
+           sample count, so row i of the output is sample i.
+        """
+        n, written = len(time_stamps), 0
+
+        def write(done):
+            nonlocal out, written
+            if len(done[0]) == 0:
+                return
+            if out is None:
+                out = np.empty((n, done[1].shape[1]))
+            out[written:written + len(done[0])] = done[1]
+            written += len(done[0])
+
+        for first in range(0, n, chunk_samples):
+            chunk = values[first:first + chunk_samples]
+            write(self.push(time_stamps[first:first + chunk_samples], chunk if columns is None else chunk[:, columns]))
+        write(self.flush())
+        return out
+
+def gaze_pipeline(sample_rate: float,
+                  min_confidence: float = 0.6,
+                  max_gap: float = 0.3,
+                  window: float = 0.05,
+                  order: int = 2,
+                  derivs: tuple = (0, 1)) -> Pipeline:
+    """The usual preprocessing for gaze columns followed by a confidence column: mask low confidence,
+       bridge gaps up to max_gap seconds, then Savitzky-Golay over `window` seconds (rounded to an odd
+       number of samples). Gives the smoothed columns, then their velocity per second.
+    """
+    samples = max(order + 1, int(round(window * sample_rate))) | 1
+    return Pipeline(ConfidenceMask(min_confidence),
+                    GapFill(max_gap),
+                    SavitzkyGolay(max(3, samples), order, derivs, sample_rate))
+
+def main():
+    from chunk_recorder import read_stream
+    from monitor import MONITOR_CHANNELS
+    from session import resolve_columns, PUPIL_CAPTURE_CHANNELS
+
+    parser = argparse.ArgumentParser(description="Preprocess the gaze of a chunked recording (a .chunks directory) "
+                                                 "into a .npy file, a block at a time")
+    parser.add_argument('directory')
+    parser.add_argument('--gaze-name', default='pupil_capture')
+    parser.add_argument('--out', default=None, help="where to write (default: <gaze name>_preprocessed.npy in it)")
+    parser.add_argument('--chunk', type=int, default=1 << 16, help="samples per block")
+    args = parser.parse_args()
+
+    meta, records = read_stream(args.directory, args.gaze_name)
+    # x, y, then the confidence the pipeline masks with
+    columns = list(resolve_columns(MONITOR_CHANNELS[1:] + MONITOR_CHANNELS[:1],
+                                   tuple(meta['channel_labels'] or PUPIL_CAPTURE_CHANNELS)))
+    span = records['time'][-1] - records['time'][0] if len(records) > 1 else 0
+    sample_rate = meta['nominal_srate'] or ((len(records) - 1) / span if span > 0 else 200.0)
+    out = args.out or f"{args.directory.rstrip('/')}/{args.gaze_name}_preprocessed.npy"
+    result = np.lib.format.open_memmap(out, mode='w+', dtype=np.float64, shape=(len(records), 4))
+    gaze_pipeline(sample_rate).run(records['time'], records['value'], args.chunk, out=result, columns=columns)
+    result.flush()
+    print(f"Wrote {out}: x, y, x velocity, y velocity of {len(records)} samples at {sample_rate:.1f}Hz")
+
+if __name__ == '__main__':
+    main()
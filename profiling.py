@@ -0,0 +1,127 @@
+# Copyright 2022
+# Author: scott.allan.stone@gmail.com (Scott Stone)
+import functools
+import json
+import time
+import tracemalloc
+from contextlib import nullcontext
+
+_DISABLED = nullcontext() # shared, so a disabled profiler allocates nothing per stage
+
+class _Stage:
+    """Context manager timing one stage of a Profiler. Time spent in stages nested inside it is
+       subtracted from its self time, so summing self times never counts anything twice.
+    """
+    __slots__ = ('profiler', 'name', 'wall', 'cpu', 'child_wall', 'child_cpu', 'start_bytes', 'max_bytes')
+
+    def __init__(self, profiler, name: str):
+        self.profiler = profiler
+        self.name = name
+        self.child_wall = self.child_cpu = 0.0
+
+    def __enter__(self):
+        stack = self.profiler._stack
+        if self.profiler.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                # Remember the enclosing stage's peak before resetting it for this one
+                stack[-1].max_bytes = max(stack[-1].max_bytes, peak)
+            self.start_bytes = self.max_bytes = current
+            tracemalloc.reset_peak()
+        stack.append(self)
+        self.cpu = time.process_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        stack = self.profiler._stack
+        stack.pop()
+        if stack:
+            stack[-1].child_wall += wall
+            stack[-1].child_cpu += cpu
+        peak = 0
+        if self.profiler.memory:
+            absolute = max(self.max_bytes, tracemalloc.get_traced_memory()[1])
+            peak = absolute - self.start_bytes
+            if stack:
+                stack[-1].max_bytes = max(stack[-1].max_bytes, absolute)
+        self.profiler._record(self.name, wall, cpu, wall - self.child_wall, cpu - self.child_cpu, peak)
+
+class Profiler:
+    """Records wall time, CPU time and (with memory=True) peak traced allocation of named stages.
+       When disabled, stage() returns a shared no-op context manager, so instrumented code costs
+       next to nothing. memory=True starts tracemalloc, which slows every allocation in the process
+       until stop() is called.
+    """
+    def __init__(self, enabled: bool = True, memory: bool = False):
+        self.enabled = enabled
+        self.memory = enabled and memory
+        self.stages = {}
+        self._stack = []
+        self._started_tracing = self.memory and not tracemalloc.is_tracing()
+        if self._started_tracing:
+            tracemalloc.start()
+
+    def stop(self) -> None:
+        """Stop tracing memory if this profiler started it; the recorded stages are kept
+        """
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        self.memory = False
+
+    def stage(self, name: str):
+        if not self.enabled:
+            return _DISABLED
+        return _Stage(self, name)
+
+    def _record(self, name: str, wall: float, cpu: float, self_wall: float, self_cpu: float, peak: int) -> None:
+        stage = self.stages.setdefault(name, {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'self_wall': 0.0,
+                                              'self_cpu': 0.0, 'peak_bytes': 0})
+        stage['calls'] += 1
+        stage['wall'] += wall
+        stage['cpu'] += cpu
+        stage['self_wall'] += self_wall
+        stage['self_cpu'] += self_cpu
+        stage['peak_bytes'] = max(stage['peak_bytes'], peak)
+
+    def to_dict(self) -> dict:
+        return {name: dict(stage) for name, stage in self.stages.items()}
+
+    def save(self, file: str) -> None:
+        with open(file, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+def profiled(name: str = None):
+    """Decorator timing a method as a stage of its object's `profiler`
+    """
+    def decorator(method):
+        stage_name = name or method.__name__.lstrip('_')
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.profiler.stage(stage_name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+def aggregate(profiles: list) -> dict:
+    """Cohort-wide profile from many per-session ones: totals, per-session mean and worst peak per stage.
+       Sorted by self time, the only column that adds up: wall and cpu include nested stages
+       (calculate_metrics runs inside calculate_distance).
+    """
+    cohort = {}
+    for profile in profiles:
+        for name, stage in profile.items():
+            total = cohort.setdefault(name, {'sessions': 0, 'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'self_wall': 0.0,
+                                             'self_cpu': 0.0, 'peak_bytes': 0})
+            total['sessions'] += 1
+            total['calls'] += stage['calls']
+            for key in ('wall', 'cpu', 'self_wall', 'self_cpu'):
+                total[key] += stage[key]
+            total['peak_bytes'] = max(total['peak_bytes'], stage['peak_bytes'])
+    for total in cohort.values():
+        total['mean_self_wall'] = total['self_wall'] / total['sessions']
+    return dict(sorted(cohort.items(), key=lambda item: -item[1]['self_wall']))
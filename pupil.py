@@ -0,0 +1,134 @@
+# Copyright 2022
+# Author: scott.allan.stone@gmail.com (Scott Stone)
+import numpy as np
+from metrics import N_EYES
+
+# Pupil diameter of each eye (mm, from the 3D eye model) and the tracker's confidence
+PUPIL_CHANNELS = ('diameter_3d_eye_0', 'diameter_3d_eye_1', 'confidence')
+PUPIL_DTYPE = np.dtype([('time', np.float64),                           # of the brightness_high marker
+                        ('baseline', np.float64, (N_EYES,)),             # mean diameter before it
+                        ('latency', np.float64, (N_EYES,)),              # seconds to the constriction onset
+                        ('amplitude', np.float64, (N_EYES,)),            # baseline - smallest diameter
+                        ('relative_amplitude', np.float64, (N_EYES,)),   # amplitude / baseline
+                        ('constriction_velocity', np.float64, (N_EYES,)),# fastest constriction, units per second
+                        ('time_to_peak', np.float64, (N_EYES,)),         # seconds to the smallest diameter
+                        ('recovery', np.float64, (N_EYES,)),             # fraction of the amplitude regained
+                        ('valid_fraction', np.float64, (N_EYES,))])      # of the response window, after masking
+
+def blink_mask(diameter: np.ndarray, confidence: np.ndarray = None, sample_rate: float = 200,
+               min_confidence: float = 0.6, margin: float = 0.05) -> np.ndarray:
+    """Samples to ignore, (N, 2): low confidence or no pupil, widened by `margin` seconds on both sides
+       (the lid covers part of the pupil either side of a blink)
+    """
+    bad = ~(diameter > 0)
+    if confidence is not None:
+        bad |= (np.asarray(confidence) < min_confidence)[:, None]
+    w = int(round(margin * sample_rate))
+    if w == 0:
+        return bad
+    # Dilate with a running count over 2w + 1 samples
+    counts = np.cumsum(np.concatenate((np.zeros((w + 1, bad.shape[1]), dtype=np.int64), bad,
+                                       np.zeros((w, bad.shape[1]), dtype=np.int64))), axis=0)
+    return (counts[2 * w + 1:] - counts[:-2 * w - 1]) > 0
+
+def fill_masked(time_stamps: np.ndarray, values: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """Linear interpolation across the masked samples of every column
+    """
+    filled = np.array(values, dtype=np.float64)
+    for column in range(filled.shape[1]):
+        bad = mask[:, column]
+        if np.any(bad) and not np.all(bad):
+            filled[bad, column] = np.interp(time_stamps[bad], time_stamps[~bad], filled[~bad, column])
+    return filled
+
+def analyze_pupil(marker_times: np.ndarray,
+                  time_stamps: np.ndarray,
+                  diameter: np.ndarray,
+                  sample_rate: float,
+                  confidence: np.ndarray = None,
+                  min_confidence: float = 0.6,
+                  blink_margin: float = 0.05,
+                  baseline: float = 1.0,
+                  window: float = 4.5,
+                  min_latency: float = 0.1,
+                  onset_fraction: float = 0.1,
+                  velocity_window: float = 0.05) -> np.ndarray:
+    """Pupillary light response to every brightness_high marker, both eyes at once.
+       diameter (N, 2) with its time_stamps and confidence are the brightness phase. Blinks (see blink_mask)
+       are bridged linearly and left out of the baseline (mean over `baseline` seconds before the marker).
+       The response window is `window` seconds from the marker, taken for every marker and eye as one
+       (markers, samples, eyes) array. Velocity is a central difference over +-velocity_window seconds and
+       the diameter is smoothed over the same span. Latency is when the constriction last rose through
+       onset_fraction of its fastest velocity before reaching it (from min_latency on), recovery the
+       fraction of the amplitude regained over the last half second.
+       Returns a PUPIL_DTYPE array, one row per marker.
+    """
+    marker_times = np.asarray(marker_times, dtype=np.float64)
+    result = np.zeros(len(marker_times), dtype=PUPIL_DTYPE)
+    result['time'] = marker_times
+    n = len(time_stamps)
+    if len(marker_times) == 0:
+        return result
+    if n < 2:
+        for field in PUPIL_DTYPE.names[1:]:
+            result[field] = np.nan
+        return result
+
+    time_stamps = np.asarray(time_stamps, dtype=np.float64)
+    diameter = np.asarray(diameter, dtype=np.float64)[:, :N_EYES]
+    masked = blink_mask(diameter, confidence, sample_rate, min_confidence, blink_margin)
+    filled = fill_masked(time_stamps, diameter, masked)
+
+    # Baseline: the unmasked samples in the second before each marker
+    before = (time_stamps[None, :] >= marker_times[:, None] - baseline) & (time_stamps[None, :] < marker_times[:, None])
+    use = before[:, :, None] & ~masked[None]
+    base = np.where(use, diameter[None], 0).sum(axis=1) / np.maximum(use.sum(axis=1), 1)
+    base[use.sum(axis=1) == 0] = np.nan
+
+    # Smoothed over +-velocity_window seconds, so the smallest diameter isn't just the lowest noise sample
+    k = max(1, int(round(velocity_window * sample_rate)))
+    padded = np.concatenate((np.repeat(filled[:1], k + 1, axis=0), filled, np.repeat(filled[-1:], k, axis=0)))
+    total = np.cumsum(padded, axis=0)
+    smooth = (total[2 * k + 1:] - total[:-2 * k - 1]) / (2 * k + 1)
+
+    # Response windows: (markers, samples, eyes)
+    w = int(round(window * sample_rate))
+    start = np.searchsorted(time_stamps, marker_times)
+    index = start[:, None] + np.arange(w)[None, :]
+    inside = index < n
+    index = np.minimum(index, n - 1)
+    response = smooth[index]
+    seconds = time_stamps[index] - marker_times[:, None]
+    window_masked = masked[index] | ~inside[:, :, None]
+
+    ahead, behind = np.minimum(index + k, n - 1), np.maximum(index - k, 0)
+    velocity = (filled[ahead] - filled[behind]) / (time_stamps[ahead] - time_stamps[behind])[:, :, None]
+    velocity[~inside] = 0
+
+    smallest = np.argmin(np.where(inside[:, :, None], response, np.inf), axis=1) # (markers, eyes)
+    fastest = np.argmin(np.where((seconds >= min_latency)[:, :, None], velocity, np.inf), axis=1)
+    m, e = np.meshgrid(np.arange(len(marker_times)), np.arange(N_EYES), indexing='ij')
+    peak_velocity = velocity[m, fastest, e]
+    amplitude = base - response[m, smallest, e]
+
+    # Onset: where the constriction last rose through onset_fraction of its fastest velocity before reaching
+    # it (from min_latency on), so a noise dip earlier on doesn't count
+    slow = (velocity > onset_fraction * peak_velocity[:, None, :]) | (seconds < min_latency)[:, :, None]
+    slow &= np.arange(w)[None, :, None] <= fastest[:, None, :]
+    last_slow = w - 1 - np.argmax(slow[:, ::-1], axis=1)
+    onset = np.minimum(last_slow + 1, fastest)
+    found = np.any(slow, axis=1) & (peak_velocity < 0)
+
+    end = seconds >= seconds[:, -1:] - 0.5
+    final = (response * end[:, :, None]).sum(axis=1) / np.maximum(end.sum(axis=1), 1)[:, None]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result['baseline'] = base
+        result['latency'] = np.where(found, seconds[m, onset], np.nan)
+        result['amplitude'] = amplitude
+        result['relative_amplitude'] = amplitude / base
+        result['constriction_velocity'] = -peak_velocity
+        result['time_to_peak'] = seconds[m, smallest]
+        result['recovery'] = (final - response[m, smallest, e]) / amplitude
+        result['valid_fraction'] = 1 - window_masked.mean(axis=1)
+    return result
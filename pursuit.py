@@ -0,0 +1,177 @@
+# Copyright 2022
+# Author: scott.allan.stone@gmail.com (Scott Stone)
+import numpy as np
+from events import adaptive_thresholds, runs, run_max
+from timeline import pursuit_steps, Timeline
+from frame_log import SUB_PHASES
+
+# Gaze on the screen (cyclopean, normalised) and how much the tracker trusts it
+PURSUIT_CHANNELS = ('norm_pos_x', 'norm_pos_y', 'confidence')
+PURSUIT_DTYPE = np.dtype([('name', 'U16'),                  # pursuit direction, e.g. 'left_hold'
+                          ('gain', np.float64),             # eye / target velocity along the motion
+                          ('lag', np.float64),              # seconds the eye is behind the target
+                          ('catch_up_saccades', np.int64),
+                          ('target_speed', np.float64),     # screen fractions per second
+                          ('samples', np.int64)])
+
+def pursuit_paths(timeline: Timeline = None, time_scale: float = 1.0) -> dict:
+    """Where the target goes in every pursuit direction: name -> (start (2,), end (2,), travel seconds),
+       in screen fractions. From a saved timeline (timeline.load_timeline) if given and it has a pursuit
+       segment, which has the exact pixels and frame counts of the recording, otherwise from the protocol
+       constants.
+    """
+    paths = {}
+    if timeline is None or 'pursuit' not in timeline.segments:
+        for step in pursuit_steps(None):
+            if step['start'] != step['end']:
+                paths.setdefault(step['sub_phase'][len('pursuit_'):],
+                                 (np.array(step['start'], dtype=np.float64), np.array(step['end'], dtype=np.float64),
+                                  step['seconds'] * time_scale))
+        return paths
+
+    frames = timeline['pursuit'].frames
+    position = np.stack((frames['x'] / timeline.width, frames['y'] / timeline.height), axis=1)
+    codes = frames['sub_phase']
+    starts = np.flatnonzero(np.diff(np.concatenate(([-1], codes))) != 0)
+    ends = np.append(starts[1:], len(frames))
+    for start, end in zip(starts, ends):
+        name = SUB_PHASES[codes[start]][len('pursuit_'):]
+        if name in paths or not name:
+            continue
+        arrived = start + np.flatnonzero(np.all(position[start:end] == position[end - 1], axis=1))[0]
+        paths[name] = (position[start], position[end - 1], (arrived - start) / timeline.fps)
+    return paths
+
+def affine_calibration(gaze: np.ndarray, target: np.ndarray) -> np.ndarray:
+    """Least squares (3, 2) affine map from gaze units onto the screen, fitted where the target is known
+    """
+    design = np.column_stack((gaze, np.ones(len(gaze))))
+    return np.linalg.lstsq(design, target, rcond=None)[0]
+
+def _lags(eye: np.ndarray, target: np.ndarray, max_lag: int) -> np.ndarray:
+    """Lag (samples, sub-sample by a parabola through the peak) maximising the cross-correlation of every
+       row of eye against the same row of target, all rows in one FFT
+    """
+    n = 1 << int(np.ceil(np.log2(2 * eye.shape[1])))
+    cc = np.fft.irfft(np.fft.rfft(eye, n, axis=1) * np.conj(np.fft.rfft(target, n, axis=1)), n, axis=1)
+    window = np.concatenate((cc[:, n - max_lag:], cc[:, :max_lag + 1]), axis=1) # lags -max_lag..max_lag
+    peak = np.clip(np.argmax(window, axis=1), 1, window.shape[1] - 2)
+    rows = np.arange(len(window))
+    left, centre, right = window[rows, peak - 1], window[rows, peak], window[rows, peak + 1]
+    curvature = left - 2 * centre + right
+    offset = np.where(curvature < 0, 0.5 * (left - right) / np.where(curvature < 0, curvature, 1), 0)
+    return peak - max_lag + offset
+
+def analyze_pursuit(names: list,
+                    start_times: np.ndarray,
+                    time_stamps: list,
+                    positions: list,
+                    sample_rate: float,
+                    confidence: list = None,
+                    paths: dict = None,
+                    calibrate: bool = True,
+                    min_confidence: float = 0.6,
+                    settle: float = 0.2,
+                    skip: float = 0.3,
+                    max_lag: float = 0.5,
+                    velocity_window: float = 0.01,
+                    lag_window: float = 0.05) -> np.ndarray:
+    """Gain, lag and catch-up saccades of every pursuit sub-phase at once.
+       names / start_times are the sub-phases and their _start marker times, time_stamps / positions /
+       confidence their gaze samples. The target position at every sample is regenerated from `paths`
+       (pursuit_paths()). With calibrate, the gaze is first mapped onto the screen by an affine fit on the
+       samples where the target sits still (`settle` seconds after it arrives), so the gain isn't fitted away.
+       Low confidence samples (blinks) are bridged linearly. Gain is the mean eye velocity along the motion
+       over the travel (from `skip` seconds in, saccades and low confidence samples left out) over the
+       target speed. Lag is where the desaccaded eye velocity best cross-correlates with the target
+       velocity, both over +-lag_window seconds. Catch-up saccades are velocity outliers
+       (events.adaptive_thresholds) during the travel. Returns a PURSUIT_DTYPE array, one row per sub-phase.
+    """
+    paths = pursuit_paths() if paths is None else paths
+    result = np.zeros(len(names), dtype=PURSUIT_DTYPE)
+    result['name'] = names
+    if len(names) == 0:
+        return result
+
+    # Everything as one ragged array: sample i belongs to sub-phase owner[i]
+    lengths = np.array([len(t) for t in time_stamps], dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    owner = np.repeat(np.arange(len(names)), lengths)
+    t = np.concatenate(time_stamps).astype(np.float64) - np.repeat(np.asarray(start_times, dtype=np.float64), lengths)
+    gaze = np.concatenate(positions).astype(np.float64)[:, :2]
+    valid = np.ones(len(t), dtype=bool) if confidence is None else np.concatenate(confidence) >= min_confidence
+
+    start = np.array([paths[name][0] for name in names])
+    end = np.array([paths[name][1] for name in names])
+    travel = np.array([paths[name][2] for name in names])
+    distance = np.linalg.norm(end - start, axis=1)
+    direction = (end - start) / distance[:, None]
+    speed = distance / travel
+    progress = np.clip(t / travel[owner], 0, 1)
+    target = start[owner] + (end - start)[owner] * progress[:, None]
+
+    still = valid & (t >= travel[owner] + settle)
+    if calibrate and np.count_nonzero(still) >= 10:
+        gaze = np.column_stack((gaze, np.ones(len(gaze)))) @ affine_calibration(gaze[still], target[still])
+
+    # Bridge low confidence samples (blinks) linearly, never across two sub-phases: every sub-phase gets
+    # its own stretch of a monotonic key so one np.interp call does them all
+    key = owner * (t.max() - t.min() + 1) + t
+    if np.any(valid) and not np.all(valid):
+        for axis in range(2):
+            gaze[~valid, axis] = np.interp(key[~valid], key[valid], gaze[valid, axis])
+
+    # Velocity over +-window seconds, never across the edge of a sub-phase
+    index = np.arange(len(t))
+    first, last = offsets[:-1][owner], offsets[1:][owner] - 1
+
+    def velocity(window):
+        w = max(1, int(round(window * sample_rate)))
+        ahead, behind = np.minimum(index + w, last), np.maximum(index - w, first)
+        dt = np.where(ahead > behind, t[ahead] - t[behind], np.inf)
+        return np.einsum('ij,ij->i', gaze[ahead] - gaze[behind], direction[owner]) / dt, \
+            np.linalg.norm(gaze[ahead] - gaze[behind], axis=1) / dt
+
+    def spans(starts, ends, widen=0):
+        """Which samples fall inside any of the runs, widened by `widen` samples (within its sub-phase)
+        """
+        inside = np.zeros(len(t) + 1, dtype=np.int64)
+        np.add.at(inside, np.maximum(starts - widen, first[starts]), 1)
+        np.add.at(inside, np.minimum(ends + widen, last[ends - 1] + 1), -1)
+        return np.cumsum(inside[:-1]) > 0
+
+    along, eye_speed = velocity(velocity_window)
+    moving = (t >= 0) & (t < travel[owner])
+    high, low = adaptive_thresholds(eye_speed[moving & valid])
+    fast = eye_speed > low
+    fast[offsets[1:][lengths > 0] - 1] = False # runs never join two sub-phases
+    run_start, run_end = runs(fast)
+    saccade = (run_max(eye_speed, run_start, run_end) > high) & ((run_end - run_start) >= 2)
+    run_start, run_end = run_start[saccade], run_end[saccade]
+    in_saccade = spans(run_start, run_end)
+    result['catch_up_saccades'] = np.bincount(owner[run_start][moving[run_start]], minlength=len(names))
+
+    steady = moving & (t >= skip) & valid & ~in_saccade
+    counts = np.bincount(owner, weights=steady, minlength=len(names))
+    mean_along = np.bincount(owner, weights=np.where(steady, along, 0), minlength=len(names)) / np.maximum(counts, 1)
+    result['gain'] = np.where(counts > 0, mean_along / speed, np.nan)
+
+    # Desaccaded eye velocity (bridged across every saccade and the window around it) against the target's,
+    # both through the same lag_window, in one batch of FFTs
+    w = max(1, int(round(lag_window * sample_rate)))
+    smooth_along, _ = velocity(lag_window)
+    bridged = spans(run_start, run_end, widen=w)
+    if np.any(bridged) and not np.all(bridged):
+        smooth_along[bridged] = np.interp(key[bridged], key[~bridged], smooth_along[~bridged])
+    ramp = (np.clip(t + w / sample_rate, 0, travel[owner]) - np.clip(t - w / sample_rate, 0, travel[owner])) \
+        / (2 * w / sample_rate)
+    eye_rows = np.zeros((len(names), lengths.max()))
+    target_rows = np.zeros_like(eye_rows)
+    column = index - offsets[:-1][owner]
+    eye_rows[owner, column] = smooth_along
+    target_rows[owner, column] = ramp * speed[owner]
+    lag = _lags(eye_rows, target_rows, max(1, int(max_lag * sample_rate))) / sample_rate
+    result['lag'] = np.where(counts > 0, lag, np.nan)
+    result['target_speed'] = speed
+    result['samples'] = lengths
+    return result
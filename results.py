@@ -0,0 +1,199 @@
+# Copyright 2022
+# Author: scott.allan.stone@gmail.com (Scott Stone)
+import csv
+import os
+import time
+import numpy as np
+from metrics import METRIC_NAMES, N_EYES
+from events import count_events
+
+TABLE_FORMATS = {'.csv': 'csv', '.parquet': 'parquet', '.feather': 'feather'}
+GAZE_AXES = ('x_eye_0', 'y_eye_0', 'x_eye_1', 'y_eye_1')
+PURSUIT_COLUMNS = ('gain', 'lag', 'catch_up_saccades') # of pursuit.PURSUIT_DTYPE, per sub-phase row
+JUMP_COLUMNS = ('latency', 'amplitude', 'gain', 'error', 'corrective_saccades') # of jump.JUMP_DTYPE, per eye
+PUPIL_COLUMNS = ('baseline', 'latency', 'amplitude', 'relative_amplitude', 'constriction_velocity',
+                 'time_to_peak', 'recovery') # of pupil.PUPIL_DTYPE, per eye on the brightness row
+
+def _scalar(value):
+    """numpy scalars -> plain Python, so rows pickle small and write cleanly
+    """
+    return value.item() if isinstance(value, np.generic) else value
+
+def metric_columns(metrics: dict) -> dict:
+    """Flatten the per-eye metric arrays into <name>_eye_<i> columns
+    """
+    row = {'n_samples': int(metrics['n_samples'][0]), 'duration': float(metrics['duration'][0])}
+    for name in METRIC_NAMES[2:]:
+        for eye in range(N_EYES):
+            row[f'{name}_eye_{eye}'] = float(metrics[name][eye])
+    return row
+
+def phase_columns(analyzer, phase: str) -> dict:
+    """Everything else the analyzer has calculated for one phase
+    """
+    row = {}
+    if phase in getattr(analyzer, 'frequency', {}):
+        for name, values in analyzer.frequency[phase].items():
+            for axis, value in zip(GAZE_AXES, values):
+                row[f'{name}_{axis}'] = float(value)
+    for eye, events in enumerate(getattr(analyzer, 'events', {}).get(phase, [])):
+        for label, count in count_events(events).items():
+            row[f'{label}_count_eye_{eye}'] = count
+    pupil = getattr(analyzer, 'pupil', None)
+    if phase == 'brightness' and pupil is not None and len(pupil):
+        # The last brightness_high of the phase: a redone trial leaves the earlier ones behind
+        for name in PUPIL_COLUMNS:
+            for eye in range(N_EYES):
+                row[f'pupil_{name}_eye_{eye}'] = float(pupil[name][-1][eye])
+    return row
+
+def session_rows(analyzer) -> list:
+    """One tidy row per phase and pursuit sub-phase of an analyzed session
+    """
+    if not hasattr(analyzer, 'metrics'):
+        analyzer.calculate_metrics()
+
+    # A .chunks/ recording and its .xdf export are the same session
+    base = {'session': os.path.splitext(os.path.basename(analyzer.file.rstrip('/')))[0],
+            'file': analyzer.file,
+            'source_mtime': os.path.getmtime(analyzer.file),
+            'analyzed_at': time.time()}
+
+    rows = []
+    for phase, start, end in zip(analyzer.phases, analyzer.timestamps_start, analyzer.timestamps_end):
+        row = dict(base, phase=phase, sub_phase='', start_time=float(start), end_time=float(end))
+        row.update(metric_columns(analyzer.metrics[phase]))
+        row.update(phase_columns(analyzer, phase))
+        rows.append(row)
+
+    pursuit = getattr(analyzer, 'pursuit', None)
+    for i, (sub_phase, start, end, metrics) in enumerate(zip(analyzer.sub_phases, analyzer.sub_phase_timestamps_start,
+                                                             analyzer.sub_phase_timestamps_end,
+                                                             analyzer.sub_phase_metrics)):
+        row = dict(base, phase='pursuit', sub_phase=sub_phase, start_time=float(start), end_time=float(end))
+        row.update(metric_columns(metrics))
+        if pursuit is not None:
+            row.update({name: pursuit[name][i] for name in PURSUIT_COLUMNS})
+        rows.append(row)
+
+    # One row per jump marker, so latency distributions come straight out of the table
+    jumps = getattr(analyzer, 'jumps', None)
+    if jumps is not None and len(jumps):
+        jump_end = analyzer.timestamps_end[analyzer.phases.index('jump')]
+        for jump, end in zip(jumps, np.append(jumps['time'][1:], jump_end)):
+            row = dict(base, phase='jump', sub_phase=jump['label'], start_time=float(jump['time']),
+                       end_time=float(end), jump_size=float(jump['size']))
+            for name in JUMP_COLUMNS:
+                for eye in range(N_EYES):
+                    row[f'saccade_{name}_eye_{eye}'] = jump[name][eye]
+            rows.append(row)
+
+    return [{key: _scalar(value) for key, value in row.items()} for row in rows]
+
+def table_format(path: str) -> str:
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in TABLE_FORMATS:
+        raise ValueError(f"Unknown table format {extension!r}, expected one of {tuple(TABLE_FORMATS)}")
+    return TABLE_FORMATS[extension]
+
+def _columns(rows: list, existing: list = ()) -> list:
+    """Union of the columns, keeping the existing order and appending new ones as they're seen
+    """
+    columns = dict.fromkeys(existing)
+    for row in rows:
+        columns.update(dict.fromkeys(row))
+    return list(columns)
+
+def _write_csv(rows: list, path: str) -> None:
+    existing = []
+    if os.path.exists(path):
+        with open(path, newline='') as f:
+            existing = next(csv.reader(f), [])
+    columns = _columns(rows, existing)
+
+    if existing == columns:
+        # Same schema: plain append
+        with open(path, 'a', newline='') as f:
+            csv.DictWriter(f, columns).writerows(rows)
+        return
+
+    # New columns (or a new file): rewrite with the wider header
+    old_rows = []
+    if existing:
+        with open(path, newline='') as f:
+            old_rows = list(csv.DictReader(f))
+    with open(path + '.tmp', 'w', newline='') as f:
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        writer.writerows(old_rows)
+        writer.writerows(rows)
+    os.replace(path + '.tmp', path)
+
+def _write_columnar(rows: list, path: str, format: str) -> None:
+    try:
+        import pandas as pd
+    except ImportError:
+        raise ImportError(f"Writing {format} tables needs pandas (and pyarrow): pip install pandas pyarrow")
+
+    table = pd.DataFrame(rows)
+    if os.path.exists(path):
+        # Neither format can be appended in place, so the table is rewritten
+        table = pd.concat([read_table(path, latest=False), table], ignore_index=True)
+    if format == 'parquet':
+        table.to_parquet(path + '.tmp', index=False)
+    else:
+        table.to_feather(path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+def write_table(rows: list, path: str) -> None:
+    """Append rows to the cohort table. The format comes from the extension (.csv, .parquet or .feather).
+       Re-analyzed sessions are appended again rather than overwritten; read_table(latest=True) keeps
+       only the newest analysis of each file.
+    """
+    if len(rows) == 0:
+        return
+    format = table_format(path)
+    if format == 'csv':
+        _write_csv(rows, path)
+    else:
+        _write_columnar(rows, path, format)
+
+def read_table(path: str, latest: bool = True):
+    """Read the cohort table as a pandas DataFrame
+    """
+    import pandas as pd
+
+    format = table_format(path)
+    if format == 'csv':
+        table = pd.read_csv(path)
+        table['sub_phase'] = table['sub_phase'].fillna('')
+    elif format == 'parquet':
+        table = pd.read_parquet(path)
+    else:
+        table = pd.read_feather(path)
+
+    if latest:
+        newest = table.groupby('file')['analyzed_at'].transform('max')
+        table = table[table['analyzed_at'] == newest].reset_index(drop=True)
+    return table
+
+def analyzed_sessions(path: str) -> dict:
+    """file -> source_mtime of every session in the table (CSV tables are read without pandas).
+       Analyses whose figures failed to render are left out, so the session is done again.
+    """
+    if not os.path.exists(path):
+        return {}
+    if table_format(path) != 'csv':
+        table = read_table(path, latest=False)
+        if 'render_failed' in table:
+            table = table[~table['render_failed'].fillna(False).astype(bool)]
+        return table.groupby('file')['source_mtime'].max().to_dict()
+
+    sessions = {}
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            if row.get('render_failed') == 'True':
+                continue
+            mtime = float(row['source_mtime'])
+            sessions[row['file']] = max(mtime, sessions.get(row['file'], mtime))
+    return sessions
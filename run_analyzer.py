@@ -1,26 +1,242 @@
 # Copyright 2022
 # Author: scott.allan.stone@gmail.com (Scott Stone)
 from analyzer import Analyzer
+from session import CACHE_MODES
+from results import session_rows, write_table, analyzed_sessions
+from profiling import Profiler, aggregate
+from pursuit import PURSUIT_CHANNELS
+from jump import JUMP_CHANNELS
+from pupil import PUPIL_CHANNELS
+from functools import partial
 from glob import glob
+from tqdm import tqdm
+import argparse
+import json
 import multiprocessing as mp
+import os
 import time
+import traceback
+import zlib
 
-def process(file: str):
-    start_time = time.perf_counter()
-    analyzer = Analyzer(file,
-                        stimulus_marker_name='Stimulus_Markers',
-                        gaze_name='pupil_capture')
+PROFILE_MODES = ('off', 'time', 'memory')
+EXTRA_CHANNELS = tuple(dict.fromkeys(PURSUIT_CHANNELS + JUMP_CHANNELS + PUPIL_CHANNELS)) # loaded next to the gaze columns, by name
+
+def load_analyzer(file: str, cache: str = 'use', profiler: Profiler = None, preprocess: bool = False,
+                  dtype: str = None, release: bool = False) -> Analyzer:
+    return Analyzer(file,
+                    stimulus_marker_name='Stimulus_Markers',
+                    gaze_name='pupil_capture',
+                    extra_channels=EXTRA_CHANNELS,
+                    cache=cache,
+                    dtype=dtype,
+                    release=release,
+                    preprocess={} if preprocess else None,
+                    profile=profiler)
+
+def analyze_file(file: str, cache: str = 'use', profiler: Profiler = None, preprocess: bool = False,
+                 dtype: str = None, release: bool = False) -> Analyzer:
+    analyzer = load_analyzer(file, cache=cache, profiler=profiler, preprocess=preprocess, dtype=dtype, release=release)
     analyzer.analyze()
 
     # Also do the dispersion of the brightness condition
     analyzer.calculate_dispersion(phase='brightness')
-    #analyzer.calculate_frequency()
+    analyzer.calculate_frequency()
+    analyzer.calculate_pursuit()
+    analyzer.calculate_jumps()
+    analyzer.calculate_pupil()
+    return analyzer
+
+def profile_file(file: str) -> str:
+    """Where a session's stage profile goes: next to the recording
+    """
+    return os.path.splitext(file.rstrip('/'))[0] + '_profile.json'
+
+def process(file: str, cache: str = 'use', profile: str = 'off', preprocess: bool = False,
+            dtype: str = None, release: bool = False) -> dict:
+    """Analysis stage: returns the session's rows for the cohort table (and its stage profile)
+    """
+    start_time = time.perf_counter()
+    profiler = Profiler(enabled=profile != 'off', memory=profile == 'memory')
+    try:
+        analyzer = analyze_file(file, cache=cache, profiler=profiler, preprocess=preprocess, dtype=dtype,
+                                release=release)
+        with profiler.stage('session_rows'):
+            rows = session_rows(analyzer)
+    finally:
+        # Pool workers are reused, tracing must not outlive this session even when it failed
+        profiler.stop()
     print(f"\t{file}: took: {time.perf_counter() - start_time:.2f}s")
+    if profile == 'off':
+        return {'rows': rows}
+    profiler.save(profile_file(file))
+    return {'rows': rows, 'profile': profiler.to_dict()}
+
+_renderer = None # one per rendering worker, reused for every file it draws
+
+def render(file: str, cache: str = 'use', preprocess: bool = False, dtype: str = None, release: bool = False,
+           **options) -> None:
+    """Rendering stage: reload the session and calculate only what the figures show (velocity,
+       dispersions, spectra), then draw them. The analysis stage has just written the cache, so it is
+       read rather than rebuilt again.
+    """
+    global _renderer
+    if _renderer is None:
+        from plots import Renderer
+        _renderer = Renderer()
+    analyzer = load_analyzer(file, cache='off' if cache == 'off' else 'use', preprocess=preprocess, dtype=dtype,
+                             release=release)
+    analyzer.calculate_velocity()
+    analyzer.calculate_dispersion(phase='stare')
+    analyzer.calculate_dispersion(phase='brightness')
+    analyzer.calculate_frequency()
+    _renderer.render(analyzer)
+
+def safe_process(file: str, stage=process, **options) -> dict:
+    """Run one stage (process or render) on one file and report what happened instead of raising,
+       so one bad recording can't take down the whole batch. options are passed on to the stage.
+    """
+    start_time = time.perf_counter()
+    result = {'file': file, 'ok': True, 'error': None, 'rows': []}
+    try:
+        result.update(stage(file, **options) or {})
+    except Exception:
+        result['ok'] = False
+        result['error'] = traceback.format_exc()
+    result['seconds'] = time.perf_counter() - start_time
+    return result
+
+def run_stage(stage, files: list, workers: int, description: str, **options) -> list:
+    """Run a stage over the files on its own worker pool, largest files first
+    """
+    if len(files) == 0:
+        return []
+    # Largest first so a big file started last doesn't leave every other worker idle. One session per
+    # task: a session takes seconds, far longer than the dispatch, and bigger chunks would undo the ordering
+    files = sorted(files, key=os.path.getsize, reverse=True)
+    workers = max(1, min(workers, len(files)))
+    results = []
+    with mp.Pool(workers) as pool:
+        jobs = pool.imap_unordered(partial(safe_process, stage=stage, **options), files, chunksize=1)
+        for result in tqdm(jobs, total=len(files), unit='session', desc=description):
+            results.append(result)
+            if not result['ok']:
+                tqdm.write(f"FAILED {result['file']}:\n{result['error']}")
+    return results
+
+def parse_shard(shard: str) -> tuple:
+    """'2/4' -> (2, 4). Shards are numbered from 1.
+    """
+    try:
+        i, n = (int(part) for part in shard.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"shard must look like i/n, not {shard!r}")
+    if not 1 <= i <= n:
+        raise argparse.ArgumentTypeError(f"shard i/n needs 1 <= i <= n, not {shard!r}")
+    return i, n
+
+def in_shard(file: str, shard: tuple) -> bool:
+    """Assign files to shards by a stable hash of their path, so every node agrees on the split
+       and adding new sessions doesn't move old ones
+    """
+    i, n = shard
+    return zlib.crc32(file.replace(os.sep, '/').encode()) % n == i - 1
+
+def is_up_to_date(file: str, analyzed: dict) -> bool:
+    """A session is up to date if the cohort table already has it, analyzed from this version of the recording
+    """
+    return analyzed.get(file, -1) >= os.path.getmtime(file)
+
+def print_profile(cohort: dict, output: str) -> None:
+    """Save the cohort-wide stage profile and print where the time went
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(cohort, f, indent=2)
+    print(f"Stage profile (cohort total without nested stages, saved to {output}):")
+    for name, stage in cohort.items():
+        print(f"\t{name:<32} {stage['self_wall']:8.2f}s wall {stage['self_cpu']:8.2f}s cpu "
+              f"{stage['mean_self_wall'] * 1000:8.1f}ms/session {stage['peak_bytes'] / 2**20:8.1f}MB peak")
+    print(f"\t{'total':<32} {sum(stage['self_wall'] for stage in cohort.values()):8.2f}s wall")
 
 def main():
-    files = glob('data/pt*/*.xdf')
-    with mp.Pool() as pool:
-        pool.map(process, files)
+    parser = argparse.ArgumentParser(description="Analyze every recorded session")
+    parser.add_argument('--glob', default='data/pt*/*.xdf',
+                        help="which recordings to analyze")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="number of worker processes")
+    parser.add_argument('--shard', type=parse_shard, default=(1, 1),
+                        help="only analyze shard i of n (e.g. 2/4) to split a cohort over several machines")
+    parser.add_argument('--incremental', action='store_true',
+                        help="skip sessions already in the results table for the current recording")
+    parser.add_argument('--table', default='data/results.csv',
+                        help="cohort results table to append to (.csv, .parquet or .feather)")
+    parser.add_argument('--render', choices=('pool', 'off'), default='pool',
+                        help="draw the figures on a separate worker pool after the analysis, or skip them")
+    parser.add_argument('--render-workers', type=int, default=os.cpu_count(),
+                        help="number of rendering processes")
+    parser.add_argument('--cache', choices=CACHE_MODES, default='use',
+                        help="use the per-session cache next to each XDF, rebuild it, or bypass it")
+    parser.add_argument('--profile', choices=PROFILE_MODES, default='off',
+                        help="time every analysis stage (and with 'memory', its peak allocation); "
+                             "writes <session>_profile.json per session and a cohort profile")
+    parser.add_argument('--preprocess', action='store_true',
+                        help="mask low confidence gaze, bridge blinks and Savitzky-Golay smooth it before the "
+                             "analysis (see preprocess.py)")
+    parser.add_argument('--dtype', choices=('float32', 'float64'), default=None,
+                        help="downcast the loaded gaze columns (float32 halves the memory of the cache and the "
+                             "phases; parsing an uncached XDF still needs the whole float64 stream)")
+    parser.add_argument('--release', action='store_true',
+                        help="copy the phases out and drop the full gaze stream once they are extracted")
+    parser.add_argument('--profile-output', default='data/profile.json',
+                        help="where the cohort-wide profile goes")
+    args = parser.parse_args()
+
+    files = [file for file in glob(args.glob) if in_shard(file, args.shard)]
+    skipped = 0
+    if args.incremental:
+        analyzed = analyzed_sessions(args.table)
+        todo = [file for file in files if not is_up_to_date(file, analyzed)]
+        skipped = len(files) - len(todo)
+        files = todo
+
+    total_bytes = sum(os.path.getsize(file) for file in files)
+    print(f"Analyzing {len(files)} sessions ({total_bytes / 2**20:.1f}MB) with {args.workers} workers, "
+          f"shard {args.shard[0]}/{args.shard[1]}, {skipped} up to date")
+
+    start_time = time.perf_counter()
+    results = run_stage(process, files, args.workers, 'analysis', cache=args.cache, profile=args.profile,
+                        preprocess=args.preprocess, dtype=args.dtype, release=args.release)
+    elapsed = time.perf_counter() - start_time
+    rows = {result['file']: result['rows'] for result in results}
+
+    errors = {}
+    if args.render == 'pool':
+        analyzed = [result['file'] for result in results if result['ok']]
+        rendered = run_stage(render, analyzed, args.render_workers, 'rendering', cache=args.cache,
+                             preprocess=args.preprocess, dtype=args.dtype, release=args.release)
+        # A session whose figures failed counts as failed, but keeps its analysis rows and profile
+        errors = {result['file']: result['error'] for result in rendered if not result['ok']}
+        for result in results:
+            if result['file'] in errors:
+                result['ok'] = False
+                result['error'] = errors[result['file']]
+        print(f"Rendering took {time.perf_counter() - start_time - elapsed:.1f}s")
+
+    # Written once here, never by the workers. Sessions whose figures failed are marked, so --incremental
+    # doesn't count them as up to date
+    write_table([dict(row, render_failed=file in errors) for file, file_rows in rows.items() for row in file_rows],
+                args.table)
+
+    if args.profile != 'off':
+        print_profile(aggregate([result['profile'] for result in results if 'profile' in result]),
+                      args.profile_output)
+
+    failed = [result['file'] for result in results if not result['ok']]
+    print(f"Analysis done in {elapsed:.1f}s: {len(results) - len(failed)} ok, {len(failed)} failed, {skipped} skipped")
+    if elapsed > 0 and len(results) > 0:
+        print(f"Throughput: {len(results) / elapsed:.2f} sessions/s, {total_bytes / 2**20 / elapsed:.1f}MB/s")
+    for file in failed:
+        print(f"\tfailed: {file}")
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
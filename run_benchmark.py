@@ -0,0 +1,361 @@
+# Copyright 2022
+# Author: scott.allan.stone@gmail.com (Scott Stone)
+import numpy as np
+import argparse
+import json
+import shutil
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from metrics import phase_metrics
+from markers import MarkerIndex, PURSUIT_DIRECTIONS, JUMP_MARKERS
+from spectral import nystagmus_spectrum
+from events import detect_events, count_events, eye_velocity
+from synthetic import write_session
+from profiling import Profiler
+from results import session_rows
+from run_analyzer import load_analyzer, analyze_file
+import os
+import tempfile
+
+REGRESSION_RATIO = 1.25 # flag anything this much slower than the last stored run
+
+def synthetic_gaze(seconds: float, sample_rate: float, seed: int = 0) -> np.ndarray:
+    """Random-walk gaze for both eyes, shaped like Analyzer.gaze_data (N, 4)
+    """
+    rng = np.random.default_rng(seed)
+    n = int(seconds * sample_rate)
+    return 0.5 + np.cumsum(rng.normal(0, 1e-3, size=(n, 4)), axis=0)
+
+def loop_distance(gaze_data: np.ndarray) -> float:
+    """The original per-sample Analyzer.calculate_distance loop, kept as the benchmark reference
+    """
+    def dist(x1, y1, x2, y2):
+        return np.sqrt((x2 - x1)**2 + (y2 - y1)**2)
+
+    distance = 0
+    for gaze_idx in range(len(gaze_data) - 1):
+        distance += dist(gaze_data[gaze_idx, 0], gaze_data[gaze_idx, 1],
+                         gaze_data[gaze_idx + 1, 0], gaze_data[gaze_idx + 1, 1])
+    return distance
+
+def synthetic_markers(n_sessions: int) -> list:
+    """The marker sequence of run_stimulus.py (with a redone vor trial), repeated n_sessions times
+    """
+    session = ['stimulus_begin', 'stare', 'stare_end', 'pursuit']
+    for dir in PURSUIT_DIRECTIONS:
+        session += [f'pursuit_{dir}_start', f'pursuit_{dir}_end']
+    session += ['pursuit_end', 'vor', 'redo_trial', 'vor', 'vor_end', 'jump']
+    session += [JUMP_MARKERS[i % 3] for i in range(17)]
+    session += ['jump_end', 'brightness', 'brightness_high', 'brightness_end', 'stimulus_end']
+    return [[marker] for marker in session * n_sessions]
+
+def loop_phase_indices(time_series: list, phase_starts: list) -> tuple:
+    """The original nested Analyzer._find_start_end_phase_indices scan, kept as the benchmark reference
+    """
+    phase_ends = [phase + '_end' for phase in phase_starts]
+    marker_start_idx, marker_end_idx = [], []
+    for marker in time_series:
+        for marker_start in phase_starts:
+            if marker[0] == marker_start:
+                marker_start_idx.append(time_series.index(marker))
+        for marker_end in phase_ends:
+            if marker[0] == marker_end:
+                marker_end_idx.append(time_series.index(marker))
+    return marker_start_idx, marker_end_idx
+
+def bench_markers(n_sessions: int = 50) -> None:
+    time_series = synthetic_markers(n_sessions)
+    time_stamps = np.arange(len(time_series), dtype=np.float64)
+    phases = ['stare', 'pursuit', 'vor', 'jump', 'brightness']
+    print(f"Marker index on {len(time_series)} markers")
+
+    start_time = time.perf_counter()
+    loop_phase_indices(time_series, phases)
+    loop_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    index = MarkerIndex(time_series, time_stamps)
+    index.phase_bounds(phases)
+    index.sub_phase_bounds('pursuit')
+    index.events(JUMP_MARKERS)
+    index_time = time.perf_counter() - start_time
+
+    print(f"\tnested scan: {loop_time * 1000:.1f}ms")
+    print(f"\tmarker index (phases, sub-phases, jumps): {index_time * 1000:.1f}ms")
+
+def bench_metrics(seconds: float = 3600, sample_rate: float = 200) -> None:
+    gaze = synthetic_gaze(seconds, sample_rate)
+    print(f"Metrics on {seconds:.0f}s @ {sample_rate:.0f}Hz ({len(gaze)} samples)")
+
+    start_time = time.perf_counter()
+    reference = loop_distance(gaze)
+    loop_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    metrics = phase_metrics(gaze, sample_rate)
+    vector_time = time.perf_counter() - start_time
+
+    assert np.isclose(metrics['path_length'][0], reference)
+    print(f"\tloop (eye 0 path length): {loop_time:.3f}s")
+    print(f"\tvectorized (all metrics, both eyes): {vector_time:.3f}s")
+    print(f"\tspeedup: {loop_time / vector_time:.0f}x")
+
+def bench_memory(seconds: float = 3600, sample_rate: float = 200) -> None:
+    """Peak and retained traced memory of loading a synthetic recording the way run_analyzer does:
+       parsing the XDF as is, downcast to float32, and downcast and released, then from the cache.
+       float32 and release only cut what is retained: liesl parses the whole stream (every channel)
+       before any column can be dropped, so the parse sets the peak. Only the cache lowers it.
+    """
+    directory = tempfile.mkdtemp()
+    file = os.path.join(directory, 'pt_m', 'pt_m.xdf')
+    try:
+        write_session(file, duration=seconds, sample_rate=sample_rate, seed=0)
+        print(f"Load memory on {seconds:.0f}s @ {sample_rate:.0f}Hz ({os.path.getsize(file) / 2**20:.0f}MB XDF)")
+        for dtype in (None, 'float32'): # the cache entries the cached loads read
+            load_analyzer(file, cache='rebuild', dtype=dtype)
+        for name, cache, options in (('xdf, as recorded', 'off', {}),
+                                     ('xdf, float32', 'off', {'dtype': 'float32'}),
+                                     ('xdf, float32, released', 'off', {'dtype': 'float32', 'release': True}),
+                                     ('cache, as recorded', 'use', {}),
+                                     ('cache, float32, released', 'use', {'dtype': 'float32', 'release': True})):
+            tracemalloc.start()
+            kept = load_analyzer(file, cache=cache, **options)
+            retained, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del kept
+            print(f"\t{name}: peak {peak / 2**20:.0f}MB, retained {retained / 2**20:.0f}MB")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def loop_frequency(gaze: np.ndarray, sample_rate: float, cutoff: float = 5) -> tuple:
+    """The original Analyzer.calculate_frequency spectrum (x and y of eye 0), kept as the benchmark reference
+    """
+    N = len(gaze)
+    yf_x = np.abs(np.fft.fft(gaze[:, 0]))[:int(N/2)]
+    yf_y = np.abs(np.fft.fft(gaze[:, 1]))[:int(N/2)]
+    xf = np.fft.fftfreq(N, 1 / sample_rate)[:N//2]
+    freq_idx = np.where((xf <= cutoff) & (xf > 0))
+    return xf[freq_idx], yf_x[freq_idx], yf_y[freq_idx]
+
+def bench_frequency(seconds: float = 1200, sample_rate: float = 200, beat: float = 3.0) -> None:
+    """Speed, and the spread of the noise floor (coefficient of variation of the spectrum away from the
+       beat, lower is better) of the old FFT and the Welch engine on a noisy 3Hz nystagmus
+    """
+    rng = np.random.default_rng(0)
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    gaze = 0.01 * np.sin(2 * np.pi * beat * t)[:, None] + rng.normal(0, 0.02, size=(len(t), 4))
+    print(f"Frequency on a {seconds:.0f}s phase @ {sample_rate:.0f}Hz")
+
+    start_time = time.perf_counter()
+    xf, power_x, _ = loop_frequency(gaze, sample_rate)
+    fft_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    spectrum = nystagmus_spectrum(gaze, sample_rate)
+    welch_time = time.perf_counter() - start_time
+
+    def noise_cv(frequencies, power):
+        floor = power[(frequencies > 0.5) & (frequencies < 5) & (np.abs(frequencies - beat) > 0.5)]
+        return floor.std() / floor.mean()
+
+    welch_x = spectrum['psd'][:, 0]
+    print(f"\tfft (x, y of eye 0): {fft_time * 1000:.1f}ms, peak {xf[np.argmax(power_x)]:.2f}Hz, "
+          f"noise floor CV {noise_cv(xf, power_x):.2f}")
+    print(f"\twelch (all 4 columns): {welch_time * 1000:.1f}ms, peak {spectrum['dominant_frequency'][0]:.2f}Hz, "
+          f"noise floor CV {noise_cv(spectrum['frequencies'], welch_x):.2f}")
+
+def bench_events(seconds: float = 3600, sample_rate: float = 200) -> None:
+    """Event detection on an hour of sawtooth nystagmus (0.3s slow phase, 25ms fast phase)
+    """
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    beat = t % 0.325
+    x = np.where(beat < 0.3, beat / 0.3 * 0.05, 0.05 * (1 - (beat - 0.3) / 0.025))
+    gaze = np.stack((x, np.full_like(x, 0.5), x, np.full_like(x, 0.5)), axis=1)
+    gaze += np.random.default_rng(0).normal(0, 1e-4, size=gaze.shape)
+    print(f"Events on {seconds:.0f}s @ {sample_rate:.0f}Hz ({len(gaze)} samples)")
+
+    start_time = time.perf_counter()
+    velocity = eye_velocity(gaze, sample_rate)
+    events = [detect_events(gaze[:, 2 * eye:2 * eye + 2], sample_rate, velocity=velocity[:, eye]) for eye in range(2)]
+    print(f"\tboth eyes: {time.perf_counter() - start_time:.3f}s, eye 0: {count_events(events[0])}")
+
+def bench_render(width: int = 3840, height: int = 2160, fps: float = 60) -> dict:
+    """Per-frame cost of drawing the pursuit condition with full flips and with dirty rectangles,
+       on the SDL dummy video driver so it runs without a display
+    """
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    import pygame
+    from timeline import Timeline
+    from frame_renderer import FrameRenderer, RENDER_MODES
+    pygame.display.init()
+    screen = pygame.display.set_mode((width, height))
+    segment = Timeline(width, height, fps, stim_order=('pursuit',), rng=np.random.default_rng(0))['pursuit']
+    print(f"Rendering {len(segment.draws)} pursuit frames at {width}x{height} ({os.environ['SDL_VIDEODRIVER']} driver)")
+
+    costs = {}
+    for mode in RENDER_MODES:
+        renderer = FrameRenderer(screen, mode=mode)
+        start_time = time.perf_counter()
+        for shape, x, y, colour, background, _ in segment.draws:
+            renderer.draw(shape, x, y, colour, background)
+            renderer.present()
+        costs[mode] = (time.perf_counter() - start_time) / len(segment.draws)
+        print(f"\t{mode}: {costs[mode] * 1000:.3f}ms/frame")
+    print(f"\tdirty rectangles are {costs['full'] / costs['dirty']:.1f}x cheaper per frame")
+    pygame.display.quit()
+    return costs
+
+def timed(function, *args, **kwargs) -> tuple:
+    start_time = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start_time
+
+def bench_stages(file: str) -> dict:
+    """Wall time of every Analyzer stage on one recording, plus peak traced memory of a load + analysis.
+       The Analyzer is built the way run_analyzer builds it (extra channels included), so the pursuit,
+       jump, pupil and preprocessing stages are timed too.
+    """
+    stages = {}
+    _, stages['load_xdf'] = timed(load_analyzer, file, cache='off')
+    _, stages['build_cache'] = timed(load_analyzer, file, cache='rebuild')
+    session, stages['load_cached'] = timed(load_analyzer, file, cache='use')
+    for stage in ('calculate_metrics', 'calculate_velocity', 'detect_events', 'calculate_frequency',
+                  'calculate_pursuit', 'calculate_jumps', 'calculate_pupil'):
+        _, stages[stage] = timed(getattr(session, stage))
+    _, stages['session_rows'] = timed(session_rows, session)
+    # Preprocessing runs while the Analyzer loads, its own profiled stage separates it from the load
+    profiler = Profiler()
+    load_analyzer(file, cache='use', profiler=profiler, preprocess=True)
+    stages['preprocess'] = profiler.stages['preprocess_gaze']['wall']
+
+    memory = {}
+    for name, cache in (('xdf', 'off'), ('cached', 'use')):
+        tracemalloc.start()
+        analyze_file(file, cache=cache)
+        memory[name] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {'seconds': stages, 'peak_bytes': memory}
+
+def bench_batch(directory: str, workers: int) -> dict:
+    """Wall time and peak worker memory of the whole batch runner, numbers only
+    """
+    before = _children_maxrss()
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run_analyzer.py'),
+               '--glob', os.path.join(directory, '*', '*.xdf'), '--workers', str(workers), '--render', 'off',
+               '--table', os.path.join(directory, 'results.csv')]
+    _, seconds = timed(subprocess.run, command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return {'seconds': seconds, 'max_rss_bytes': max(before, _children_maxrss())}
+
+def _children_maxrss() -> int:
+    try:
+        import resource
+    except ImportError: # Windows
+        return 0
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+
+def _commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+def bench_end_to_end(sizes: list, sample_rate: float, sessions: int, workers: int) -> dict:
+    """Generate synthetic recordings of each size, time every stage on one and the batch runner on all
+    """
+    record = {}
+    directory = tempfile.mkdtemp()
+    try:
+        for size in sizes:
+            size_dir = os.path.join(directory, f'{size:.0f}s')
+            files = [os.path.join(size_dir, f'pt_{i}', f'pt_{i}.xdf') for i in range(sessions)]
+            _, generate = timed(lambda: [write_session(file, duration=size, sample_rate=sample_rate, seed=i)
+                                         for i, file in enumerate(files)])
+            print(f"End to end on {sessions} x {size:.0f}s @ {sample_rate:.0f}Hz")
+            record[f'{size:.0f}s'] = bench_stages(files[0])
+            record[f'{size:.0f}s']['seconds']['generate'] = generate / sessions
+            for file in files: # the batch run should start from a cold cache
+                shutil.rmtree(os.path.splitext(file)[0] + '.cache', ignore_errors=True)
+            record[f'{size:.0f}s']['batch'] = bench_batch(size_dir, workers)
+
+            for stage, seconds in record[f'{size:.0f}s']['seconds'].items():
+                print(f"\t{stage}: {seconds:.3f}s")
+            for name, peak in record[f'{size:.0f}s']['peak_bytes'].items():
+                print(f"\tpeak memory ({name}): {peak / 2**20:.1f}MB")
+            batch = record[f'{size:.0f}s']['batch']
+            print(f"\tbatch ({workers} workers): {batch['seconds']:.2f}s, "
+                  f"max worker RSS {batch['max_rss_bytes'] / 2**20:.0f}MB")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return record
+
+def _flatten(record: dict, prefix: str = '') -> dict:
+    flat = {}
+    for key, value in record.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f'{prefix}{key}/'))
+        else:
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+def compare(record: dict, output: str) -> None:
+    """Compare against the last stored run with the same configuration and flag regressions
+    """
+    previous = None
+    if os.path.exists(output):
+        with open(output) as f:
+            for line in f:
+                stored = json.loads(line)
+                if stored['config'] == record['config']:
+                    previous = stored
+    if previous is None:
+        print("No earlier run with this configuration to compare against")
+        return
+
+    now, before = _flatten(record['results']), _flatten(previous['results'])
+    print(f"Compared with {previous['commit']} ({previous['time']}):")
+    for key in sorted(now):
+        if key in before and before[key] > 0:
+            ratio = now[key] / before[key]
+            flag = '  <-- REGRESSION' if ratio > REGRESSION_RATIO else ''
+            print(f"\t{key}: {ratio:.2f}x{flag}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the analysis pipeline on synthetic data")
+    parser.add_argument('--only', choices=('micro', 'e2e'), default=None,
+                        help="run only the micro benchmarks or only the end-to-end suite")
+    parser.add_argument('--sizes', type=float, nargs='+', default=[300, 1800],
+                        help="recording lengths (seconds) for the end-to-end suite")
+    parser.add_argument('--rate', type=float, default=200, help="gaze sample rate (Hz)")
+    parser.add_argument('--sessions', type=int, default=4, help="recordings per size for the batch runner")
+    parser.add_argument('--workers', type=int, default=2, help="batch runner workers")
+    parser.add_argument('--output', default='data/benchmarks.jsonl',
+                        help="where end-to-end results are appended, one JSON object per run")
+    args = parser.parse_args()
+
+    if args.only != 'e2e':
+        bench_metrics()
+        bench_markers()
+        bench_memory()
+        bench_frequency()
+        bench_events()
+        bench_render()
+
+    if args.only != 'micro':
+        record = {'time': datetime.now().isoformat(timespec='seconds'),
+                  'commit': _commit(),
+                  'config': {'sizes': args.sizes, 'rate': args.rate, 'sessions': args.sessions,
+                             'workers': args.workers},
+                  'results': bench_end_to_end(args.sizes, args.rate, args.sessions, args.workers)}
+        compare(record, args.output)
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -2,49 +2,76 @@
 # Author: scott.allan.stone@gmail.com (Scott Stone)
 from io import TextIOWrapper
 import pygame, os
+import argparse
+import json
+import time
 from pygame.locals import *
 from pylsl import StreamOutlet, StreamInfo
 from datetime import datetime
-import numpy as np
 from time import sleep
 import liesl
 from sys import exit
+from frame_scheduler import FrameScheduler
+from frame_log import FrameLog, SUB_PHASES
+from marker_dispatch import MarkerDispatcher
+from pylsl import local_clock
+from timeline import Timeline
+from frame_renderer import FrameRenderer
+from headless import KeyScript, FakeOutlet, FakeRecorder, KEY_RESPONSES
+from monitor import GazeMonitor
+from synthetic import SyntheticGazeOutlet
+from chunk_recorder import ChunkRecorder
+import timeline as protocol
+
+KEY_SCRIPT = None # scripted key presses for a headless run, see headless.py
+WAIT_TIMEOUT_MS = 100 # wait_for_space wakes up at least this often
+GAZE_MONITOR = None # live gaze quality from the Gaze stream, see monitor.py
 
 # "The Doctor with 2 Hands" vertigo stimulus presentation and recording program.
 # Check the README.md file for more information.
-def main():
+def main(size=None, fullscreen=True, stim_order=None, time_scale=1.0):
     '''
     Main function for the program
+    size, fullscreen, stim_order and time_scale are there for the headless mode: a fixed window size,
+    no fullscreen, every condition and shortened timings. Returns the frame timing of the run.
     '''
-    # Seed the random number generator
-    np.random.seed()
-
     # Setup the outgoing LSL stream - this is the flags stream to mark which task is being performed
-    outlet.push_sample(['stimulus_begin'])
+    # Markers are sent from a background thread, stamped with the flip that shows their stimulus
+    markers = MarkerDispatcher(outlet)
+    markers.push('stimulus_begin')
 
     # Initialization of PyGame
     pygame.init()
-    window_w = pygame.display.Info().current_w
-    window_h = pygame.display.Info().current_h
-    size = WIDTH, HEIGHT = window_w, window_h
-    screen = pygame.display.set_mode(size=size, flags=pygame.FULLSCREEN | pygame.HWSURFACE) # 
+    if size is None:
+        size = pygame.display.Info().current_w, pygame.display.Info().current_h
+    WIDTH, HEIGHT = size
+    screen = pygame.display.set_mode(size=size, flags=pygame.FULLSCREEN | pygame.HWSURFACE if fullscreen else 0)
     pygame.mouse.set_visible(False)
     pygame.display.flip()
     pygame.display.set_caption("Stimulus")
-    surface = pygame.Surface((WIDTH,HEIGHT), pygame.SRCALPHA) # For drawing transparent circles
     FPS = 60 
-    clock = pygame.time.Clock()
-    clock.tick(FPS)
+    scheduler = FrameScheduler(FPS) # sleep-then-spin frame pacing, see frame_scheduler.py
+    scheduler.tick()
+    frame_log = FrameLog(FPS) # when every frame was really presented, see frame_log.py
+    frame_log_file = "data/" + subject_name + "/" + subject_name + "_frames.bin"
 
     # PyGame font 
     pygame.font.init()
     font = pygame.font.SysFont('courier.ttf', 36)
 
     # Constants
-    BRIGHTNESS_TRIAL_LENGTH = 10 # This can be shorter than the main trial length
-    SCREEN_CENTRE = (WIDTH/2, HEIGHT/2)
     #STIM_ORDER = ['stare', 'pursuit', 'vor', 'jump', 'brightness']
     STIM_ORDER = ['vor', 'jump', 'brightness']
+    if stim_order is not None:
+        STIM_ORDER = list(stim_order)
+    RENDER_MODE = 'dirty' # only repaint where the target moved; 'full' redraws the whole screen every frame
+
+    # Compile every condition to per-frame arrays up front (see timeline.py) and keep them with the recording
+    timeline = Timeline(WIDTH, HEIGHT, FPS, STIM_ORDER, time_scale=time_scale)
+    timeline.save("data/" + subject_name + "/" + subject_name + "_timeline.npz")
+    renderer = FrameRenderer(screen, mode=RENDER_MODE)
+    trials = {} # frame summary of every trial
+    render_time = 0.0 # seconds spent drawing and presenting frames
     
     '''
     Main execution loop
@@ -65,23 +92,62 @@ def main():
             Resets the screen to black
             '''
             screen.fill((0,0,0))
-            surface.fill((0,0,0))   
+            renderer.invalidate()
         
-        def draw_fixation_cross(centre=SCREEN_CENTRE, color=(255,255,255)):
+        def draw_frame(shape, x, y, colour, background):
+            '''
+            Inline:
+            Draw one compiled timeline frame (a fixation cross or target dot, see frame_renderer.py)
+            '''
+            renderer.draw(shape, x, y, colour, background)
+            # NOTE: This is debug info - set using $DEBUG_FLAG
+            if DEBUG_FLAG:
+                img = font.render(stim, True, (255, 255, 255))
+                txt_rect = img.get_rect(center=(WIDTH/2, HEIGHT/2 - 0.4*HEIGHT))
+                screen.blit(img, txt_rect)
+                renderer.invalidate()
+
+        def flip():
             '''
             Inline:
-            Draw a white cross at the centre of the coordinates given
-            You can change the color by passing a tuple of colors in RGB
+            Present the frame, log when it went up and stamp the markers waiting for it
             '''
-            LINE_LENGTH = 10
-            start_pos_h = (centre[0], centre[1]-LINE_LENGTH)
-            end_pos_h = (centre[0], centre[1]+LINE_LENGTH)
-            start_pos_v = (centre[0]-LINE_LENGTH, centre[1])
-            end_pos_v = (centre[0]+LINE_LENGTH, centre[1])
+            renderer.present()
+            flip_time = local_clock()
+            frame_log.record(scheduler.frame_count, flip_time)
+            markers.flipped(flip_time)
 
-            # Draw the cross
-            pygame.draw.line(screen, color, start_pos_h, end_pos_h, 4)
-            pygame.draw.line(screen, color, start_pos_v, end_pos_v, 4)
+        def wait():
+            '''
+            Inline:
+            Wait for the experimenter, then restart frame pacing from now
+            '''
+            wait_for_space()
+            scheduler.sync()
+            frame_log.resume()
+
+        def play(segment):
+            '''
+            Inline:
+            Present a compiled condition: draw only the frames that change, hold the rest,
+            and send every marker with the flip that shows it
+            '''
+            nonlocal render_time
+            frame_log.phase(segment.name)
+            for f, hold, (shape, x, y, colour, background, sub_phase) in \
+                    zip(segment.draw_frames.tolist(), segment.hold_frames.tolist(), segment.draws):
+                for label in segment.markers.get(f, ()):
+                    if label != segment.name:
+                        print("\t-" + label)
+                    markers.on_flip(label)
+                frame_log.phase(sub_phase=SUB_PHASES[sub_phase])
+                start_time = time.perf_counter()
+                draw_frame(shape, x, y, colour, background)
+                flip()
+                render_time += time.perf_counter() - start_time
+                scheduler.hold(hold / FPS)
+            for label in segment.markers.get(len(segment), ()):
+                markers.push(label)
 
         # Let the experimenter know the stimulus is loaded and up and running
         text = font.render("Stimulus loaded. Press space to begin ...", True, (255, 255, 255))
@@ -89,7 +155,7 @@ def main():
         screen.blit(text, txt_rect)
 
         pygame.display.flip()
-        wait_for_space()
+        wait()
         clear_screen()
         
         for stim in STIM_ORDER:
@@ -101,330 +167,84 @@ def main():
             jump         :      pt follows target. it will jump left / right.
             brightness   :      pt looks at target and holds gaze for few seconds. brightness inverts.
             '''
-            clear_screen()
-            # NOTE: This is debug info - set using $DEBUG_FLAG
-            if DEBUG_FLAG:
-                img = font.render(stim, True, (255, 255, 255))
-                txt_rect = img.get_rect(center=(WIDTH/2, HEIGHT/2 - 0.4*HEIGHT))
-                screen.blit(img, txt_rect)
-            
-            '''
-            Stare condition
-            '''
-            if stim == 'stare':
-                # NOTE: This draws a dot on the screen for 20s, then ends. Very simple.
-                STARE_TIME = 20 # seconds
-                STARE_FRAMES = STARE_TIME * FPS
-
-                print(str(stim))
-                outlet.push_sample([stim])
-                draw_fixation_cross()
-                pygame.display.flip()
-
-                for _ in range(0, STARE_FRAMES):
-                    clock.tick(FPS)
-
-            '''
-            Pursuit condition
-            '''
-            if stim == 'pursuit':
-                # NOTE: Draws a dot and moves left / right for ~20s.
-                # NOTE: left/right left-hold 5 right-hold 5
-                # NOTE: do the same for up/down
-                print(stim)
-                outlet.push_sample([stim])
-                #create_data_csv(stim)
-
-                # Extremes for how far our dot can move
-                L_EDGE = WIDTH * 0.1          
-                R_EDGE = WIDTH - (WIDTH * 0.1)
-                T_EDGE = HEIGHT * 0.1
-                B_EDGE = HEIGHT - (HEIGHT * 0.1)
-                CENTRE_X = WIDTH / 2
-                CENTRE_Y = HEIGHT / 2
-
-                # Dot parameters
-                TARG_SIZE = 20  # pixels
-                HOLD_TIME = 3   # seconds
-                TRAVEL_TIME = 2 # seconds ( to get to the end position at a constant velocity )
-                TRAVEL_FRAMES = TRAVEL_TIME * FPS
-                ONE_SEC_FRAMES = FPS
-                HOLD_FRAMES = HOLD_TIME * FPS
-                HOLD_FLAG = False
-                order = ('left', 'right_centre', 'right', 'left_centre',
-                         'left_hold', 'right_centre', 'right_hold', 'left_centre', 
-                         'top', 'bottom_centre', 'bottom', 'top_centre',
-                         'top_hold', 'bottom_centre', 'bottom_hold', 'top_centre')
-                
-                for dir in order:
-                    # Push the sample over LSL
-                    outlet.push_sample(["pursuit_" + dir + "_start"])
-                    print("\t-" + dir + ":" + str(HOLD_FLAG))
-                    HOLD_FLAG = False # hard reset
-
-                    if "_hold" in dir:
-                        HOLD_FLAG = True
-                    else:
-                        HOLD_FLAG = False
-
-                    if dir == 'left':
-                        '''
-                        Move to the left from centre
-                        '''
-                        # Calculate the X values before hand since we can't move sub-pixel at a time
-                        pos_trajectory_x = np.round(np.linspace(CENTRE_X, L_EDGE, TRAVEL_FRAMES))
-                        pos_trajectory_y = np.ones(len(pos_trajectory_x)) * CENTRE_Y
-                        pos = [pos_trajectory_x, pos_trajectory_y]
-                        HOLD_FLAG = False
-
-                    if dir == 'right_centre':
-                        '''
-                        Move back to centre rightwards
-                        '''
-                        # Calculate the X values before hand since we can't move sub-pixel at a time
-                        pos_trajectory_x = np.round(np.linspace(L_EDGE, CENTRE_X, TRAVEL_FRAMES))
-                        pos_trajectory_y = np.ones(len(pos_trajectory_x)) * CENTRE_Y
-                        pos = [pos_trajectory_x, pos_trajectory_y]
-
-                    if dir == 'right':
-                        '''
-                        Move to the right from centre
-                        '''
-                        # Calculate the X values before hand since we can't move sub-pixel at a time
-                        pos_trajectory_x = np.round(np.linspace(CENTRE_X, R_EDGE, TRAVEL_FRAMES))
-                        pos_trajectory_y = np.ones(len(pos_trajectory_x)) * CENTRE_Y
-                        pos = [pos_trajectory_x, pos_trajectory_y]
-
-                    if dir == 'left_centre':
-                        '''
-                        Move back to centre leftwards
-                        '''
-                        # Calculate the X values before hand since we can't move sub-pixel at a time
-                        pos_trajectory_x = np.round(np.linspace(R_EDGE, CENTRE_X, TRAVEL_FRAMES))
-                        pos_trajectory_y = np.ones(len(pos_trajectory_x)) * CENTRE_Y
-                        pos = [pos_trajectory_x, pos_trajectory_y]
-
-                    if dir == 'left_hold':
-                        '''
-                        Go to the leftmost side and hold for $HOLD_TIME (default: 3) seconds
-                        '''
-                        # Calculate the X values before hand since we can't move sub-pixel at a time
-                        pos_trajectory_x = np.round(np.linspace(CENTRE_X, L_EDGE, TRAVEL_FRAMES))
-                        pos_trajectory_y = np.ones(len(pos_trajectory_x)) * CENTRE_Y
-                        pos = [pos_trajectory_x, pos_trajectory_y]
-
-                    if dir == 'right_hold':
-                        # Calculate the X values before hand since we can't move sub-pixel at a time
-                        pos_trajectory_x = np.round(np.linspace(CENTRE_X, R_EDGE, TRAVEL_FRAMES))
-                        pos_trajectory_y = np.ones(len(pos_trajectory_x)) * CENTRE_Y
-                        pos = [pos_trajectory_x, pos_trajectory_y]
-
-                    if dir == 'top':
-                        '''
-                        Move to the top from centre
-                        '''
-                        # Calculate the X values before hand since we can't move sub-pixel at a time
-                        pos_trajectory_y = np.round(np.linspace(CENTRE_Y, T_EDGE, TRAVEL_FRAMES))
-                        pos_trajectory_x = np.ones(len(pos_trajectory_y)) * CENTRE_X
-                        pos = [pos_trajectory_x, pos_trajectory_y]
-
-                    if dir == 'bottom_centre':
-                        '''
-                        Move to the centre downwards from the top
-                        '''
-                        # Calculate the X values before hand since we can't move sub-pixel at a time
-                        pos_trajectory_y = np.round(np.linspace(T_EDGE, CENTRE_Y, TRAVEL_FRAMES))
-                        pos_trajectory_x = np.ones(len(pos_trajectory_y)) * CENTRE_X
-                        pos = [pos_trajectory_x, pos_trajectory_y]
-
-                    if dir == 'bottom':
-                        '''
-                        Move to the bottom from the centre
-                        '''
-                        # Calculate the X values before hand since we can't move sub-pixel at a time
-                        pos_trajectory_y = np.round(np.linspace(CENTRE_Y, B_EDGE, TRAVEL_FRAMES))
-                        pos_trajectory_x = np.ones(len(pos_trajectory_y)) * CENTRE_X
-                        pos = [pos_trajectory_x, pos_trajectory_y]
-
-                    if dir == 'top_centre':
-                        '''
-                        Move to the centre from bottom upwards
-                        '''
-                        # Calculate the X values before hand since we can't move sub-pixel at a time
-                        pos_trajectory_y = np.round(np.linspace(B_EDGE, CENTRE_Y, TRAVEL_FRAMES))
-                        pos_trajectory_x = np.ones(len(pos_trajectory_y)) * CENTRE_X
-                        pos = [pos_trajectory_x, pos_trajectory_y]
-
-                    if dir == 'top_hold':
-                        '''
-                        Move to the top upwards and hold
-                        '''
-                        # Calculate the X values before hand since we can't move sub-pixel at a time
-                        pos_trajectory_y = np.round(np.linspace(CENTRE_Y, T_EDGE, TRAVEL_FRAMES))
-                        pos_trajectory_x = np.ones(len(pos_trajectory_y)) * CENTRE_X
-                        pos = [pos_trajectory_x, pos_trajectory_y]
-                            
-
-                    if dir == 'bottom_hold':
-                        '''
-                        Move to the bottom downwards and hold
-                        '''
-                        # Calculate the X values before hand since we can't move sub-pixel at a time
-                        pos_trajectory_y = np.round(np.linspace(CENTRE_Y, B_EDGE, TRAVEL_FRAMES))
-                        pos_trajectory_x = np.ones(len(pos_trajectory_y)) * CENTRE_X
-                        pos = [pos_trajectory_x, pos_trajectory_y]
-
-                    ''' 
-                    Animate the dot
-                    '''
-                    for f in range(0, TRAVEL_FRAMES):
-                        curr_pos = (int(pos[0][f]), int(pos[1][f]))
-                        pygame.draw.circle(screen, (255,255,255), curr_pos, TARG_SIZE, 0)
-                        pygame.display.flip()
-                        clear_screen()
-                        clock.tick(FPS)
-
-                    # Check if we should hold
-                    if HOLD_FLAG is True:
-                        for _ in range(0, int(HOLD_FRAMES)):
-                            clock.tick(FPS)
-                    elif HOLD_FLAG is False:
-                        for _ in range(0, int(ONE_SEC_FRAMES/2)):
-                            clock.tick(FPS)
-                        
-                    outlet.push_sample(["pursuit_" + dir + "_end"])
-        
-            '''
-            VOR condition
-            '''       
-            if stim == 'vor':
-                # NOTE: Patient keeps gaze steady on target, rotates head while maintaining fixation. Same as 'stare'
-                
-                print(stim)
-                outlet.push_sample([stim])
-                #create_data_csv(stim)
-                draw_fixation_cross()
-                pygame.display.flip()
-                
-                # The user picks how long they want to do this one
-                wait_for_space()
-
-                # Add the ability to redo the trial
-                global REDO_TRIAL
-                if REDO_TRIAL == True:
-                    REDO_TRIAL = False
-                    print('Redoing trial: vor')
-                    outlet.push_sample(["redo_trial"])
-                    outlet.push_sample([stim])
-                    draw_fixation_cross()
-                    pygame.display.flip()
-                    wait_for_space()
-
-            '''
-            Jump condition
-            '''
-            if stim == 'jump':
-                # NOTE: Target appears on left, then disappears and reappears on the right. This is statically set, but
-                #  the amount of time between the jumps is dynamic and determined at runtime.
-                
-                print(stim)
-                outlet.push_sample([stim])
-                #create_data_csv(stim)
-                draw_fixation_cross()
-
-                # Order of where the stimulus hops to
-                MIN_S = 0.5
-                MAX_S = 1.5
-                order = ('cross', 'left', 'cross', 'right', 'cross', 'left', 'cross', 'right', 'cross', 'left', 'cross', 'right', 'cross', 'left', 'cross', 'right', 'cross')
-                N_JUMPS = len(order)
-                target_times = [np.random.uniform(MIN_S, MAX_S) for i in range(N_JUMPS)]
-                target_times[0] = 3 # first one should be 3s
-                # At the beginning, there is a 3s buffer time to when the target first appears on the left. 
-                # They will need to fixate on the target cross, and a dot will show up.
-                # After that the target will appear to 2s, then the subject shifts back to the centre cross for ~3s.
-                # Then a target shows up on the right for 2s
-                for i in range(0, len(order)):
-                    if order[i] == 'cross':
-                        outlet.push_sample(['jump_cross'])
-                        draw_fixation_cross()
-
-                    if order[i] == 'left':
-                        outlet.push_sample(['jump_left'])
-                        pygame.draw.circle(screen, (255,255,255), (int(WIDTH/20), int(HEIGHT/2)), 20)
-
-                    if order[i] == 'right':
-                        outlet.push_sample(['jump_right'])
-                        pygame.draw.circle(screen, (255,255,255), (int(WIDTH-WIDTH/20), int(HEIGHT/2)), 20)
-                    
-                    pygame.display.flip()
-                    # Hold it for however long target_times[i] says
-                    jump_start_time = pygame.time.get_ticks()
-                    while (pygame.time.get_ticks() - jump_start_time) / 1000 <= target_times[i]:
-                        pass
-                    
-                    clear_screen()
-
-                pygame.draw.circle(surface, (255,255,255), (int(WIDTH/2), int(HEIGHT/2)), 20, 0)
-                pygame.display.flip()
-
-            
-            '''
-            Brightness condition
-            '''
-            if stim == 'brightness':
+            global REDO_TRIAL
+            segment = timeline[stim]
+            while True:
+                clear_screen()
                 print(stim)
+                if GAZE_MONITOR is not None:
+                    GAZE_MONITOR.reset_trial()
+                play(segment)
+
+                # Conditions that wait on the experimenter can be redone
+                if segment.wait:
+                    wait()
+                    if REDO_TRIAL == True:
+                        REDO_TRIAL = False
+                        print('Redoing trial: ' + stim)
+                        markers.push("redo_trial")
+                        play(segment)
+                        wait()
+
+                colour = (0, 0, 0) if stim == 'brightness' else (255, 255, 255)
+                img = font.render("Trial over! Hit spacebar to continue.", True, colour)
+                txt_rect = img.get_rect(center=(WIDTH/2, HEIGHT/2 + 0.4*HEIGHT))
+                screen.blit(img, txt_rect)
+                # The live gaze monitor says the eye tracker lost the eyes too often: offer a redo
+                poor_gaze = GAZE_MONITOR is not None and GAZE_MONITOR.poor_trial()
+                if poor_gaze:
+                    img = font.render("Poor gaze tracking! Hit R then spacebar to redo.", True, colour)
+                    txt_rect = img.get_rect(center=(WIDTH/2, HEIGHT/2 + 0.45*HEIGHT))
+                    screen.blit(img, txt_rect)
+                renderer.invalidate()
+                flip()
+                markers.push(stim + "_end")
+                frame_summary = frame_log.flush(frame_log_file)
+                frame_summary['poor_gaze'] = poor_gaze
+                trials[stim] = frame_summary
+                print(f"\t-frames: {frame_summary}")
+                if GAZE_MONITOR is not None:
+                    print(f"\t-gaze: {GAZE_MONITOR.quality}")
+                wait()
+
+                # Any trial can be redone from its trial over screen
+                if REDO_TRIAL == False:
+                    break
+                REDO_TRIAL = False
+                print('Redoing trial: ' + stim)
+                markers.push("redo_trial")
 
-                BRIGHTNESS_FRAMES = BRIGHTNESS_TRIAL_LENGTH * FPS
-
-                outlet.push_sample([stim])
-                #create_data_csv(stim)
-                draw_fixation_cross()
-
-                for i in range(0, BRIGHTNESS_FRAMES):
-                    clock.tick(FPS)
-                    if i >= BRIGHTNESS_FRAMES/2:
-                        screen.fill((255, 255, 255))
-                        draw_fixation_cross(color=(0,0,0))
-                    if i == BRIGHTNESS_FRAMES/2:
-                        print("\t-brightness_high")
-                        outlet.push_sample(["brightness_high"])
-                    
-                    pygame.display.flip()
-
-            if stim == 'brightness':
-                img = font.render("Trial over! Hit spacebar to continue.", True, (0, 0, 0))  
-            else:
-                img = font.render("Trial over! Hit spacebar to continue.", True, (255, 255, 255))   
-                
-            txt_rect = img.get_rect(center=(WIDTH/2, HEIGHT/2 + 0.4*HEIGHT))
-            screen.blit(img, txt_rect)
-            pygame.display.flip()
-            outlet.push_sample([stim + "_end"])
-            wait_for_space()
-        
         # NOTE: once we get here, we've finished the experiment.
         RUNNING = False
+        print(f"Frame timing: {scheduler.report()}")
+        markers.close()
+
+    drawn = sum(trial['frames'] for trial in trials.values())
+    return {'scheduler': scheduler.report(), 'trials': trials,
+            'render_ms_per_frame': 1000 * render_time / max(1, drawn)}
 
 def wait_for_space():
     ''' 
     Wait for the user to press the spacebar before continuing.
     Used between trials.
-    TODO: add an ability to redo the current trial: currently not working
     '''
     global REDO_TRIAL
+    if KEY_SCRIPT is not None:
+        KEY_SCRIPT.post()
     KEY_NOT_PRESSED = True
     while KEY_NOT_PRESSED:
-        for event in pygame.event.get():
-            if event.type == KEYDOWN and event.key == K_SPACE:
-                KEY_NOT_PRESSED = False
-            if event.type == KEYDOWN and event.key == K_r:
-                REDO_TRIAL = True
-
-def generate_subject_name(date: datetime):
+        # Sleep until the next event instead of polling, this runs for as long as the experimenter waits
+        event = pygame.event.wait(WAIT_TIMEOUT_MS)
+        if event.type == KEYDOWN and event.key == K_SPACE:
+            KEY_NOT_PRESSED = False
+        if event.type == KEYDOWN and event.key == K_r:
+            REDO_TRIAL = True
+
+def generate_subject_name(date: datetime, prefix: str = "pt_"):
     '''
     Generate a subject name based on the current date / time
     '''
-    return "pt_" + str(date.year) + "-" + str(date.month) + "-" + str(date.day) + "_" + str(date.hour) + "-" + str(date.minute) + "-" +  str(date.second)
+    return prefix + str(date.year) + "-" + str(date.month) + "-" + str(date.day) + "_" + str(date.hour) + "-" + str(date.minute) + "-" +  str(date.second)
 
 def create_data_csv(name):
     '''
@@ -455,34 +275,68 @@ def write_data_csv(file: TextIOWrapper, data):
     return 1
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Present the stimulus and record it")
+    parser.add_argument('--headless', action='store_true',
+                        help="no display, eye tracker or experimenter: SDL dummy driver, scripted keys, "
+                             "fake marker outlet and recorder. Runs every condition and writes the frame and "
+                             "marker logs, for automated timing tests")
+    parser.add_argument('--time-scale', type=float, default=1.0,
+                        help="shorten every timed part of the protocol by this factor (headless runs)")
+    parser.add_argument('--keys', nargs='*', default=[], choices=tuple(KEY_RESPONSES),
+                        help="the scripted experimenter's response at each wait, then 'space' (headless runs)")
+    parser.add_argument('--size', type=int, nargs=2, default=(1920, 1080), help="window size (headless runs)")
+    parser.add_argument('--synthetic-gaze', action='store_true',
+                        help="serve a synthetic Gaze stream for the gaze monitor (headless runs)")
+    args = parser.parse_args()
+
     # Do some house cleaning around the current subject
     # Create their folder in the "data/" directory
     global REDO_TRIAL
     REDO_TRIAL = False
     DEBUG_FLAG = False
+    if args.headless:
+        os.environ['SDL_VIDEODRIVER'] = 'dummy'
+        KEY_SCRIPT = KeyScript(args.keys)
 
     if not os.path.exists('data'):
         print("No data folder found. Creating one ...")
         os.mkdir("data")
 
     # Generate a subject name based on today's date & time
-    subject_name = generate_subject_name(datetime.now())
+    subject_name = generate_subject_name(datetime.now(), prefix="headless_" if args.headless else "pt_")
     os.mkdir("data/" + subject_name)
     print("Created subject folder " + subject_name + "/ in data/")
 
     # LSL outlet
-    info = StreamInfo('Stimulus_Markers', 'Marker', 1, 0, 'string', 'stim-prog-1')
-    outlet = StreamOutlet(info)
+    if args.headless:
+        outlet = FakeOutlet()
+    else:
+        info = StreamInfo('Stimulus_Markers', 'Marker', 1, 0, 'string', 'stim-prog-1')
+        outlet = StreamOutlet(info)
     print("Setting up LSL stream ..")
 
     # Using LieSL to record XDF data
-    r = liesl.Recorder()
+    r = FakeRecorder() if args.headless else liesl.Recorder()
 
     # Change the save location to be in this folder
     r.bind([{"type":"Gaze"},{"type":"Marker"}])
     r.start_recording(filename="data/" + subject_name + "/" + subject_name + ".xdf")
     print("Started recording on LabRecorder ...")
 
+    # Watch the gaze stream live so bad trials can be redone straight away
+    gaze_outlet = SyntheticGazeOutlet().start() if args.headless and args.synthetic_gaze else None
+    if not args.headless or gaze_outlet is not None:
+        GAZE_MONITOR = GazeMonitor.connect(timeout=3, preprocess={})
+        if GAZE_MONITOR is None:
+            print("No Gaze stream found, running without the gaze monitor")
+        else:
+            GAZE_MONITOR.start()
+
+    # Also record in-process, in fixed-size blocks that survive a crash: data/<subject>/<subject>.chunks/
+    chunks = FakeRecorder() if args.headless and gaze_outlet is None else ChunkRecorder()
+    chunks.bind([{"type":"Gaze"},{"type":"Marker"}])
+    chunks.start_recording(filename="data/" + subject_name + "/" + subject_name + ".xdf")
+
     # Check if consumer is connected
     outlet.wait_for_consumers(3)
     while outlet.have_consumers() is False:
@@ -491,12 +345,28 @@ if __name__ == '__main__':
     
     # Run the main script
     print('Starting PyGame backend ...')
-    main() # Main entry point
+    if args.headless:
+        timing = main(size=tuple(args.size), fullscreen=False, stim_order=protocol.STIM_ORDER,
+                      time_scale=args.time_scale)
+    else:
+        timing = main() # Main entry point
     outlet.push_sample(['stimulus_end'])
     
+    if GAZE_MONITOR is not None:
+        GAZE_MONITOR.stop()
+    if gaze_outlet is not None:
+        gaze_outlet.stop()
+
     # Stop recording
     print("Stopping LSL recording ...")
     r.stop_recording()
+    chunks.stop_recording()
     sleep(0.5)
 
+    if args.headless:
+        outlet.save("data/" + subject_name + "/" + subject_name + "_markers.csv")
+        with open("data/" + subject_name + "/" + subject_name + "_timing.json", 'w') as f:
+            json.dump(timing, f, indent=2)
+        print(f"Headless run written to data/{subject_name}/")
+
     print("Stopped. Safe to close!")
\ No newline at end of file
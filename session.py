@@ -0,0 +1,234 @@
+# Copyright 2022
+# Author: scott.allan.stone@gmail.com (Scott Stone)
+import hashlib
+import json
+import os
+import numpy as np
+
+CACHE_VERSION = 3
+CACHE_MODES = ('use', 'rebuild', 'off')
+GAZE_COLUMNS = (-4, -3, -2, -1) # the columns Analyzer treats as (x_0, y_0, x_1, y_1)
+# Channel layout of the pupil_capture LSL stream (same as the header in run_stimulus.create_data_csv)
+PUPIL_CAPTURE_CHANNELS = ('confidence', 'norm_pos_x', 'norm_pos_y',
+                          'gaze_point_3d_x', 'gaze_point_3d_y', 'gaze_point_3d_z',
+                          'eye_0_center_x', 'eye_0_center_y', 'eye_0_center_z',
+                          'eye_1_center_x', 'eye_1_center_y', 'eye_1_center_z',
+                          'gaze_normal_3d_eye_0_x', 'gaze_normal_3d_eye_0_y', 'gaze_normal_3d_eye_0_z',
+                          'gaze_normal_3d_eye_1_x', 'gaze_normal_3d_eye_1_y', 'gaze_normal_3d_eye_1_z',
+                          'diameter_2d_eye_0', 'diameter_2d_eye_1',
+                          'diameter_3d_eye_0', 'diameter_3d_eye_1')
+
+class Stream:
+    """Minimal stand-in for a liesl stream: just the samples and their timestamps
+    """
+    def __init__(self, time_series, time_stamps: np.ndarray):
+        self.time_series = time_series
+        self.time_stamps = time_stamps
+
+    def __len__(self) -> int:
+        return len(self.time_stamps)
+
+class Session:
+    """The parts of one recording that Analyzer needs: the marker stream, the selected gaze columns
+       and the gaze sample rate.
+    """
+    def __init__(self, markers: Stream, gaze: Stream, sample_rate: float, columns: tuple):
+        self.markers = markers
+        self.gaze = gaze
+        self.sample_rate = sample_rate
+        self.columns = tuple(columns)
+
+    def release_gaze(self) -> None:
+        """Drop the gaze stream (and its memory map) once everything needed has been copied out of it
+        """
+        self.gaze = None
+
+def resolve_columns(channels: tuple, layout: tuple = PUPIL_CAPTURE_CHANNELS) -> tuple:
+    """Turn a mix of channel names and column indices into column indices.
+       Names are looked up in the pupil_capture channel layout.
+    """
+    columns = []
+    for channel in channels:
+        if isinstance(channel, str):
+            if channel not in layout:
+                raise ValueError(f"Unknown channel {channel!r}, expected one of {layout}")
+            columns.append(layout.index(channel))
+        else:
+            columns.append(int(channel))
+    return tuple(columns)
+
+def project_columns(time_series: np.ndarray, columns: tuple, dtype=None) -> np.ndarray:
+    """Copy the selected columns into a new contiguous array, one column at a time so no full-width
+       temporary is made
+    """
+    time_series = np.asarray(time_series)
+    projected = np.empty((len(time_series), len(columns)), dtype=dtype or time_series.dtype)
+    for i, column in enumerate(columns):
+        projected[:, i] = time_series[:, column]
+    return projected
+
+def _dtype_name(dtype) -> str:
+    return None if dtype is None else np.dtype(dtype).name
+
+def cache_dir(file: str) -> str:
+    """The cache for data/pt_x/pt_x.xdf lives in data/pt_x/pt_x.cache/
+    """
+    return os.path.splitext(file)[0] + '.cache'
+
+def cache_entry(file: str, stimulus_marker_name: str, gaze_name: str, columns: tuple, dtype=None) -> str:
+    """One cache directory per selection of streams, columns and dtype, inside cache_dir(file), so
+       loading different columns (run_analyzer, cohort.build_cohort, run_benchmark) never evicts another
+    """
+    key = json.dumps([stimulus_marker_name, gaze_name, list(columns), _dtype_name(dtype)])
+    return os.path.join(cache_dir(file), hashlib.blake2b(key.encode(), digest_size=6).hexdigest())
+
+def file_hash(file: str, block_size: int = 1 << 20) -> str:
+    """Content hash of a file, read in blocks so it never holds the whole file in memory
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def read_xdf(file: str,
+             stimulus_marker_name: str,
+             gaze_name: str,
+             columns: tuple = GAZE_COLUMNS,
+             dtype=None) -> Session:
+    """Parse the XDF file and keep only what the analysis uses: the selected gaze columns (optionally
+       downcast to dtype). The parsed file is dropped before returning, so the full stream is only
+       in memory while parsing.
+       This lowers what is retained, not the peak: liesl parses the whole stream (every channel, in
+       its recorded format) before any column can be dropped, and the projection briefly sits next to
+       it. Only loading from the cache (load_session) keeps the full stream out of memory.
+    """
+    import liesl # only needed when the cache can't be used
+
+    data = liesl.XDFFile(file, verbose=True) # verbose is broken
+    markers, gaze = data[stimulus_marker_name], data[gaze_name]
+    labels = np.array([marker[0] for marker in markers.time_series], dtype=str)
+    session = Session(markers=Stream(labels, np.asarray(markers.time_stamps, dtype=np.float64)),
+                      gaze=Stream(project_columns(gaze.time_series, columns, dtype),
+                                  np.asarray(gaze.time_stamps, dtype=np.float64)),
+                      sample_rate=float(gaze._stream['info']['effective_srate']),
+                      columns=columns)
+    # liesl memoises XDFStream properties in class-level lru_caches keyed by the stream, which would keep
+    # the last stream parsed (every sample of it) alive until the next file
+    for attribute in vars(type(gaze)).values():
+        if isinstance(attribute, property) and hasattr(attribute.fget, 'cache_clear'):
+            attribute.fget.cache_clear()
+    return session
+
+def _cache_meta(file: str, stimulus_marker_name: str, gaze_name: str, columns: tuple, dtype=None) -> dict:
+    stat = os.stat(file)
+    return {'version': CACHE_VERSION,
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'stimulus_marker_name': stimulus_marker_name,
+            'gaze_name': gaze_name,
+            'columns': list(columns),
+            'dtype': _dtype_name(dtype)}
+
+def _cache_is_valid(file: str, meta: dict, expected: dict) -> bool:
+    """A cache entry is valid if it was made from the same streams of a file with the same size and
+       either the same mtime or (if the file was touched / copied) the same content hash
+    """
+    for key in ('version', 'size', 'stimulus_marker_name', 'gaze_name', 'columns', 'dtype'):
+        if meta.get(key) != expected[key]:
+            return False
+    if meta.get('mtime_ns') == expected['mtime_ns']:
+        return True
+    return meta.get('hash') == file_hash(file)
+
+def _replace_file(path: str, write) -> None:
+    """Write to a temporary file next to path and move it into place, so a process that has the old
+       file memory-mapped keeps reading the old one and nobody ever sees a half-written file
+    """
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        write(f)
+    os.replace(tmp, path)
+
+def write_cache(file: str, session: Session, stimulus_marker_name: str, gaze_name: str, dtype=None) -> None:
+    """Write the session as .npy files in its cache_entry. meta.json is written last, so an
+       interrupted write is never mistaken for a valid cache.
+    """
+    directory = cache_entry(file, stimulus_marker_name, gaze_name, session.columns, dtype)
+    os.makedirs(directory, exist_ok=True)
+    meta_file = os.path.join(directory, 'meta.json')
+    if os.path.exists(meta_file):
+        os.remove(meta_file)
+
+    arrays = {'gaze_time_stamps': session.gaze.time_stamps, 'gaze_time_series': session.gaze.time_series,
+              'marker_time_stamps': session.markers.time_stamps, 'marker_labels': session.markers.time_series}
+    for name, array in arrays.items():
+        _replace_file(os.path.join(directory, name + '.npy'), lambda f: np.save(f, array))
+
+    meta = _cache_meta(file, stimulus_marker_name, gaze_name, session.columns, dtype)
+    meta['hash'] = file_hash(file)
+    meta['sample_rate'] = session.sample_rate
+    _replace_file(meta_file, lambda f: f.write(json.dumps(meta, indent=2).encode()))
+
+def read_cache(file: str,
+               stimulus_marker_name: str,
+               gaze_name: str,
+               columns: tuple = GAZE_COLUMNS,
+               dtype=None) -> Session:
+    """Load a session from its cache, memory-mapped. Returns None if there is no valid cache.
+    """
+    directory = cache_entry(file, stimulus_marker_name, gaze_name, columns, dtype)
+    meta_file = os.path.join(directory, 'meta.json')
+    if not os.path.exists(meta_file):
+        return None
+
+    with open(meta_file) as f:
+        meta = json.load(f)
+    expected = _cache_meta(file, stimulus_marker_name, gaze_name, columns, dtype)
+    if not _cache_is_valid(file, meta, expected):
+        return None
+
+    if meta['mtime_ns'] != expected['mtime_ns']:
+        # Same content, new mtime: remember it so the hash isn't needed next time
+        meta['mtime_ns'] = expected['mtime_ns']
+        _replace_file(meta_file, lambda f: f.write(json.dumps(meta, indent=2).encode()))
+
+    def load(name):
+        return np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+
+    return Session(markers=Stream(load('marker_labels'), load('marker_time_stamps')),
+                   gaze=Stream(load('gaze_time_series'), load('gaze_time_stamps')),
+                   sample_rate=meta['sample_rate'],
+                   columns=columns)
+
+def load_session(file: str,
+                 stimulus_marker_name: str,
+                 gaze_name: str,
+                 columns: tuple = GAZE_COLUMNS,
+                 dtype=None,
+                 cache: str = 'use') -> Session:
+    """Load a session, going through the on-disk cache.
+       Only `columns` of the gaze stream are kept (names or indices, see resolve_columns), converted
+       to dtype (e.g. np.float32) if given. Every selection of columns and dtype has its own cache entry.
+       cache='use' reads a valid cache or builds it, 'rebuild' always re-parses the XDF and
+       rewrites the cache, 'off' parses the XDF and never touches the cache.
+       A .chunks directory written by chunk_recorder.ChunkRecorder is read directly (it needs no cache).
+    """
+    if cache not in CACHE_MODES:
+        raise ValueError(f"cache must be one of {CACHE_MODES}, not {cache!r}")
+
+    columns = resolve_columns(columns)
+    if os.path.isdir(file):
+        from chunk_recorder import read_chunks # imports session itself
+        return read_chunks(file, stimulus_marker_name, gaze_name, columns, dtype)
+    if cache == 'use':
+        session = read_cache(file, stimulus_marker_name, gaze_name, columns, dtype)
+        if session is not None:
+            return session
+
+    session = read_xdf(file, stimulus_marker_name, gaze_name, columns, dtype)
+    if cache != 'off':
+        write_cache(file, session, stimulus_marker_name, gaze_name, dtype)
+        # Re-open memory-mapped so a fresh and a cached load behave the same
+        session = read_cache(file, stimulus_marker_name, gaze_name, columns, dtype)
+    return session
@@ -0,0 +1,132 @@
+# Copyright 2022
+# Author: scott.allan.stone@gmail.com (Scott Stone)
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+NYSTAGMUS_BAND = (0.5, 5.0) # Hz
+
+def _segments(signal: np.ndarray, nperseg: int, overlap: float) -> np.ndarray:
+    """Overlapping segments of an (N, C) signal as a strided (C, S, nperseg) view, nothing is copied
+    """
+    step = max(1, int(nperseg * (1 - overlap)))
+    return sliding_window_view(signal.T, nperseg, axis=-1)[:, ::step]
+
+def _hann(n: int) -> np.ndarray:
+    """Periodic Hann window (as scipy.signal.welch uses): its spectrum is just the first two bins
+    """
+    return 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(n) / n)
+
+def segment_spectra(segments: np.ndarray, sample_rate: float, detrend: str = 'constant', average: bool = False,
+                    batch: int = 8) -> tuple:
+    """Periodic Hann windowed, one-sided power spectral density of equal-length segments (..., S, nperseg),
+       e.g. the Welch segments of a signal or windows gathered from many phases (Cohort.spectra).
+       detrend is 'constant', 'linear' or None, removed from every segment on its own.
+       Returns (frequencies (F,), power (..., S, F)), or with average the mean over the segments (..., F).
+       The segments (usually an overlapping strided view) are windowed `batch` at a time into one small
+       reused buffer and transformed from there, so they are never copied whole. The trend is fitted
+       straight from the view and taken out of the spectrum instead of the samples: with a periodic Hann
+       window a constant only reaches bins 0 and 1.
+    """
+    nperseg = segments.shape[-1]
+    window = _hann(nperseg)
+    if detrend not in ('constant', 'linear', None):
+        raise ValueError(f"detrend must be 'constant', 'linear' or None, not {detrend!r}")
+    if detrend is not None:
+        mean = np.einsum('...n->...', segments) / nperseg
+        mean_spectrum = np.fft.rfft(window)[:2]
+    if detrend == 'linear':
+        t = np.arange(nperseg) - (nperseg - 1) / 2
+        slope = np.einsum('...n,n->...', segments, t) / (t ** 2).sum()
+        slope_spectrum = np.fft.rfft(t * window)
+
+    n_segments = segments.shape[-2]
+    n_frequencies = nperseg // 2 + 1
+    power = np.zeros(segments.shape[:-2] + ((n_frequencies,) if average else (n_segments, n_frequencies)))
+    buffer = np.empty(segments.shape[:-2] + (min(batch, n_segments), nperseg))
+    for first in range(0, n_segments, batch):
+        part = segments[..., first:first + batch, :]
+        windowed = buffer[..., :part.shape[-2], :]
+        np.multiply(part, window, out=windowed)
+        spectrum = np.fft.rfft(windowed, axis=-1)
+        if detrend is not None:
+            spectrum[..., :2] -= mean[..., first:first + batch, None] * mean_spectrum
+        if detrend == 'linear':
+            spectrum -= slope[..., first:first + batch, None] * slope_spectrum
+        part_power = np.square(spectrum.real)
+        part_power += np.square(spectrum.imag)
+        if average:
+            power += part_power.sum(axis=-2)
+        else:
+            power[..., first:first + batch, :] = part_power
+
+    if average:
+        power /= max(n_segments, 1)
+    power /= sample_rate * (window ** 2).sum()
+    # One-sided: every bin except DC (and Nyquist for an even length) holds half the power
+    power[..., 1:(nperseg + 1) // 2] *= 2
+    return np.fft.rfftfreq(nperseg, 1 / sample_rate), power
+
+def _segment_length(n: int, sample_rate: float, segment_seconds: float) -> int:
+    """Samples per segment: the power of two closest to segment_seconds (fast FFT sizes), at most n
+    """
+    target = max(2, segment_seconds * sample_rate)
+    return int(max(2, min(n, 2 ** round(np.log2(target)))))
+
+def welch(signal: np.ndarray,
+          sample_rate: float,
+          segment_seconds: float = 8.0,
+          overlap: float = 0.5,
+          detrend: str = 'constant') -> tuple:
+    """Welch power spectral density of every column of an (N, C) signal (periodic Hann window).
+       The segments are a strided view of the signal and the power is averaged batch by batch, so
+       nothing the size of the phase (or of all the overlapping segments) is allocated.
+       Returns (frequencies (F,), psd (F, C)).
+    """
+    signal = np.asarray(signal)
+    if signal.ndim == 1:
+        signal = signal[:, None]
+    nperseg = _segment_length(len(signal), sample_rate, segment_seconds)
+    frequencies, power = segment_spectra(_segments(signal, nperseg, overlap), sample_rate, detrend,
+                                          average=True)
+    return frequencies, power.T
+
+def spectrogram(signal: np.ndarray,
+                sample_rate: float,
+                segment_seconds: float = 2.0,
+                overlap: float = 0.5,
+                detrend: str = 'constant') -> tuple:
+    """Short-time power spectrum of every column of an (N, C) signal.
+       Returns (segment centre times (S,), frequencies (F,), power (S, F, C)).
+    """
+    signal = np.asarray(signal)
+    if signal.ndim == 1:
+        signal = signal[:, None]
+    nperseg = _segment_length(len(signal), sample_rate, segment_seconds)
+    step = max(1, int(nperseg * (1 - overlap)))
+    frequencies, power = segment_spectra(_segments(signal, nperseg, overlap), sample_rate, detrend)
+    times = (np.arange(power.shape[1]) * step + nperseg / 2) / sample_rate
+    return times, frequencies, np.moveaxis(power, 0, -1)
+
+def band_summary(frequencies: np.ndarray, psd: np.ndarray, band: tuple = NYSTAGMUS_BAND) -> dict:
+    """Dominant frequency and total power inside the band, for every column of psd (F, C)
+    """
+    in_band = (frequencies >= band[0]) & (frequencies <= band[1])
+    if not np.any(in_band):
+        n = psd.shape[1]
+        return {'dominant_frequency': np.full(n, np.nan), 'band_power': np.full(n, np.nan)}
+
+    band_psd = psd[in_band]
+    df = frequencies[1] - frequencies[0]
+    return {'dominant_frequency': frequencies[in_band][np.argmax(band_psd, axis=0)],
+            'band_power': band_psd.sum(axis=0) * df}
+
+def nystagmus_spectrum(gaze: np.ndarray,
+                       sample_rate: float,
+                       band: tuple = NYSTAGMUS_BAND,
+                       segment_seconds: float = 8.0) -> dict:
+    """Welch spectrum of all gaze columns at once plus its dominant frequency and band power
+    """
+    frequencies, psd = welch(gaze, sample_rate, segment_seconds=segment_seconds)
+    summary = band_summary(frequencies, psd, band)
+    summary['frequencies'], summary['psd'] = frequencies, psd
+    return summary
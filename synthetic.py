@@ -0,0 +1,272 @@
+# Copyright 2022
+# Author: scott.allan.stone@gmail.com (Scott Stone)
+import argparse
+import os
+import threading
+import numpy as np
+import pylsl
+from session import PUPIL_CAPTURE_CHANNELS
+from timeline import STIM_ORDER, stare_steps, pursuit_steps, jump_steps, brightness_steps
+from xdf_writer import XDFWriter
+
+CENTRE = (0.5, 0.5) # screen positions are normalised (0-1, y down), as in timeline.py
+
+class Protocol:
+    """Marker timeline and target trajectory of one run of run_stimulus.py, played from the same
+       timeline.py steps the stimulus draws. Only what the experimenter decides (how long the VOR
+       phase runs, the pauses between conditions) is made up here.
+       The target is piecewise linear between keyframes (a jump is two keyframes at the same time).
+    """
+    def __init__(self, start_time: float = 1000.0, rng: np.random.Generator = None, redo_vor: bool = True,
+                 stim_order: tuple = STIM_ORDER):
+        self.rng = np.random.default_rng() if rng is None else rng
+        self.redo = redo_vor
+        self.t = start_time
+        self.markers, self.key_times, self.key_positions = [], [], []
+        self.brightness_high = []
+        self.marker('stimulus_begin')
+        self.hold(CENTRE, 1.0)
+        for stim in stim_order:
+            getattr(self, stim)()
+            self.marker(stim + '_end')
+            self.hold(CENTRE, self.rng.uniform(2, 5)) # experimenter presses space
+        self.marker('stimulus_end')
+
+    def marker(self, label: str) -> None:
+        self.markers.append((label, self.t))
+
+    def move(self, start: tuple, end: tuple, seconds: float) -> None:
+        self.key_times += [self.t, self.t + seconds]
+        self.key_positions += [start, end]
+        self.t += seconds
+
+    def hold(self, position: tuple, seconds: float) -> None:
+        self.move(position, position, seconds)
+
+    def play(self, steps: list) -> None:
+        """Markers and target path of a list of timeline.step()s
+        """
+        for step in steps:
+            for label in step['markers']:
+                self.marker(label)
+            self.move(step['start'], step['end'], step['seconds'])
+            for label in step['after']:
+                self.marker(label)
+
+    def stare(self) -> None:
+        self.play(stare_steps(self.rng))
+
+    def pursuit(self) -> None:
+        self.play(pursuit_steps(self.rng))
+
+    def vor(self) -> None:
+        self.marker('vor')
+        self.hold(CENTRE, self.rng.uniform(10, 20))
+        if self.redo:
+            self.marker('redo_trial')
+            self.marker('vor')
+            self.hold(CENTRE, self.rng.uniform(10, 20))
+
+    def jump(self) -> None:
+        self.play(jump_steps(self.rng))
+
+    def brightness(self) -> None:
+        dark, high = brightness_steps(self.rng)
+        self.play([dark])
+        self.brightness_high.append(self.t)
+        self.play([high])
+
+    def target(self, t: np.ndarray) -> np.ndarray:
+        """Target position at times t, (N, 2)
+        """
+        key_times = np.asarray(self.key_times)
+        key_positions = np.asarray(self.key_positions)
+        return np.stack((np.interp(t, key_times, key_positions[:, 0]),
+                         np.interp(t, key_times, key_positions[:, 1])), axis=1)
+
+    def scale(self, factor: float) -> None:
+        """Stretch the whole timeline in time (keeps the start time)
+        """
+        t0 = self.key_times[0]
+        self.markers = [(label, t0 + (t - t0) * factor) for label, t in self.markers]
+        self.key_times = [t0 + (t - t0) * factor for t in self.key_times]
+        self.brightness_high = [t0 + (t - t0) * factor for t in self.brightness_high]
+        self.t = t0 + (self.t - t0) * factor
+
+def channel_labels(n_channels: int) -> tuple:
+    """The pupil_capture layout, cut short or padded with extra channels
+    """
+    extra = tuple(f'extra_{i}' for i in range(max(0, n_channels - len(PUPIL_CAPTURE_CHANNELS))))
+    return (PUPIL_CAPTURE_CHANNELS + extra)[:n_channels]
+
+def gaze_samples(t: np.ndarray,
+                 protocol: Protocol,
+                 blinks: np.ndarray,
+                 rng: np.random.Generator,
+                 n_channels: int,
+                 latency: float = 0.2,
+                 nystagmus_hz: float = 3.0,
+                 nystagmus_amplitude: float = 0.01,
+                 noise: float = 0.002) -> np.ndarray:
+    """Synthetic pupil_capture samples at times t: gaze follows the target after `latency` seconds with a
+       horizontal sawtooth nystagmus (slow drift, fast reset), noise, blinks, and a pupillary light response
+       after every brightness_high
+    """
+    gaze = protocol.target(t - latency)
+    if nystagmus_hz > 0:
+        beat = (t * nystagmus_hz) % 1
+        slow = 0.9 # fraction of each beat spent in the slow phase
+        gaze[:, 0] += nystagmus_amplitude * np.where(beat < slow, beat / slow, (1 - beat) / (1 - slow))
+    eyes = [gaze + rng.normal(0, noise, size=gaze.shape) + offset for offset in (-0.01, 0.01)]
+
+    # Pupil diameter (mm): constricts by 30% 0.25s after the screen turns white, partly recovers
+    diameter = np.full(len(t), 3.5)
+    for onset in protocol.brightness_high:
+        dt = t - onset - 0.25
+        after = dt > 0
+        diameter[after] -= 1.05 * (1 - np.exp(-dt[after] / 0.3)) * (0.6 + 0.4 * np.exp(-dt[after] / 3))
+
+    in_blink = np.searchsorted(blinks[:, 0], t, side='right') - 1
+    blinking = (in_blink >= 0) & (t < blinks[np.maximum(in_blink, 0), 1])
+
+    columns = {'confidence': np.where(blinking, 0.0, rng.uniform(0.85, 1.0, size=len(t))),
+               'norm_pos_x': (eyes[0][:, 0] + eyes[1][:, 0]) / 2, 'norm_pos_y': (eyes[0][:, 1] + eyes[1][:, 1]) / 2}
+    columns['gaze_point_3d_x'] = (columns['norm_pos_x'] - 0.5) * 600
+    columns['gaze_point_3d_y'] = (columns['norm_pos_y'] - 0.5) * 400
+    columns['gaze_point_3d_z'] = np.full(len(t), 500.0)
+    for eye, (x, y) in enumerate(((20.0, 15.0), (-40.0, 15.0))):
+        columns[f'eye_{eye}_center_x'], columns[f'eye_{eye}_center_y'] = np.full(len(t), x), np.full(len(t), y)
+        columns[f'eye_{eye}_center_z'] = np.full(len(t), -20.0)
+        columns[f'gaze_normal_3d_eye_{eye}_x'] = eyes[eye][:, 0] - 0.5
+        columns[f'gaze_normal_3d_eye_{eye}_y'] = eyes[eye][:, 1] - 0.5
+        columns[f'gaze_normal_3d_eye_{eye}_z'] = np.full(len(t), 1.0)
+        columns[f'diameter_3d_eye_{eye}'] = diameter + rng.normal(0, 0.02, size=len(t))
+        columns[f'diameter_2d_eye_{eye}'] = columns[f'diameter_3d_eye_{eye}'] * 12
+
+    samples = np.empty((len(t), n_channels), dtype=np.float32)
+    for i, label in enumerate(channel_labels(n_channels)):
+        samples[:, i] = columns[label] if label in columns else rng.normal(0, 1, size=len(t))
+    # Blinks: the tracker loses the pupil
+    samples[blinking, 1:] = 0
+    return samples
+
+def write_session(file: str,
+                  duration: float = None,
+                  sample_rate: float = 200,
+                  n_channels: int = len(PUPIL_CAPTURE_CHANNELS),
+                  seed: int = None,
+                  blink_rate: float = 0.25,
+                  redo_vor: bool = True,
+                  chunk_seconds: float = 60,
+                  **eye_model) -> Protocol:
+    """Write one synthetic session as XDF, in the shape run_stimulus.py records it: a Stimulus_Markers
+       string stream and a pupil_capture gaze stream. If duration (seconds) is given, the protocol is
+       stretched in time to fill it. eye_model is passed on to gaze_samples (latency, nystagmus_hz, ...).
+       The gaze is generated and written chunk_seconds at a time, so memory doesn't grow with duration.
+    """
+    rng = np.random.default_rng(seed)
+    protocol = Protocol(rng=rng, redo_vor=redo_vor)
+    start, end = protocol.key_times[0] - 1, protocol.t + 1
+    if duration is not None:
+        protocol.scale((duration - 2) / (end - start - 2))
+        end = protocol.t + 1
+
+    n_blinks = rng.poisson(blink_rate * (end - start))
+    blink_starts = np.sort(rng.uniform(start, end, size=n_blinks))
+    blinks = np.stack((blink_starts, blink_starts + rng.uniform(0.1, 0.3, size=n_blinks)), axis=1)
+    if n_blinks == 0:
+        blinks = np.full((1, 2), -np.inf)
+
+    os.makedirs(os.path.dirname(os.path.abspath(file)), exist_ok=True)
+    with XDFWriter(file) as xdf:
+        xdf.add_stream(1, 'Stimulus_Markers', 'Marker', 1, 0, 'string', source_id='stim-prog-1')
+        xdf.add_stream(2, 'pupil_capture', 'Gaze', n_channels, sample_rate, 'float32',
+                       channel_labels=channel_labels(n_channels))
+
+        labels, times = zip(*protocol.markers)
+        xdf.write_samples(1, times, [[label] for label in labels])
+
+        n = int((end - start) * sample_rate)
+        chunk = int(chunk_seconds * sample_rate)
+        for first in range(0, n, chunk):
+            t = start + np.arange(first, min(n, first + chunk)) / sample_rate
+            t = np.sort(t + rng.normal(0, 0.1 / sample_rate, size=len(t))) # timestamp jitter
+            xdf.write_samples(2, t, gaze_samples(t, protocol, blinks, rng, n_channels, **eye_model))
+    return protocol
+
+class SyntheticGazeOutlet:
+    """A live pupil_capture Gaze stream on the local network, for trying the gaze monitor (monitor.py) without
+       an eye tracker. A background thread pushes gaze_samples in real time, chunk_seconds at a time, from a
+       Protocol that starts now; raise blink_rate to make the quality bad, or pause() to stop samples arriving.
+    """
+    def __init__(self, sample_rate: float = 200, n_channels: int = len(PUPIL_CAPTURE_CHANNELS), seed: int = None,
+                 blink_rate: float = 0.25, chunk_seconds: float = 0.02, name: str = 'pupil_capture', **eye_model):
+        self.sample_rate = sample_rate
+        self.n_channels = n_channels
+        self.blink_rate = blink_rate
+        self.chunk_seconds = chunk_seconds
+        self.eye_model = eye_model
+        self.rng = np.random.default_rng(seed)
+        info = pylsl.StreamInfo(name, 'Gaze', n_channels, sample_rate, pylsl.cf_float32, 'synthetic-gaze-1')
+        channels = info.desc().append_child('channels')
+        for label in channel_labels(n_channels):
+            channels.append_child('channel').append_child_value('label', label)
+        self.outlet = pylsl.StreamOutlet(info)
+        self.paused = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self) -> None:
+        start = pylsl.local_clock()
+        protocol = Protocol(start_time=start + 1, rng=self.rng)
+        sent = 0
+        while not self._stop.wait(self.chunk_seconds):
+            now = pylsl.local_clock()
+            t = start + np.arange(sent, int((now - start) * self.sample_rate)) / self.sample_rate
+            sent += len(t)
+            if len(t) == 0 or self.paused.is_set():
+                continue
+            n_blinks = self.rng.poisson(self.blink_rate * len(t) / self.sample_rate)
+            blink_starts = np.sort(self.rng.uniform(t[0] - 0.3, t[-1], size=n_blinks))
+            blinks = np.stack((blink_starts, blink_starts + self.rng.uniform(0.1, 0.3, size=n_blinks)), axis=1)
+            if n_blinks == 0:
+                blinks = np.full((1, 2), -np.inf)
+            samples = gaze_samples(t, protocol, blinks, self.rng, self.n_channels, **self.eye_model)
+            self.outlet.push_chunk(samples, float(t[-1]))
+
+    def start(self) -> 'SyntheticGazeOutlet':
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='synthetic-gaze', daemon=True)
+        self._thread.start()
+        return self
+
+    def pause(self, paused: bool = True) -> None:
+        if paused:
+            self.paused.set()
+        else:
+            self.paused.clear()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+def main():
+    parser = argparse.ArgumentParser(description="Write synthetic recordings shaped like run_stimulus.py output")
+    parser.add_argument('--out', default='data', help="directory to create the pt_synthetic_* sessions in")
+    parser.add_argument('--sessions', type=int, default=1)
+    parser.add_argument('--duration', type=float, default=None, help="seconds per session (default: real length)")
+    parser.add_argument('--rate', type=float, default=200, help="gaze sample rate (Hz)")
+    parser.add_argument('--channels', type=int, default=len(PUPIL_CAPTURE_CHANNELS))
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for i in range(args.sessions):
+        name = f'pt_synthetic_{i:04d}'
+        file = os.path.join(args.out, name, name + '.xdf')
+        write_session(file, duration=args.duration, sample_rate=args.rate, n_channels=args.channels,
+                      seed=args.seed + i)
+        print(f"Wrote {file}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+# Copyright 2022
+# Author: scott.allan.stone@gmail.com (Scott Stone)
+import json
+import numpy as np
+from markers import PURSUIT_DIRECTIONS
+from frame_log import SUB_PHASES
+
+# The protocol, declaratively. Times are in seconds, positions are fractions of the screen.
+STIM_ORDER = ('stare', 'pursuit', 'vor', 'jump', 'brightness')
+STARE_TIME = 20
+PURSUIT_ORDER = PURSUIT_DIRECTIONS
+PURSUIT_EDGES = {'left': (0.1, 0.5), 'right': (0.9, 0.5), 'top': (0.5, 0.1), 'bottom': (0.5, 0.9)}
+TRAVEL_TIME = 2   # to get to the end position at a constant velocity
+HOLD_TIME = 3     # after a _hold direction
+SETTLE_TIME = 0.5 # after every other direction
+JUMP_ORDER = ('cross',) + ('left', 'cross', 'right', 'cross') * 4
+JUMP_TARGETS = {'cross': (0.5, 0.5), 'left': (1 / 20, 0.5), 'right': (19 / 20, 0.5)}
+JUMP_FIRST_TIME = 3 # the first one should be 3s
+JUMP_MIN_TIME, JUMP_MAX_TIME = 0.5, 1.5
+BRIGHTNESS_TIME = 10 # the background turns white halfway through
+TARGET_SIZE = 20 # pixels
+
+WHITE, BLACK = (255, 255, 255), (0, 0, 0)
+SHAPES = ('none', 'cross', 'dot')
+NONE, CROSS, DOT = range(len(SHAPES))
+FRAME_DTYPE = np.dtype([('shape', np.uint8),          # index into SHAPES
+                        ('x', np.int32),              # pixels
+                        ('y', np.int32),
+                        ('colour', np.uint8, (3,)),
+                        ('background', np.uint8, (3,)),
+                        ('sub_phase', np.uint8)])     # index into frame_log.SUB_PHASES
+
+def step(shape: int, start: tuple, seconds: float = None, end: tuple = None, frames: int = None,
+         colour: tuple = WHITE, background: tuple = BLACK, markers: tuple = (), after: tuple = (),
+         sub_phase: str = '') -> dict:
+    """One piece of a condition: a shape held at `start`, or moved from `start` to `end` at constant speed.
+       `markers` are sent with its first frame, `after` with the frame after its last.
+    """
+    return {'shape': shape, 'start': start, 'end': start if end is None else end, 'seconds': seconds,
+            'frames': frames, 'colour': colour, 'background': background, 'markers': markers, 'after': after,
+            'sub_phase': sub_phase}
+
+def stare_steps(rng) -> list:
+    return [step(CROSS, (0.5, 0.5), STARE_TIME, markers=('stare',))]
+
+def pursuit_steps(rng) -> list:
+    steps = []
+    for dir in PURSUIT_ORDER:
+        name = dir.replace('_hold', '').replace('_centre', '')
+        if dir.endswith('_centre'):
+            # e.g. right_centre travels back to the centre from the opposite (left) edge
+            opposite = {'left': 'right', 'right': 'left', 'top': 'bottom', 'bottom': 'top'}[name]
+            start, end = PURSUIT_EDGES[opposite], (0.5, 0.5)
+        else:
+            start, end = (0.5, 0.5), PURSUIT_EDGES[name]
+        markers = ('pursuit',) if not steps else ()
+        steps.append(step(DOT, start, TRAVEL_TIME, end=end, markers=markers + ('pursuit_' + dir + '_start',),
+                          sub_phase='pursuit_' + dir))
+        steps.append(step(DOT, end, HOLD_TIME if dir.endswith('_hold') else SETTLE_TIME,
+                          after=('pursuit_' + dir + '_end',), sub_phase='pursuit_' + dir))
+    return steps
+
+def vor_steps(rng) -> list:
+    # The experimenter decides how long this one goes on for
+    return [step(CROSS, (0.5, 0.5), frames=1, markers=('vor',))]
+
+def jump_steps(rng) -> list:
+    times = rng.uniform(JUMP_MIN_TIME, JUMP_MAX_TIME, size=len(JUMP_ORDER))
+    times[0] = JUMP_FIRST_TIME
+    steps = []
+    for target, seconds in zip(JUMP_ORDER, times):
+        markers = ('jump',) if not steps else ()
+        steps.append(step(CROSS if target == 'cross' else DOT, JUMP_TARGETS[target], seconds,
+                          markers=markers + ('jump_' + target,), sub_phase='jump_' + target))
+    return steps
+
+def brightness_steps(rng) -> list:
+    return [step(CROSS, (0.5, 0.5), BRIGHTNESS_TIME / 2, markers=('brightness',)),
+            step(CROSS, (0.5, 0.5), BRIGHTNESS_TIME / 2, colour=BLACK, background=WHITE,
+                 markers=('brightness_high',), sub_phase='brightness_high')]
+
+CONDITIONS = {'stare': stare_steps, 'pursuit': pursuit_steps, 'vor': vor_steps, 'jump': jump_steps,
+              'brightness': brightness_steps}
+WAIT_CONDITIONS = ('vor',) # end on the experimenter's key press instead of a fixed time
+
+class Segment:
+    """One condition compiled to per-frame arrays, plus the markers to send and the frame they go with.
+       A marker at frame == len(frames) goes after the last frame.
+    """
+    def __init__(self, name: str, frames: np.ndarray, marker_frames: np.ndarray, marker_labels: list,
+                 wait: bool = False):
+        self.name = name
+        self.frames = frames
+        self.marker_frames = np.asarray(marker_frames, dtype=np.int64)
+        self.marker_labels = list(marker_labels)
+        self.wait = wait
+
+        # Frames that look different from the one before (or send a marker) are the only ones drawn
+        changed = np.ones(len(frames), dtype=bool)
+        fields = [frames[field].reshape(len(frames), -1) for field in ('shape', 'x', 'y', 'colour', 'background')]
+        changed[1:] = np.any(np.concatenate([np.diff(field.astype(np.int64), axis=0) != 0 for field in fields],
+                                            axis=1), axis=1)
+        changed[self.marker_frames[self.marker_frames < len(frames)]] = True
+        self.draw_frames = np.flatnonzero(changed)
+        self.hold_frames = np.diff(np.append(self.draw_frames, len(frames)))
+        # Plain tuples (shape, x, y, colour, background, sub_phase) of the drawn frames, ready for pygame
+        drawn = frames[self.draw_frames]
+        self.draws = list(zip(drawn['shape'].tolist(), drawn['x'].tolist(), drawn['y'].tolist(),
+                              map(tuple, drawn['colour'].tolist()), map(tuple, drawn['background'].tolist()),
+                              drawn['sub_phase'].tolist()))
+        self.markers = {}
+        for frame, label in zip(self.marker_frames.tolist(), self.marker_labels):
+            self.markers.setdefault(frame, []).append(label)
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+def compile_steps(steps: list, width: int, height: int, fps: float, time_scale: float = 1.0) -> tuple:
+    """Steps -> (per-frame FRAME_DTYPE array, marker frames, marker labels).
+       time_scale shortens (or stretches) every timed step, e.g. 0.1 for a quick headless run.
+    """
+    counts = [s['frames'] if s['frames'] is not None else max(1, round(s['seconds'] * time_scale * fps))
+              for s in steps]
+    frames = np.zeros(sum(counts), dtype=FRAME_DTYPE)
+    marker_frames, marker_labels = [], []
+    first = 0
+    sub_phase_codes = {name: i for i, name in enumerate(SUB_PHASES)}
+    for s, n in zip(steps, counts):
+        block = frames[first:first + n]
+        start = (s['start'][0] * width, s['start'][1] * height)
+        end = (s['end'][0] * width, s['end'][1] * height)
+        # Worked out in whole pixels beforehand since we can't move sub-pixel at a time
+        block['x'] = np.round(np.linspace(start[0], end[0], n))
+        block['y'] = np.round(np.linspace(start[1], end[1], n))
+        block['shape'] = s['shape']
+        block['colour'] = s['colour']
+        block['background'] = s['background']
+        block['sub_phase'] = sub_phase_codes[s['sub_phase']]
+        marker_frames += [first] * len(s['markers']) + [first + n] * len(s['after'])
+        marker_labels += list(s['markers']) + list(s['after'])
+        first += n
+    order = np.argsort(marker_frames, kind='stable')
+    return frames, np.asarray(marker_frames, dtype=np.int64)[order], [marker_labels[i] for i in order]
+
+class Timeline:
+    """The whole protocol compiled before the first trial, so the render loop only indexes arrays.
+       The random jump times are drawn here, and save() keeps them with the recording so target positions
+       can be reconstructed exactly afterwards.
+    """
+    def __init__(self, width: int, height: int, fps: float = 60, stim_order: tuple = STIM_ORDER,
+                 rng: np.random.Generator = None, segments: dict = None, time_scale: float = 1.0):
+        self.width, self.height, self.fps = width, height, fps
+        self.stim_order = tuple(stim_order)
+        self.time_scale = time_scale
+        if segments is None:
+            rng = np.random.default_rng() if rng is None else rng
+            segments = {}
+            for name in self.stim_order:
+                frames, marker_frames, marker_labels = compile_steps(CONDITIONS[name](rng), width, height, fps,
+                                                                     time_scale)
+                segments[name] = Segment(name, frames, marker_frames, marker_labels, wait=name in WAIT_CONDITIONS)
+        self.segments = segments
+
+    def __getitem__(self, name: str) -> Segment:
+        return self.segments[name]
+
+    def trajectory(self, name: str) -> tuple:
+        """Target position of a condition per frame in screen fractions: (seconds since its first frame, (N, 2))
+        """
+        frames = self.segments[name].frames
+        return np.arange(len(frames)) / self.fps, np.stack((frames['x'] / self.width, frames['y'] / self.height), axis=1)
+
+    def save(self, file: str) -> None:
+        arrays = {}
+        for name, segment in self.segments.items():
+            arrays[name + '_frames'] = segment.frames
+            arrays[name + '_marker_frames'] = segment.marker_frames
+        meta = {'width': self.width, 'height': self.height, 'fps': self.fps, 'stim_order': self.stim_order,
+                'time_scale': self.time_scale,
+                'marker_labels': {name: segment.marker_labels for name, segment in self.segments.items()},
+                'wait': {name: segment.wait for name, segment in self.segments.items()}}
+        np.savez(file, meta=np.array(json.dumps(meta)), **arrays)
+
+def load_timeline(file: str) -> Timeline:
+    with np.load(file) as data:
+        meta = json.loads(str(data['meta']))
+        segments = {name: Segment(name, data[name + '_frames'], data[name + '_marker_frames'],
+                                  meta['marker_labels'][name], wait=meta['wait'][name])
+                    for name in meta['stim_order']}
+    return Timeline(meta['width'], meta['height'], meta['fps'], meta['stim_order'], segments=segments,
+                    time_scale=meta.get('time_scale', 1.0))
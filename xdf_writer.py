@@ -0,0 +1,97 @@
+# Copyright 2022
+# Author: scott.allan.stone@gmail.com (Scott Stone)
+import struct
+from xml.sax.saxutils import escape
+import numpy as np
+
+# Chunk tags from the XDF specification
+FILE_HEADER, STREAM_HEADER, SAMPLES, CLOCK_OFFSET, BOUNDARY, STREAM_FOOTER = 1, 2, 3, 4, 5, 6
+NUMERIC_FORMATS = {'float32': '<f4', 'double64': '<f8', 'int8': '<i1', 'int16': '<i2', 'int32': '<i4', 'int64': '<i8'}
+
+def _varlen(value: int) -> bytes:
+    """XDF variable-length integer: one byte saying how many bytes follow, then the value"""
+    if value < 256:
+        return struct.pack('<BB', 1, value)
+    if value < 2 ** 32:
+        return struct.pack('<BI', 4, value)
+    return struct.pack('<BQ', 8, value)
+
+class XDFWriter:
+    """Minimal XDF 1.0 writer: one header per stream, sample chunks, and a footer per stream on close.
+       Enough for pyxdf / liesl.XDFFile to read the file back like a LabRecorder recording.
+    """
+    def __init__(self, file: str):
+        self.f = open(file, 'wb')
+        self.f.write(b'XDF:')
+        self._chunk(FILE_HEADER, b'<?xml version="1.0"?><info><version>1.0</version></info>')
+        self.streams = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def _chunk(self, tag: int, content: bytes) -> None:
+        self.f.write(_varlen(len(content) + 2))
+        self.f.write(struct.pack('<H', tag))
+        self.f.write(content)
+
+    def add_stream(self, stream_id: int, name: str, type: str, channel_count: int, nominal_srate: float,
+                   channel_format: str, channel_labels: tuple = None, source_id: str = '') -> None:
+        """Write a stream header. channel_format is 'string' or one of NUMERIC_FORMATS.
+        """
+        channels = ''
+        if channel_labels is not None:
+            channels = '<channels>' + ''.join(f'<channel><label>{escape(label)}</label></channel>'
+                                              for label in channel_labels) + '</channels>'
+        info = (f'<?xml version="1.0"?><info><name>{escape(name)}</name><type>{escape(type)}</type>'
+                f'<channel_count>{channel_count}</channel_count><nominal_srate>{nominal_srate}</nominal_srate>'
+                f'<channel_format>{channel_format}</channel_format><source_id>{escape(source_id)}</source_id>'
+                f'<created_at>0</created_at><desc>{channels}</desc></info>')
+        self._chunk(STREAM_HEADER, struct.pack('<I', stream_id) + info.encode())
+        self.streams[stream_id] = {'format': channel_format, 'channel_count': channel_count,
+                                   'first': None, 'last': None, 'count': 0}
+
+    def write_samples(self, stream_id: int, time_stamps: np.ndarray, samples) -> None:
+        """Write one chunk of samples. Numeric samples are an (N, C) array, string samples a list of lists.
+        """
+        stream = self.streams[stream_id]
+        time_stamps = np.asarray(time_stamps, dtype=np.float64)
+        n = len(time_stamps)
+        if n == 0:
+            return
+
+        if stream['format'] == 'string':
+            body = bytearray()
+            for time_stamp, sample in zip(time_stamps, samples):
+                body += struct.pack('<Bd', 8, time_stamp)
+                for value in sample:
+                    raw = str(value).encode()
+                    body += _varlen(len(raw)) + raw
+            body = bytes(body)
+        else:
+            # Every sample is [8][timestamp][values], packed in one go
+            dtype = np.dtype([('n', 'u1'), ('t', '<f8'),
+                              ('v', NUMERIC_FORMATS[stream['format']], (stream['channel_count'],))])
+            packed = np.empty(n, dtype=dtype)
+            packed['n'], packed['t'], packed['v'] = 8, time_stamps, samples
+            body = packed.tobytes()
+
+        self._chunk(SAMPLES, struct.pack('<I', stream_id) + _varlen(n) + body)
+        stream['first'] = time_stamps[0] if stream['first'] is None else stream['first']
+        stream['last'] = time_stamps[-1]
+        stream['count'] += n
+
+    def close(self) -> None:
+        if self.f.closed:
+            return
+        for stream_id, stream in self.streams.items():
+            # A zero clock offset at both ends, as LabRecorder writes for a stream on the local machine
+            for t in (stream['first'] or 0, stream['last'] or 0):
+                self._chunk(CLOCK_OFFSET, struct.pack('<Idd', stream_id, t, 0.0))
+            footer = (f'<?xml version="1.0"?><info><first_timestamp>{stream["first"] or 0}</first_timestamp>'
+                      f'<last_timestamp>{stream["last"] or 0}</last_timestamp>'
+                      f'<sample_count>{stream["count"]}</sample_count></info>')
+            self._chunk(STREAM_FOOTER, struct.pack('<I', stream_id) + footer.encode())
+        self.f.close()